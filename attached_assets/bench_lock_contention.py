@@ -0,0 +1,120 @@
+"""Multi-threaded contention benchmark for the lock manager
+
+Worker threads run transactions that take row write locks, each followed by log_operation and
+is_transaction_active, the calls that used to share TransactionManager.transaction_lock. It reports
+lock operations per second and the latency of single operations:
+
+    python bench_lock_contention.py [--threads 1 2 4 8] [--stripes 1 16] [--engine DIR]
+
+"checkpoint" rows run the workers while another thread checkpoints a database with a large indexed
+table. Capturing the snapshot holds transaction_lock, which every lock operation waited for before
+the lock table was striped. --engine runs the same benchmark against the oldengine.py in another
+directory, e.g. an older checkout.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+KEYS_PER_TRANSACTION = 20
+CHECKPOINT_ROWS = 100000
+
+
+def open_database(directory, stripes, wal_mode=False):
+    from oldengine import Database
+    options = {"checkpoint_interval": 0, "lock_escalation_threshold": 10 ** 6, "wal_mode": wal_mode}
+    if "lock_stripes" in Database.__init__.__code__.co_varnames:
+        options["lock_stripes"] = stripes
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Database(os.path.join(directory, "bench.json"), **options)
+
+
+def fill_for_checkpoints(db):
+    with contextlib.redirect_stdout(io.StringIO()):
+        db.create_table("big", ["id int", "v int"], {"id": ["primary_key"]})
+        db.begin_transaction("fill")
+        for key in range(CHECKPOINT_ROWS):
+            db.insert("big", str(key), [str(key), str(key)], "fill")
+        db.commit_transaction("fill")
+        db.create_index("big", "v")
+
+
+def run(db, threads, transactions, shared_table, checkpoints):
+    tm = db.transaction_manager
+    latencies = [[] for _ in range(threads)]
+    done = threading.Event()
+
+    def worker(number):
+        table = "t" if shared_table else f"t{number}"
+        timings = latencies[number]
+        for i in range(transactions):
+            transaction_id = f"w{number}_{i}"
+            tm.begin_transaction(transaction_id)
+            for key in range(KEYS_PER_TRANSACTION):
+                start = time.perf_counter()
+                tm.acquire_lock(transaction_id, table, f"{number}_{key}", 'write')
+                tm.log_operation(transaction_id, "update", table, key)
+                tm.is_transaction_active(transaction_id)
+                timings.append(time.perf_counter() - start)
+            tm.rollback_transaction(transaction_id)
+
+    def checkpointer():
+        while not done.is_set():
+            db.checkpoint()
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    background = threading.Thread(target=checkpointer)
+    with contextlib.redirect_stdout(io.StringIO()):  # The engine prints DEBUG lines
+        if checkpoints:
+            background.start()
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        if checkpoints:
+            background.join()
+
+    timings = sorted(timing for worker_timings in latencies for timing in worker_timings)
+    return {"ops_per_second": len(timings) / elapsed,
+            "p99_ms": timings[int(len(timings) * 0.99)] * 1000,
+            "max_ms": timings[-1] * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--stripes", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--transactions", type=int, default=500, help="Transactions per thread")
+    parser.add_argument("--engine", help="Directory of the oldengine.py to measure")
+    args = parser.parse_args()
+    sys.path.insert(0, args.engine or os.path.dirname(os.path.abspath(__file__)))
+
+    print(f"{'scenario':<26}{'stripes':>8}{'threads':>8}{'ops/s':>10}{'p99 ms':>9}{'max ms':>9}")
+    for scenario in ("distinct tables", "one shared table", "distinct + checkpoint"):
+        for stripes in args.stripes:
+            for threads in args.threads:
+                directory = tempfile.mkdtemp()
+                try:
+                    checkpoints = scenario.endswith("checkpoint")
+                    db = open_database(directory, stripes, wal_mode=checkpoints)
+                    if checkpoints:
+                        fill_for_checkpoints(db)
+                    result = run(db, threads, args.transactions, scenario == "one shared table", checkpoints)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        db.close()
+                finally:
+                    shutil.rmtree(directory, ignore_errors=True)
+                print(f"{scenario:<26}{stripes:>8}{threads:>8}{result['ops_per_second']:>10.0f}"
+                      f"{result['p99_ms']:>9.2f}{result['max_ms']:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
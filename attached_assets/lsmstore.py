@@ -0,0 +1,513 @@
+import os
+import json
+import base64
+import hashlib
+import heapq
+import shutil
+import struct
+import threading
+import weakref
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import MutableMapping, ItemsView, ValuesView
+
+DELETED = object()  # Tombstone: the key was deleted after it was written to an older run
+MISSING = object()  # The key does not appear in a memtable or run at all
+
+class BloomFilter:
+    """Bit array that answers "definitely not present" for most keys a run does not have"""
+    BITS_PER_KEY = 10
+    HASHES = 7
+
+    def __init__(self, bit_count, hash_count=HASHES, bits=None):
+        self.bit_count = max(8, bit_count)
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((self.bit_count + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, key_count):
+        return cls(key_count * cls.BITS_PER_KEY)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def to_json(self):
+        return {"bits": self.bit_count, "hashes": self.hash_count, "data": base64.b64encode(bytes(self.bits)).decode()}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["bits"], data["hashes"], bytearray(base64.b64decode(data["data"])))
+
+class SortedRun:
+    """Immutable run file: blocks of records and tombstones in key order, then a footer with the block index and bloom filter"""
+    LENGTH = struct.Struct("<Q")
+
+    def __init__(self, path, footer):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.level = footer["level"]
+        self.count = footer["count"]
+        self.blocks = footer["blocks"]  # [first key, offset, length] per block
+        self.first_keys = [block[0] for block in self.blocks]
+        self.bloom = BloomFilter.from_json(footer["bloom"])
+        self.file = open(path, 'rb')
+        self.read_lock = threading.Lock()
+
+    @classmethod
+    def write(cls, path, entries, encode_block, level, expected_count, block_records=128):
+        """Write (key, record or DELETED) pairs that arrive sorted by str(key)"""
+        bloom = BloomFilter.for_keys(max(1, expected_count))
+        blocks = []
+        count = 0
+        with open(path, 'wb') as file:
+            block = []
+            for key, value in chain_with_end(entries):
+                if key is not MISSING:
+                    block.append((key, value))
+                    bloom.add(key)
+                    count += 1
+                if block and (len(block) >= block_records or key is MISSING):
+                    data = encode_block(block)
+                    blocks.append([str(block[0][0]), file.tell(), len(data)])
+                    file.write(data)
+                    block = []
+            footer = json.dumps({"level": level, "count": count, "blocks": blocks,
+                                 "bloom": bloom.to_json()}).encode("utf-8")
+            file.write(footer + cls.LENGTH.pack(len(footer)))
+            file.flush()
+            os.fsync(file.fileno())
+        return cls.open(path)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            file.seek(-cls.LENGTH.size, os.SEEK_END)
+            footer_length = cls.LENGTH.unpack(file.read(cls.LENGTH.size))[0]
+            file.seek(-cls.LENGTH.size - footer_length, os.SEEK_END)
+            footer = json.loads(file.read(footer_length))
+        return cls(path, footer)
+
+    def read_block(self, index):
+        _, offset, length = self.blocks[index]
+        with self.read_lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def block_for(self, key):
+        """Index of the only block that can hold key, or -1"""
+        return bisect_right(self.first_keys, str(key)) - 1
+
+    def close(self):
+        self.file.close()
+
+def tag_entries(entries, age):
+    for key, value in entries:
+        yield str(key), age, key, value
+
+def chain_with_end(entries):
+    """Yield the entries followed by one (MISSING, None) marker so the writer can emit its last block"""
+    yield from entries
+    yield MISSING, None
+
+class LSMStore:
+    """Directory of one LSM table: the run files, memtable files and the manifest naming the current ones"""
+    MANIFEST = "manifest.json"
+    BLOCK_CACHE = 64  # Decoded blocks kept in memory
+
+    def __init__(self, directory, encode, decode, write_json, memtable_limit=4096, fanout=4, block_records=128):
+        self.directory = directory
+        self.encode = encode  # {key: record} -> bytes
+        self.decode = decode  # bytes -> {key: record}
+        self.write_json = write_json  # Writes the manifest atomically
+        self.memtable_limit = memtable_limit
+        self.fanout = fanout  # Runs of one level that get merged into a single run of the next level
+        self.block_records = block_records
+        self.lock = threading.RLock()
+        self.instances = weakref.WeakValueDictionary()  # id -> every LSMRecords sharing these runs
+        self.runs = {}  # name -> SortedRun for every run file that is open
+        self.manifest = None
+        self.next_file = 0
+        self.writing = set()  # Files being written or not yet installed, which flushes must not delete
+        self.block_cache = OrderedDict()  # (run name, block index) -> decoded block
+        self.stats = {"memtable_flushes": 0, "compactions": 0, "bloom_skips": 0, "bloom_false_positives": 0,
+                      "block_reads": 0, "block_cache_hits": 0}
+        self.compaction_event = threading.Event()
+        self.compactor = None
+        self.closed = False
+
+    def open(self, create=False):
+        """Open the table directory, returns the stored state or None for a new, empty table"""
+        if create:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        manifest_path = os.path.join(self.directory, self.MANIFEST)
+        state = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                self.manifest = json.load(file)
+            self.next_file = self.manifest["next_file"]
+            for name in self.manifest["runs"]:
+                self.runs[name] = SortedRun.open(os.path.join(self.directory, name))
+            memtable = {}
+            if self.manifest.get("memtable"):
+                with open(os.path.join(self.directory, self.manifest["memtable"]), 'rb') as file:
+                    memtable = self.decode_block(file.read())
+            state = {"memtable": memtable, "runs": list(self.manifest["runs"]), "count": self.manifest["count"],
+                     "lsn": self.manifest.get("lsn", 0), "version": self.manifest.get("version", 0)}
+        self._remove_unreferenced(self.manifest["runs"] if self.manifest else [])
+        self.compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self.compactor.start()
+        return state
+
+    def encode_block(self, entries):
+        """Encode (key, record or DELETED) pairs as the live records followed by the deleted keys"""
+        live = {key: value for key, value in entries if value is not DELETED}
+        deleted = [key for key, value in entries if value is DELETED]
+        data = self.encode(live) if live else b""
+        return SortedRun.LENGTH.pack(len(data)) + data + json.dumps(deleted).encode("utf-8")
+
+    def decode_block(self, data):
+        if not data:
+            return {}
+        length = SortedRun.LENGTH.unpack_from(data)[0]
+        start = SortedRun.LENGTH.size
+        block = self.decode(data[start:start + length]) if length else {}
+        for key in json.loads(data[start + length:]):
+            block[key] = DELETED
+        return block
+
+    def _new_file_name(self, extension):
+        """Reserve a new file name, call release once the file is installed or abandoned"""
+        with self.lock:
+            self.next_file += 1
+            name = f"{self.next_file:08d}.{extension}"
+            self.writing.add(name)
+            return name
+
+    def release(self, name):
+        with self.lock:
+            self.writing.discard(name)
+
+    def write_run(self, entries, level, expected_count):
+        """Write a run, its name stays reserved until the caller installs it and calls release"""
+        name = self._new_file_name("run")
+        try:
+            run = SortedRun.write(os.path.join(self.directory, name), entries, self.encode_block, level,
+                                  expected_count, self.block_records)
+        except Exception:
+            self.release(name)
+            raise
+        with self.lock:
+            self.runs[name] = run
+        return run
+
+    def lookup(self, run, key):
+        """Value of key in run, MISSING when the run does not have it"""
+        if not run.bloom.might_contain(key):
+            self.stats["bloom_skips"] += 1
+            return MISSING
+        index = run.block_for(key)
+        value = self.read_block(run, index).get(key, MISSING) if index >= 0 else MISSING
+        if value is MISSING:
+            self.stats["bloom_false_positives"] += 1
+        return value
+
+    def read_block(self, run, index):
+        cache_key = (run.name, index)
+        with self.lock:
+            block = self.block_cache.get(cache_key)
+            if block is not None:
+                self.stats["block_cache_hits"] += 1
+                self.block_cache.move_to_end(cache_key)
+                return block
+        block = self.decode_block(run.read_block(index))
+        with self.lock:
+            self.stats["block_reads"] += 1
+            self.block_cache[cache_key] = block
+            if len(self.block_cache) > self.BLOCK_CACHE:
+                self.block_cache.popitem(last=False)
+        return block
+
+    def iter_run(self, run):
+        for index in range(len(run.blocks)):
+            block = self.decode_block(run.read_block(index))
+            yield from sorted(block.items(), key=lambda item: str(item[0]))
+
+    def merge(self, sources):
+        """Merge (key, value) iterators sorted by str(key), the first source wins for keys in several of them"""
+        tagged = [tag_entries(source, age) for age, source in enumerate(sources)]
+        last = None
+        for sort_key, _, key, value in heapq.merge(*tagged, key=lambda item: (item[0], item[1])):
+            if sort_key != last:
+                last = sort_key
+                yield key, value
+
+    def request_compaction(self):
+        self.compaction_event.set()
+
+    def _compaction_loop(self):
+        while True:
+            self.compaction_event.wait()
+            self.compaction_event.clear()
+            if self.closed:
+                return
+            try:
+                while not self.closed and self.compact_once():
+                    pass
+            except Exception as e:
+                print(f"DEBUG: LSM compaction in {self.directory} failed: {str(e)}")
+
+    def _pick_compaction(self):
+        """Oldest group of at least fanout neighbouring runs on one level, with the instance it came from"""
+        with self.lock:
+            for instance in list(self.instances.values()):
+                runs = instance.runs
+                end = len(runs)
+                while end > 0:
+                    start = end - 1
+                    while start > 0 and runs[start - 1].level == runs[end - 1].level:
+                        start -= 1
+                    if end - start >= self.fanout:
+                        return runs[start:end], end == len(runs)
+                    end = start
+        return None, False
+
+    def compact_once(self):
+        """Merge one group of runs into a single run on the next level; returns False when nothing is due"""
+        group, oldest = self._pick_compaction()
+        if not group:
+            return False
+        entries = self.merge([self.iter_run(run) for run in group])
+        if oldest:
+            # Nothing older can hold these keys, so their tombstones have done their job
+            entries = ((key, value) for key, value in entries if value is not DELETED)
+        merged = self.write_run(entries, group[0].level + 1, sum(run.count for run in group))
+
+        with self.lock:
+            for instance in list(self.instances.values()):
+                instance.replace_runs(group, merged, oldest)
+            self.stats["compactions"] += 1
+            self.release(merged.name)
+        return True
+
+    def flush(self, state, lsn=0):
+        """Make a captured state durable: write the memtable, then atomically replace the manifest"""
+        memtable_name = None
+        try:
+            if state["memtable"]:
+                memtable_name = self._new_file_name("mem")
+                with open(os.path.join(self.directory, memtable_name), 'wb') as file:
+                    file.write(self.encode_block(list(state["memtable"].items())))
+                    file.flush()
+                    os.fsync(file.fileno())
+            with self.lock:
+                manifest = {"runs": state["runs"], "memtable": memtable_name, "count": state["count"],
+                            "next_file": self.next_file, "lsn": lsn, "version": state.get("version", 0)}
+                self.write_json(os.path.join(self.directory, self.MANIFEST), manifest)
+                self.manifest = manifest
+                referenced = set(manifest["runs"])
+                for instance in list(self.instances.values()):
+                    referenced.update(run.name for run in instance.runs)
+                self._remove_unreferenced(referenced)
+        finally:
+            if memtable_name is not None:
+                self.release(memtable_name)
+
+    def _remove_unreferenced(self, run_names):
+        """Delete run and memtable files that neither the manifest, a live LSMRecords nor a writer uses"""
+        keep = set(run_names)
+        if self.manifest and self.manifest.get("memtable"):
+            keep.add(self.manifest["memtable"])
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name == self.MANIFEST or name in keep or name in self.writing:
+                    continue
+                run = self.runs.pop(name, None)
+                if run is not None:
+                    run.close()
+                for cache_key in [cache_key for cache_key in self.block_cache if cache_key[0] == name]:
+                    del self.block_cache[cache_key]
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass  # Still open elsewhere, retried at the next flush
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, open_runs=len(self.runs))
+
+    def close(self):
+        self.closed = True
+        self.compaction_event.set()
+        if self.compactor is not None and self.compactor is not threading.current_thread():
+            self.compactor.join()
+        with self.lock:
+            for run in self.runs.values():
+                run.close()
+            self.runs = {}
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class LSMRecords(MutableMapping):
+    """Records of one table as a log-structured merge tree.
+
+    Writes go to an in-memory memtable that is written out as a sorted, immutable run once it is full.
+    Reads check the memtable and then the runs from newest to oldest, skipping runs whose bloom filter
+    rules the key out. A background thread merges runs so that reads stay cheap.
+    """
+    def __init__(self, store, state=None):
+        self.store = store
+        state = state or {"memtable": {}, "runs": [], "count": 0}
+        self.memtable = dict(state["memtable"])  # key -> record or DELETED
+        self.runs = tuple(store.runs[run] if isinstance(run, str) else run for run in state["runs"])  # Newest first
+        self.count = state["count"]
+        store.instances[id(self)] = self
+
+    def capture(self):
+        """State for LSMStore.flush; runs are immutable so only the memtable is copied"""
+        with self.store.lock:
+            return {"memtable": dict(self.memtable), "runs": [run.name for run in self.runs], "count": self.count}
+
+    def __deepcopy__(self, memo):
+        with self.store.lock:
+            return LSMRecords(self.store, {"memtable": self.memtable, "runs": self.runs, "count": self.count})
+
+    def __repr__(self):
+        return f"<LSMRecords {self.count} records in {self.store.directory}>"
+
+    def _lookup(self, key):
+        value = self.memtable.get(key, MISSING)
+        if value is not MISSING:
+            return value
+        for run in self.runs:
+            value = self.store.lookup(run, key)
+            if value is not MISSING:
+                return value
+        return MISSING
+
+    def __getitem__(self, key):
+        with self.store.lock:
+            value = self._lookup(key)
+        if value is MISSING or value is DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        with self.store.lock:
+            value = self._lookup(key)
+        return value is not MISSING and value is not DELETED
+
+    def __setitem__(self, key, record):
+        with self.store.lock:
+            if key not in self:
+                self.count += 1
+            self.memtable[key] = record
+            self._maybe_flush_memtable()
+
+    def __delitem__(self, key):
+        with self.store.lock:
+            if key not in self:
+                raise KeyError(key)
+            if self.runs:
+                self.memtable[key] = DELETED  # Hides the versions in older runs
+            else:
+                del self.memtable[key]
+            self.count -= 1
+            self._maybe_flush_memtable()
+
+    def _maybe_flush_memtable(self):
+        if len(self.memtable) < self.store.memtable_limit:
+            return
+        entries = sorted(self.memtable.items(), key=lambda item: str(item[0]))
+        if not self.runs:
+            entries = [(key, value) for key, value in entries if value is not DELETED]
+        run = self.store.write_run(iter(entries), 0, len(entries))
+        self.runs = (run,) + self.runs
+        self.store.release(run.name)
+        self.memtable = {}
+        self.store.stats["memtable_flushes"] += 1
+        self.store.request_compaction()
+
+    def replace_runs(self, group, merged, oldest):
+        """Swap a merged run in for the runs it was made from, if this copy still has them"""
+        runs = self.runs
+        for start in range(len(runs) - len(group) + 1):
+            if runs[start:start + len(group)] == group:
+                if oldest and start + len(group) != len(runs):
+                    return  # Tombstones were dropped, only valid where the group is the oldest data
+                self.runs = runs[:start] + (merged,) + runs[start + len(group):]
+                return
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        with self.store.lock:
+            self.memtable = {}
+            self.runs = ()
+            self.count = 0
+
+    def rewrite(self, function):
+        """Replace every record with function(record) by writing one new run"""
+        with self.store.lock:
+            entries = ((key, function(record)) for key, record in self._iter_merged())
+            level = max((run.level for run in self.runs), default=0)
+            run = self.store.write_run(entries, level, max(1, self.count))
+            self.runs = (run,)
+            self.store.release(run.name)
+            self.memtable = {}
+
+    def _iter_merged(self):
+        """Yield the live (key, record) pairs in key order, newest version first wins"""
+        with self.store.lock:
+            memtable = sorted(self.memtable.items(), key=lambda item: str(item[0]))
+            runs = self.runs
+        sources = [iter(memtable)] + [self.store.iter_run(run) for run in runs]
+        for key, value in self.store.merge(sources):
+            if value is not DELETED:
+                yield key, value
+
+    def __iter__(self):
+        for key, _ in self._iter_merged():
+            yield key
+
+    def items(self):
+        return LSMItemsView(self)
+
+    def values(self):
+        return LSMValuesView(self)
+
+    def get_stats(self):
+        stats = self.store.get_stats()
+        levels = {}
+        for run in self.runs:
+            levels[run.level] = levels.get(run.level, 0) + 1
+        stats.update(records=self.count, memtable_entries=len(self.memtable), runs=len(self.runs),
+                     runs_per_level=levels)
+        return stats
+
+class LSMItemsView(ItemsView):
+    def __iter__(self):
+        yield from self._mapping._iter_merged()
+
+class LSMValuesView(ValuesView):
+    def __iter__(self):
+        for _, record in self._mapping._iter_merged():
+            yield record
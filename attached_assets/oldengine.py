@@ -1,8 +1,32 @@
 import json
+import os
 import re
+import sys
 import copy
-from datetime import datetime
+import shutil
+import struct
+from array import array
+from datetime import datetime, timedelta
 import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from itertools import accumulate, chain, count
+from pagestore import BufferPool, PageFile, PagedRecords
+from lsmstore import LSMStore, LSMRecords
+
+# Top-level keys of a snapshot file; any other first key means the old tables-only format
+SNAPSHOT_FIELDS = {'tables', 'indexes', 'lsn', 'layout', 'activeTransactions'}
+
+# Operations that change the database and therefore have to be written to the WAL
+WAL_OPERATIONS = {
+    'create_table', 'insert', 'delete', 'update', 'drop_column',
+    'delete_table', 'drop_table', 'create_index', 'drop_index',
+}
+
+# Operations that only change records; a paged or LSM table's files may already hold them when the snapshot does not
+RECORD_OPERATIONS = {'insert', 'delete', 'update', 'delete_table'}
 
 def convert_value(value, data_type):
      if data_type == "int":
@@ -21,146 +45,1453 @@ def convert_value(value, data_type):
      elif data_type == "string":
         return str(value)  # Convert to string
      return value  # Return the value as is if type is unknown
- 
+
+class WriteAheadLog:
+    """Append-only log of committed transactions, one JSON line per commit"""
+    def __init__(self, file_name, serializer=None):
+        self.file_name = file_name
+        self.serializer = serializer
+        self.lock = threading.Lock()
+        self.file = None
+        self.last_lsn = 0
+
+    def prepare(self, transaction_id, operations):
+        """Assign the next LSN to a committed transaction and encode it as a log line"""
+        ops = []
+        for op in operations:
+            entry = [op['operation'], list(op['args'])]
+            if op['kwargs']:
+                entry.append(op['kwargs'])
+            ops.append(entry)
+
+        with self.lock:
+            self.last_lsn += 1
+            return json.dumps({"lsn": self.last_lsn, "txn": transaction_id, "ops": ops},
+                              default=self.serializer, separators=(",", ":")) + "\n"
+
+    def write_batch(self, lines):
+        """Append prepared lines with a single write and fsync"""
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.file_name, 'a')
+            self.file.write("".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def read(self):
+        """Yield logged transactions in commit order, stopping at a torn trailing record"""
+        valid_bytes = 0  # End of the last complete record
+        try:
+            with open(self.file_name, 'rb') as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        print(f"DEBUG: Ignoring incomplete record at the end of {self.file_name}")
+                        break
+                    try:
+                        record = json.loads(line)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        print(f"DEBUG: Ignoring corrupt record at the end of {self.file_name}")
+                        break
+                    valid_bytes += len(line)
+                    self.last_lsn = max(self.last_lsn, record["lsn"])
+                    yield record
+        except FileNotFoundError:
+            return
+        if valid_bytes < self.size():
+            # Cut the torn record off, the next commit would otherwise be appended to it and lost with it
+            os.truncate(self.file_name, valid_bytes)
+
+    def tell(self):
+        """Byte offset just past the last record written so far"""
+        with self.lock:
+            return self.size()
+
+    def truncate_prefix(self, offset):
+        """Drop the records before offset, keeping anything appended since then"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            try:
+                with open(self.file_name, 'r') as file:
+                    file.seek(offset)
+                    tail = file.read()
+            except FileNotFoundError:
+                tail = ""
+            temp_name = self.file_name + ".tmp"
+            with open(temp_name, 'w') as file:
+                file.write(tail)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_name, self.file_name)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.file_name)
+        except OSError:
+            return 0
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class StreamingJSONReader:
+    """Incremental JSON reader that parses a large object one member at a time from a file"""
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, file, total_bytes=0, chunk_size=64 * 1024):
+        self.file = file
+        self.total_bytes = total_bytes
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, amount=None):
+        """Read more of the file, dropping the consumed part of the buffer first"""
+        if self.eof:
+            return False
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        chunk = self.file.read(amount or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.bytes_read += len(chunk)
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise json.JSONDecodeError("Unexpected end of file", self.buffer, self.pos)
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expected '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def read_value(self):
+        """Decode one complete value, reading ahead until all of it is in the buffer"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Grow geometrically so that a large value is not re-parsed once per chunk
+                if not self._fill(max(self.chunk_size, len(self.buffer) - self.pos)):
+                    raise
+                continue
+            # A number cut off by the end of the buffer ("12" of "123", "-1" of "-1.5") continues in the next chunk
+            if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and not self.buffer[end:].strip("0123456789.eE+-") and self._fill()):
+                continue
+            self.pos = end
+            return value
+
+    def iter_object(self):
+        """Yield the keys of the object at the current position; the caller consumes each value"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expected a string key", self.buffer, self.pos)
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise json.JSONDecodeError("Expected ',' or '}'", self.buffer, self.pos - 1)
+
+class SnapshotDecodeError(ValueError):
+    """A binary snapshot or segment file is truncated or damaged"""
+
+class RecordCodec:
+    """Binary encoding of a table's records, stored column by column in native types so loading needs no parsing"""
+    MAGIC = b"HBDB\x01"  # First bytes of a binary snapshot or segment, JSON files start with '{'
+    INT, FLOAT, BOOL, DATETIME, STRING, JSON = range(6)  # How the values of one column are stored
+    ABSENT, PRESENT, NULL = 0, 1, 2  # Entries of a column's presence map
+    MISSING = object()  # Stands in for a field a record does not have
+    EPOCH = datetime(1970, 1, 1)
+    LENGTH = struct.Struct("<Q")
+    COLUMN = struct.Struct("<BB")  # Storage kind, whether a presence map follows
+
+    def __init__(self, serializer=None):
+        self.serializer = serializer  # For values in JSON-stored columns, e.g. datetimes in a mixed column
+
+    def write_header(self, file, header):
+        text = json.dumps(header, default=self.serializer, separators=(",", ":")).encode("utf-8")
+        file.write(self.MAGIC + self.LENGTH.pack(len(text)) + text)
+
+    def read_header(self, file):
+        if file.read(len(self.MAGIC)) != self.MAGIC:
+            raise SnapshotDecodeError("Not a binary snapshot file")
+        try:
+            return json.loads(self._read_exact(file, self._read_length(file)))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise SnapshotDecodeError(f"Damaged header: {str(e)}")
+
+    def write_block(self, file, records):
+        """Write one table's records as a length-prefixed block"""
+        parts = self.encode_records(records)
+        file.write(self.LENGTH.pack(sum(len(part) for part in parts)))
+        for part in parts:
+            file.write(part)
+
+    def read_block(self, file):
+        """Read one encoded block without decoding it"""
+        return self._read_exact(file, self._read_length(file))
+
+    def _read_length(self, file):
+        return self.LENGTH.unpack(self._read_exact(file, self.LENGTH.size))[0]
+
+    def _read_exact(self, file, size):
+        data = file.read(size)
+        if len(data) != size:
+            raise SnapshotDecodeError("Unexpected end of file")
+        return data
+
+    def encode_records(self, records):
+        """Encode {key: record} as the keys followed by one typed column per field name"""
+        keys = list(records)
+        rows = list(records.values())
+        names = list(dict.fromkeys(chain.from_iterable(rows)))
+        parts = [self.LENGTH.pack(len(rows))]
+        parts.extend(self._encode_column(keys))
+        parts.append(self.LENGTH.pack(len(names)))
+        for name in names:
+            encoded_name = str(name).encode("utf-8", "surrogatepass")
+            parts.append(self.LENGTH.pack(len(encoded_name)) + encoded_name)
+            parts.extend(self._encode_column([row.get(name, self.MISSING) for row in rows]))
+        return parts
+
+    def _column_kind(self, values):
+        types = set(map(type, values))
+        if types == {int} and -2 ** 63 <= min(values) and max(values) < 2 ** 63:
+            return self.INT
+        if types == {float}:
+            return self.FLOAT
+        if types == {bool}:
+            return self.BOOL
+        if types == {datetime} and all(value.tzinfo is None for value in values):
+            return self.DATETIME
+        if types == {str}:
+            return self.STRING
+        return self.JSON  # Mixed, empty or unusual columns
+
+    def _encode_column(self, values):
+        present = [value for value in values if value is not None and value is not self.MISSING]
+        presence = b""
+        if len(present) != len(values):
+            presence = bytes(self.ABSENT if value is self.MISSING else self.NULL if value is None else self.PRESENT
+                             for value in values)
+        kind = self._column_kind(present)
+
+        if kind == self.INT:
+            payload = [self._pack_array('q', present)]
+        elif kind == self.FLOAT:
+            payload = [self._pack_array('d', present)]
+        elif kind == self.BOOL:
+            payload = [bytes(present)]
+        elif kind == self.DATETIME:
+            micros = [(value - self.EPOCH) // timedelta(microseconds=1) for value in present]
+            payload = [self._pack_array('q', micros)]
+        elif kind == self.STRING:
+            text = "".join(present).encode("utf-8", "surrogatepass")
+            payload = [self._pack_array('q', [len(value) for value in present]), self.LENGTH.pack(len(text)), text]
+        else:
+            text = json.dumps(present, default=self.serializer, separators=(",", ":")).encode("utf-8")
+            payload = [self.LENGTH.pack(len(text)), text]
+        return [self.COLUMN.pack(kind, bool(presence)), presence] + payload
+
+    def decode_records(self, data):
+        """Decode a block, returns the records and the names of fields stored as JSON that may still need conversion"""
+        try:
+            view = memoryview(data)
+            count, pos = self._unpack_length(view, 0)
+            keys, pos = self._decode_column(view, pos, count)
+            column_count, pos = self._unpack_length(view, pos)
+            names, columns, json_fields = [], [], []
+            for _ in range(column_count):
+                name_length, pos = self._unpack_length(view, pos)
+                name = self._slice(view, pos, name_length).decode("utf-8", "surrogatepass")
+                pos += name_length
+                if view[pos] == self.JSON:
+                    json_fields.append(name)
+                values, pos = self._decode_column(view, pos, count)
+                names.append(name)
+                columns.append(values)
+            if pos != len(view):
+                raise SnapshotDecodeError("Trailing data after the last column")
+        except (struct.error, IndexError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise SnapshotDecodeError(f"Damaged record block: {str(e)}")
+
+        if not columns:
+            rows = ({} for _ in keys)
+        elif any(self.MISSING in values for values in columns):
+            rows = ({name: value for name, value in zip(names, row) if value is not self.MISSING}
+                    for row in zip(*columns))
+        else:
+            rows = (dict(zip(names, row)) for row in zip(*columns))
+        return dict(zip(keys, rows)), json_fields
+
+    def _decode_column(self, view, pos, count):
+        kind, has_presence = self.COLUMN.unpack_from(view, pos)
+        pos += self.COLUMN.size
+        presence = None
+        present_count = count
+        if has_presence:
+            presence = self._slice(view, pos, count)
+            present_count = presence.count(self.PRESENT)
+            pos += count
+
+        if kind == self.INT or kind == self.FLOAT:
+            values = self._unpack_array('q' if kind == self.INT else 'd', view, pos, present_count).tolist()
+            pos += 8 * present_count
+        elif kind == self.BOOL:
+            values = [byte == 1 for byte in self._slice(view, pos, present_count)]
+            pos += present_count
+        elif kind == self.DATETIME:
+            epoch, microsecond = self.EPOCH, timedelta(microseconds=1)
+            values = [epoch + micros * microsecond for micros in self._unpack_array('q', view, pos, present_count)]
+            pos += 8 * present_count
+        elif kind == self.STRING:
+            lengths = self._unpack_array('q', view, pos, present_count)
+            pos += 8 * present_count
+            text_length, pos = self._unpack_length(view, pos)
+            text = self._slice(view, pos, text_length).decode("utf-8", "surrogatepass")
+            pos += text_length
+            ends = list(accumulate(lengths))
+            values = [text[start:end] for start, end in zip([0] + ends, ends)]
+        elif kind == self.JSON:
+            text_length, pos = self._unpack_length(view, pos)
+            values = json.loads(self._slice(view, pos, text_length))
+            pos += text_length
+            if len(values) != present_count:
+                raise SnapshotDecodeError("Column length does not match the record count")
+        else:
+            raise SnapshotDecodeError(f"Unknown column storage kind {kind}")
+
+        if presence is not None:
+            present = iter(values)
+            values = [next(present) if flag == self.PRESENT else None if flag == self.NULL else self.MISSING
+                      for flag in presence]
+        return values, pos
+
+    def _unpack_length(self, view, pos):
+        return self.LENGTH.unpack_from(view, pos)[0], pos + self.LENGTH.size
+
+    def _slice(self, view, pos, size):
+        if pos + size > len(view):
+            raise SnapshotDecodeError("Unexpected end of record block")
+        return bytes(view[pos:pos + size])
+
+    def _pack_array(self, typecode, values):
+        packed = array(typecode, values)
+        if sys.byteorder == "big":
+            packed.byteswap()  # Files are always little-endian
+        return packed.tobytes()
+
+    def _unpack_array(self, typecode, view, pos, count):
+        unpacked = array(typecode)
+        unpacked.frombytes(self._slice(view, pos, 8 * count))
+        if sys.byteorder == "big":
+            unpacked.byteswap()
+        return unpacked
+
+class LazyTable(dict):
+    """Table whose records are only read from disk the first time they are used"""
+    def __init__(self, schema, loader, index_columns=()):
+        super().__init__(schema)
+        self.loader = loader  # Returns the table's records dict
+        self.index_columns = list(index_columns)  # Indexes that come with the records
+        self.load_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return dict.__contains__(self, "records")
+
+    def materialize(self):
+        if not self.loaded:
+            with self.load_lock:
+                if not self.loaded:
+                    dict.__setitem__(self, "records", self.loader())
+        return dict.__getitem__(self, "records")
+
+    def __missing__(self, key):
+        if key == "records":
+            return self.materialize()
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key == "records":
+            return self.materialize()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        return key == "records" or dict.__contains__(self, key)
+
+    def __deepcopy__(self, memo):
+        if self.loaded:
+            return copy.deepcopy(dict(self), memo)
+        return LazyTable(copy.deepcopy(dict(self), memo), self.loader, self.index_columns)
+
+class OrderedIndex(dict):
+    """Index of one column, {value: [keys]}, that also keeps its distinct values sorted for range lookups
+
+    The sorted values are split into blocks with a list of each block's first value, like the runs of an
+    LSM table, so seeking to a bound and adding or removing a value are a bisect on each level plus an
+    edit of one short block.
+    """
+    BLOCK_SIZE = 256  # Values per block before it is split in two
+
+    def __init__(self, index=None):
+        super().__init__(index or {})
+        # Values that do not compare with the others, e.g. a string stored in an int column by an older
+        # version, are only hashed: equality lookups find them, range lookups cannot match them anyway
+        self.unordered = set()
+        try:
+            values = sorted(self)
+        except TypeError:
+            by_type = {}
+            for value in self:
+                by_type.setdefault(type(value), []).append(value)
+            values = max(by_type.values(), key=len)
+            try:
+                values.sort()
+            except TypeError:
+                values = []
+            self.unordered = set(self) - set(values)
+        self.blocks = [values[start:start + self.BLOCK_SIZE] for start in range(0, len(values), self.BLOCK_SIZE)]
+        self.firsts = [block[0] for block in self.blocks]
+
+    def add(self, value, key):
+        keys = self.get(value)
+        if keys is not None:
+            keys.append(key)
+            return
+        self[value] = [key]
+        if not self.blocks:
+            self.blocks.append([value])
+            self.firsts.append(value)
+            return
+        try:
+            position = max(bisect_right(self.firsts, value) - 1, 0)
+            block = self.blocks[position]
+            insort(block, value)  # Compares before it inserts, so a TypeError leaves the block as it was
+        except TypeError:
+            self.unordered.add(value)
+            return
+        self.firsts[position] = block[0]
+        if len(block) > 2 * self.BLOCK_SIZE:
+            half = len(block) // 2
+            self.blocks[position:position + 1] = [block[:half], block[half:]]
+            self.firsts[position:position + 1] = [block[0], block[half]]
+
+    def discard(self, value, key):
+        keys = self.get(value)
+        if keys is None or key not in keys:
+            return
+        keys.remove(key)
+        if keys:
+            return
+        del self[value]
+        if value in self.unordered:
+            self.unordered.discard(value)
+            return
+        position = bisect_right(self.firsts, value) - 1
+        block = self.blocks[position]
+        del block[bisect_left(block, value)]
+        if block:
+            self.firsts[position] = block[0]
+        else:
+            del self.blocks[position], self.firsts[position]
+
+    def values_between(self, low=None, high=None, include_low=True, include_high=True):
+        """Distinct values within the bounds in ascending order, None leaves a side open"""
+        blocks = list(self.blocks)  # Writers insert into and split blocks while readers walk them
+        position, start = 0, 0
+        if low is not None and blocks:
+            position = max(bisect_right(self.firsts[:len(blocks)], low) - 1, 0)
+            start = (bisect_left if include_low else bisect_right)(blocks[position], low)
+        for block in blocks[position:]:
+            for value in block[start:]:
+                if high is not None and (value > high or (value == high and not include_high)):
+                    return
+                yield value
+            start = 0
+
+    def keys_between(self, low=None, high=None, include_low=True, include_high=True):
+        """Keys of the rows whose value is within the bounds, streamed in value order"""
+        for value in self.values_between(low, high, include_low, include_high):
+            yield from list(self.get(value, ()))
+
+class GroupCommitter:
+    """Batches concurrent commits so that they share one durable write and one fsync"""
+    def __init__(self, flush, window=0.0, max_batch=64, history=1000):
+        self.flush = flush  # Called with the list of queued records, returns True once durable
+        self.window = window  # Seconds the flushing thread waits for more commits to join
+        self.max_batch = max(1, max_batch)
+        self.condition = threading.Condition()
+        self.pending = []
+        self.enqueued_seq = 0
+        self.durable_seq = 0
+        self.flushing = False
+        self.failed = set()
+        self.flush_sizes = deque(maxlen=history)  # Commits covered by each recent flush
+        self.total_flushes = 0
+        self.total_commits = 0
+
+    def enqueue(self, record):
+        with self.condition:
+            self.pending.append(record)
+            self.enqueued_seq += 1
+            if len(self.pending) >= self.max_batch:
+                self.condition.notify_all()
+            return self.enqueued_seq
+
+    def wait_durable(self, ticket):
+        """Wait until ticket is durable, flushing a batch ourselves if nobody else is"""
+        with self.condition:
+            while self.durable_seq < ticket:
+                if self.flushing:
+                    self.condition.wait()
+                    continue
+
+                # Become the leader for the next batch
+                self.flushing = True
+                deadline = time.monotonic() + self.window
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                first_seq = self.durable_seq + 1
+
+                self.condition.release()
+                try:
+                    ok = self.flush(batch)
+                except Exception as e:
+                    print(f"Error during group flush: {str(e)}")
+                    ok = False
+                finally:
+                    self.condition.acquire()
+
+                self.durable_seq += len(batch)
+                if not ok:
+                    self.failed.update(range(first_seq, self.durable_seq + 1))
+                self.flush_sizes.append(len(batch))
+                self.total_flushes += 1
+                self.total_commits += len(batch)
+                self.flushing = False
+                self.condition.notify_all()
+
+            if ticket in self.failed:
+                self.failed.discard(ticket)
+                return False
+            return True
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'flushes': self.total_flushes,
+                'commits': self.total_commits,
+                'average_batch': (self.total_commits / self.total_flushes) if self.total_flushes else 0,
+                'recent_batch_sizes': list(self.flush_sizes),
+                'window': self.window,
+                'max_batch': self.max_batch,
+            }
+
+class Checkpointer(threading.Thread):
+    """Background thread that snapshots the database once the WAL is big or old enough"""
+    def __init__(self, db, interval=60.0, max_wal_bytes=16 * 1024 * 1024, poll_interval=0.5):
+        super().__init__(name="checkpointer", daemon=True)
+        self.db = db
+        self.interval = interval
+        self.max_wal_bytes = max_wal_bytes
+        self.poll_interval = min(poll_interval, interval)
+        self.stop_event = threading.Event()
+        self.last_checkpoint = time.monotonic()
+        self.checkpoints = 0
+
+    def run(self):
+        while not self.stop_event.wait(self.poll_interval):
+            wal_size = self.db.wal.size()
+            if wal_size == 0:
+                self.last_checkpoint = time.monotonic()
+                continue
+            if wal_size >= self.max_wal_bytes or time.monotonic() - self.last_checkpoint >= self.interval:
+                # A deferred checkpoint is simply retried on the next poll
+                if self.db.checkpoint():
+                    self.last_checkpoint = time.monotonic()
+                    self.checkpoints += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+class RowVersion:
+    """Earlier value of a row or table, seen by snapshots taken before the change that replaced it committed"""
+    __slots__ = ("value", "writer", "commit_ts", "aborted_at")
+
+    def __init__(self, value, writer):
+        self.value = value  # None if the row or table did not exist
+        self.writer = writer  # Transaction that made the change, None once it rolled back
+        self.commit_ts = None
+        self.aborted_at = None
+
+    def visible_to(self, transaction_id, snapshot):
+        if self.commit_ts is not None:
+            return self.commit_ts > snapshot
+        return self.writer != transaction_id  # Uncommitted or rolled back, everybody else reads this value
+
+    @property
+    def aborted(self):
+        return self.aborted_at is not None and self.commit_ts is None
+
+class LockRequest:
+    """A transaction waiting for a lock, woken through its own condition when granted or given up"""
+    __slots__ = ("transaction_id", "lock_key", "mode", "condition", "granted")
+
+    def __init__(self, transaction_id, lock_key, mode, condition):
+        self.transaction_id = transaction_id
+        self.lock_key = lock_key
+        self.mode = mode  # Mode the transaction will hold once granted, including what it held before
+        self.condition = condition  # Shares the latch of the LockStripe holding lock_key
+        self.granted = None  # True or False once decided
+
+class LockStripe:
+    """One partition of the lock table, lock keys are spread over the stripes by hash"""
+    __slots__ = ("latch", "locks", "lock_queue", "escalations")
+
+    def __init__(self):
+        self.latch = threading.Lock()
+        self.locks = {}  # {(table_name, key): {transaction_id: mode held}}, TABLE_KEY for the table itself
+        self.lock_queue = {}  # {(table_name, key): deque of LockRequests, granted in order}
+        self.escalations = 0  # Counted per stripe, under its latch
+
+class OptimisticState:
+    """Private read and write sets of an optimistic transaction, validated and applied when it commits"""
+    __slots__ = ("reads", "writes", "operations", "undo", "applying")
+    UNSTAGED = object()  # Undo marker for a key that had no staged write before
+
+    def __init__(self):
+        self.reads = set()  # {(table_name, key)}, TABLE_KEY for a scan of the whole table
+        self.writes = {}  # {table_name: {key: staged record, None if deleted}}
+        self.operations = []  # (operation, args) to run at commit, in order
+        self.undo = []  # (table_name, key, staged record it replaced or UNSTAGED), for rolling back to savepoints
+        self.applying = False  # Set while commit runs the operations for real
+
+# Multigranularity locking: rows are locked S or X, tables in any mode. Row locks need the matching
+# intention (IS or IX) on their table, so table-level and row-level work conflict at the table lock
+LOCK_MODES = ("IS", "IX", "S", "SIX", "X")  # Weakest first
+LOCK_COMPATIBLE = {
+    "IS": {"IS", "IX", "S", "SIX"},
+    "IX": {"IS", "IX"},
+    "S": {"IS", "S"},
+    "SIX": {"IS"},
+    "X": set(),
+}
+LOCK_COVERS = {
+    "IS": {"IS"},
+    "IX": {"IS", "IX"},
+    "S": {"IS", "S"},
+    "SIX": {"IS", "IX", "S", "SIX"},
+    "X": set(LOCK_MODES),
+}
+LOCK_ALIASES = {'read': "S", 'write': "X"}
+
+def combine_lock_modes(held, requested):
+    """Weakest mode that gives everything both modes give"""
+    if held is None:
+        return requested
+    return next(mode for mode in LOCK_MODES if held in LOCK_COVERS[mode] and requested in LOCK_COVERS[mode])
+
 class TransactionManager:
-    def __init__(self, db):
+    ISOLATION_LEVELS = {"snapshot", "serializable"}
+    CONCURRENCY_MODES = {"locking", "optimistic"}
+    VACUUM_EVERY = 1000  # Commits between two full passes over the row versions
+    TABLE_KEY = "*"  # Key of the lock that covers every row of a table
+
+    def __init__(self, db, lock_timeout=5.0, escalate_after=1000, history=1000, stripes=16):
         self.db = db
         self.active_transactions = {}
+        # Finished transactions leave active_transactions, the most recent ones are summarized here
+        self.history = OrderedDict()  # {transaction_id: {'status', 'operations', 'autocommit', 'deadlock_victim'}}
+        self.history_size = history
+        # Guards commit timestamps, snapshots, versions, undo logs and the history. Locks and the
+        # transaction registry have their own striped latches, always taken after this one if both are needed
         self.transaction_lock = threading.RLock()
-        self.checkpoints = {}
-        self.locks = {}  # {(table_name, key): {'read': set(), 'write': None}}
-        self.lock_queue = {}  # {(table_name, key): [waiting_transactions]}
-        
-    def acquire_lock(self, transaction_id, table_name, key, lock_type='read'):
-        with self.transaction_lock:
-            lock_key = (table_name, key)
-
-            if lock_key not in self.locks:
-                self.locks[lock_key] = {'read': set(), 'write': None}
-                self.lock_queue[lock_key] = []
-
-            current_locks = self.locks[lock_key]
-
-            if lock_type == 'read' and transaction_id in current_locks['read']:
-                return True
-            if lock_type == 'write' and transaction_id == current_locks['write']:
+        self.undo_logs = {}  # {transaction_id: [before-images of the rows and tables it changed, oldest first]}
+        # Multi-version reads: readers see the rows as of the last commit before they began, without locks
+        self.commit_ts = 0  # Timestamp of the latest commit
+        self.snapshots = {}  # {transaction_id: commit_ts it reads as of} for active transactions
+        self.row_versions = {}  # {table_name: {key: [RowVersion, oldest first]}}
+        self.table_history = {}  # {table_name: [RowVersion holding the table object, oldest first]}
+        self.commits_since_vacuum = 0
+        # Requests for unrelated tables and keys only share a latch if they hash to the same stripe
+        self.lock_stripes = [LockStripe() for _ in range(max(1, stripes))]
+        # Entries of active_transactions are latched by transaction id: status, held locks, operations
+        self.registry_latches = [threading.Lock() for _ in range(max(1, stripes))]
+        self.deadlock_latch = threading.Lock()  # One detector at a time, it latches every stripe
+        self.waiting = {}  # {transaction_id: LockRequest it is blocked on}
+        self.lock_timeout = lock_timeout  # Seconds acquire_lock waits before giving up, 0 fails at once
+        self.deadlocks = 0  # Wait-for cycles broken by rolling back a victim
+        self.escalate_after = escalate_after  # Row locks on one table before they are traded for a table lock
+        self.read_ids = count(1)
+        self.conflicts = 0  # Optimistic transactions rolled back because their validation failed
+
+    def _stripe(self, lock_key):
+        return self.lock_stripes[hash(lock_key) % len(self.lock_stripes)]
+
+    def _registry_latch(self, transaction_id):
+        return self.registry_latches[hash(transaction_id) % len(self.registry_latches)]
+
+    def acquire_lock(self, transaction_id, table_name, key, lock_type='read', timeout=None):
+        """Lock a row ('read'/'write') or, with TABLE_KEY, a table in any of LOCK_MODES
+
+        Waits in FIFO order and returns False if the lock was not granted within the timeout.
+        A row lock first takes the matching intention lock on its table.
+        """
+        transaction = self.active_transactions.get(transaction_id)
+        if transaction is None:
+            return False
+        mode = LOCK_ALIASES.get(lock_type, lock_type)
+        if timeout is None:
+            # Optimistic transactions lock only while they commit, a conflict there aborts rather than waits
+            timeout = 0 if transaction['optimistic'] else self.lock_timeout
+        deadline = time.monotonic() + timeout
+        if key == self.TABLE_KEY:
+            granted = self._acquire(transaction, transaction_id, (table_name, key), mode, deadline)
+        else:
+            # Only grants to this transaction change its locks, so its own thread reads them without a latch
+            table_key = (table_name, self.TABLE_KEY)
+            table_mode = transaction['locks'].get(table_key)
+            if table_mode is not None and mode in LOCK_COVERS[table_mode]:
+                return True  # S, SIX or X on the table already covers reading its rows, X covers writing them
+            granted = self._acquire(transaction, transaction_id, table_key, "IS" if mode == "S" else "IX", deadline) \
+                and self._acquire(transaction, transaction_id, (table_name, key), mode, deadline)
+            if granted:
+                self._escalate(transaction_id, table_name)
+        if not granted and transaction.get('deadlock_victim'):
+            # The detector only picks the victim, it rolls back on its own thread holding no latch
+            self.rollback_transaction(transaction_id)
+        return granted
+
+    def _acquire(self, transaction, transaction_id, lock_key, mode, deadline):
+        held = transaction['locks'].get(lock_key)
+        if held is not None and mode in LOCK_COVERS[held]:
+            return True
+        stripe = self._stripe(lock_key)
+        with stripe.latch:
+            if lock_key not in stripe.locks:
+                stripe.locks[lock_key] = {}
+                stripe.lock_queue[lock_key] = deque()
+
+            holders = stripe.locks[lock_key]
+            queue = stripe.lock_queue[lock_key]
+            held = holders.get(transaction_id)
+            if held is not None and mode in LOCK_COVERS[held]:
                 return True
+            mode = combine_lock_modes(held, mode)
 
-            if lock_type == 'read':
-                if current_locks['write'] is None:
-                        current_locks['read'].add(transaction_id)
-                        self.active_transactions[transaction_id]['locks'].add(lock_key)
-                        return True
-            elif lock_type == 'write':
-                if not current_locks['read'] and current_locks['write'] is None:
-                        current_locks['write'] = transaction_id
-                        self.active_transactions[transaction_id]['locks'].add(lock_key)
-                        return True
-
-            self.lock_queue[lock_key].append((transaction_id, lock_type))
+            if not queue and self._grantable(holders, transaction_id, mode):
+                if self._grant(lock_key, holders, transaction_id, mode):
+                    return True
+                self._reclaim(stripe, lock_key)
+                return False
+            if deadline <= time.monotonic():
+                self._reclaim(stripe, lock_key)
+                return False
+
+            request = LockRequest(transaction_id, lock_key, mode, threading.Condition(stripe.latch))
+            if held is not None:
+                queue.appendleft(request)  # Upgrades go first, newer requests would wait on the held lock anyway
+            else:
+                queue.append(request)
+            self.waiting[transaction_id] = request
+
+        # Only a new wait adds edges to the wait-for graph, so any new cycle runs through this request.
+        # The detector latches every stripe in order, so it runs with this one released
+        self._break_deadlock(transaction_id)
+
+        with stripe.latch:
+            while request.granted is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not request.condition.wait(remaining):
+                    if request.granted is None:
+                        self._cancel_request(stripe, request)
+                    break
+            self.waiting.pop(transaction_id, None)
+            return request.granted
+
+    def _grantable(self, holders, transaction_id, mode):
+        return all(mode in LOCK_COMPATIBLE[held] for holder, held in holders.items()
+                   if holder != transaction_id)
+
+    def _grant(self, lock_key, holders, transaction_id, mode):
+        """Record a granted lock, call with its stripe latched; False if the transaction is ending meanwhile"""
+        transaction = self.active_transactions.get(transaction_id)
+        if transaction is None:
             return False
+        with transaction['latch']:
+            if transaction['status'] != 'active':
+                return False
+            if lock_key[1] != self.TABLE_KEY and transaction_id not in holders:
+                row_locks = transaction['row_locks']
+                row_locks[lock_key[0]] = row_locks.get(lock_key[0], 0) + 1
+            holders[transaction_id] = mode
+            transaction['locks'][lock_key] = mode
+            return True
+
+    def _escalate(self, transaction_id, table_name):
+        """Trade a transaction's row locks on a table for one table lock once it holds too many, without waiting"""
+        transaction = self.active_transactions[transaction_id]
+        if transaction['row_locks'].get(table_name, 0) <= self.escalate_after:
+            return
+        table_key = (table_name, self.TABLE_KEY)
+        stripe = self._stripe(table_key)
+        with stripe.latch:
+            holders = stripe.locks[table_key]
+            held = holders[transaction_id]
+            mode = combine_lock_modes(held, "X" if held in ("IX", "SIX") else "S")
+            if stripe.lock_queue[table_key] or not self._grantable(holders, transaction_id, mode):
+                return  # Keep the row locks, others are using the table
+            if not self._grant(table_key, holders, transaction_id, mode):
+                return
+            stripe.escalations += 1
+
+        with transaction['latch']:
+            row_keys = [lock_key for lock_key in transaction['locks']
+                        if lock_key[0] == table_name and lock_key[1] != self.TABLE_KEY]
+            for lock_key in row_keys:
+                del transaction['locks'][lock_key]
+            del transaction['row_locks'][table_name]
+        self._release_keys(transaction_id, row_keys)
+
+    def _release_keys(self, transaction_id, lock_keys):
+        """Drop the transaction's hold on each key and grant what waits behind it, one stripe latch at a time"""
+        for lock_key in lock_keys:
+            stripe = self._stripe(lock_key)
+            with stripe.latch:
+                stripe.locks[lock_key].pop(transaction_id, None)
+                self._process_lock_queue(stripe, lock_key)
+                self._reclaim(stripe, lock_key)
 
-    
     def release_locks(self, transaction_id):
+        transaction = self.active_transactions[transaction_id]
+        with transaction['latch']:
+            # From here on no lock is granted to the transaction, so the set below is complete
+            transaction['status'] = 'ending'
+            locks = list(transaction['locks'])
+            transaction['locks'].clear()
+            transaction['row_locks'].clear()
+        self._cancel_wait(transaction_id)
+        self._release_keys(transaction_id, locks)
+
+    def _cancel_wait(self, transaction_id):
+        """Wake a request the transaction is still waiting on, it ended from another thread"""
+        request = self.waiting.get(transaction_id)
+        if request is not None:
+            stripe = self._stripe(request.lock_key)
+            with stripe.latch:
+                if request.granted is None:
+                    self._cancel_request(stripe, request)
+
+    def _cancel_request(self, stripe, request):
+        """Give up a queued request and let the ones behind it through, call with its stripe latched"""
+        request.granted = False
+        stripe.lock_queue[request.lock_key].remove(request)
+        self._process_lock_queue(stripe, request.lock_key)
+        self._reclaim(stripe, request.lock_key)
+        request.condition.notify()
+
+    def _reclaim(self, stripe, lock_key):
+        """Drop a lock entry nobody holds or waits for, lock keys would otherwise pile up forever"""
+        if not stripe.locks.get(lock_key, True) and not stripe.lock_queue[lock_key]:
+            del stripe.locks[lock_key], stripe.lock_queue[lock_key]
+
+    def _waits_for(self, transaction_id):
+        """Transactions the given one is blocked by: conflicting holders and conflicting requests queued ahead"""
+        request = self.waiting.get(transaction_id)
+        if request is None or request.granted is not None:
+            return set()
+        stripe = self._stripe(request.lock_key)
+        blockers = {holder for holder, held in stripe.locks[request.lock_key].items()
+                    if request.mode not in LOCK_COMPATIBLE[held]}
+        for ahead in stripe.lock_queue[request.lock_key]:
+            if ahead is request:
+                break
+            if request.mode not in LOCK_COMPATIBLE[ahead.mode]:
+                blockers.add(ahead.transaction_id)
+        blockers.discard(transaction_id)
+        return blockers
+
+    def _find_cycle(self, start):
+        """Transactions on a wait-for cycle through start, empty if start is not deadlocked"""
+        parents = {start: None}
+        stack = [start]
+        while stack:
+            transaction_id = stack.pop()
+            for blocker in self._waits_for(transaction_id):
+                if blocker == start:
+                    cycle = [transaction_id]
+                    while parents[cycle[-1]] is not None:
+                        cycle.append(parents[cycle[-1]])
+                    return cycle
+                if blocker not in parents:
+                    parents[blocker] = transaction_id
+                    stack.append(blocker)
+        return []
+
+    def _break_deadlock(self, transaction_id):
+        """Pick the cheapest transaction on a cycle through the given waiter and fail its wait, the others go on waiting"""
+        with self.deadlock_latch:
+            for stripe in self.lock_stripes:
+                stripe.latch.acquire()
+            try:
+                cycle = self._find_cycle(transaction_id)
+                if not cycle:
+                    return
+                # Fewest operations and before-images is the least work to lose and to undo, the requester wins ties
+                victim = min(cycle, key=lambda member: (len(self.active_transactions[member]['operations']),
+                                                        len(self.undo_logs.get(member, ())),
+                                                        member == transaction_id))
+                self.deadlocks += 1
+                self.active_transactions[victim]['deadlock_victim'] = True
+                request = self.waiting[victim]
+                self._cancel_request(self._stripe(request.lock_key), request)
+            finally:
+                for stripe in reversed(self.lock_stripes):
+                    stripe.latch.release()
+
+    def is_deadlock_victim(self, transaction_id):
+        """True if the transaction was rolled back to break a deadlock and can be retried right away"""
         with self.transaction_lock:
-            print(f"[DEBUG] Releasing locks for {transaction_id}...")
-            print("[DEBUG] Locks held:", self.active_transactions[transaction_id]['locks'])
-            for lock_key in list(self.active_transactions[transaction_id]['locks']):
-                current_locks = self.locks[lock_key]
-
-                if transaction_id in current_locks['read']:
-                    current_locks['read'].remove(transaction_id)
-                if transaction_id == current_locks['write']:
-                    current_locks['write'] = None
-
-                self._process_lock_queue(lock_key)
-
-            self.active_transactions[transaction_id]['locks'].clear()
-
+            return self.history.get(transaction_id, {}).get('deadlock_victim', False)
+
+    def _lock_table_sizes(self):
+        """(entries, held entries, table locks beyond intentions, queued requests), one stripe latch at a time"""
+        entries = held = table_locks = queued = 0
+        for stripe in self.lock_stripes:
+            with stripe.latch:
+                entries += len(stripe.locks)
+                held += sum(1 for holders in stripe.locks.values() if holders)
+                table_locks += sum(1 for (_, key), holders in stripe.locks.items()
+                                   if key == self.TABLE_KEY and set(holders.values()) - {"IS", "IX"})
+                queued += sum(len(queue) for queue in stripe.lock_queue.values())
+        return entries, held, table_locks, queued
+
+    def get_lock_stats(self):
+        _, held, table_locks, _ = self._lock_table_sizes()
+        return {
+            'locked_keys': held,
+            'waiting': len(self.waiting),
+            'table_locks': table_locks,
+            'deadlocks': self.deadlocks,
+            'escalations': sum(stripe.escalations for stripe in self.lock_stripes),
+            'optimistic_conflicts': self.conflicts,
+            'stripes': len(self.lock_stripes),
+        }
 
-    
-    def _process_lock_queue(self, lock_key):
-        current_locks = self.locks[lock_key]
-        queue = self.lock_queue[lock_key]
-
-        i = 0
-        while i < len(queue):
-                waiting_transaction, lock_type = queue[i]
-
-                if lock_type == 'read' and current_locks['write'] is None:
-                        current_locks['read'].add(waiting_transaction)
-                        self.active_transactions[waiting_transaction]['locks'].add(lock_key)
-                        queue.pop(i)
-                elif lock_type == 'write' and not current_locks['read'] and current_locks['write'] is None:
-                        current_locks['write'] = waiting_transaction
-                        self.active_transactions[waiting_transaction]['locks'].add(lock_key)
-                        queue.pop(i)
-                else:
-                        i += 1  
+    def get_memory_stats(self):
+        """Sizes of everything the transaction manager keeps, to spot what grows in a long-running process"""
+        entries, _, _, queued = self._lock_table_sizes()
+        with self.transaction_lock:
+            return {
+                'active_transactions': len(self.active_transactions),
+                'logged_operations': sum(len(t['operations']) for t in list(self.active_transactions.values())),
+                'undo_entries': sum(len(undo_log) for undo_log in self.undo_logs.values()),
+                'history': len(self.history),
+                'history_size': self.history_size,
+                'lock_entries': entries,
+                'queued_requests': queued,
+                'snapshots': len(self.snapshots),
+                'row_versions': sum(len(chain) for chains in self.row_versions.values() for chain in chains.values()),
+            }
 
-    def begin_transaction(self, transaction_id):
+    def _process_lock_queue(self, stripe, lock_key):
+        """Grant waiting requests from the head of the queue until one has to keep waiting, call with stripe latched"""
+        queue = stripe.lock_queue.get(lock_key)
+
+        while queue:
+            request = queue[0]
+            if not self._grantable(stripe.locks[lock_key], request.transaction_id, request.mode):
+                break
+            queue.popleft()
+            request.granted = self._grant(lock_key, stripe.locks[lock_key], request.transaction_id, request.mode)
+            request.condition.notify()
+
+    def begin_transaction(self, transaction_id, isolation="snapshot", autocommit=False, concurrency="locking"):
+        """Autocommit transactions wrap a single call and are forgotten once they commit
+
+        Optimistic transactions stage their row writes privately and take no locks until they commit,
+        where they are validated against what others committed since they began. Known limit: validation
+        and the staged writes run under transaction_lock, so optimistic commits still go one at a time.
+        """
         with self.transaction_lock:
                 if transaction_id in self.active_transactions:
                         return f"Transaction {transaction_id} already exists!"
-
-                self.checkpoints[transaction_id] = copy.deepcopy(self.db.tables)
-                self.active_transactions[transaction_id] = {
+                if isolation not in self.ISOLATION_LEVELS:
+                        return f"Unsupported isolation level: '{isolation}'. Expected 'snapshot' or 'serializable'."
+                if concurrency not in self.CONCURRENCY_MODES:
+                        return f"Unsupported concurrency mode: '{concurrency}'. Expected 'locking' or 'optimistic'."
+                if concurrency == "optimistic" and isolation != "snapshot":
+                        return "Optimistic transactions read from their snapshot, use isolation 'snapshot'."
+
+                self.undo_logs[transaction_id] = []
+                self.snapshots[transaction_id] = self.commit_ts
+                transaction = {
                         'status': 'active',
                         'operations': [],
-                        'locks': set()  # ✅ this was missing or not initialized properly
+                        # {lock_key: mode held}, also kept by the stripes, read here without a latch
+                        'locks': {},  # ✅ this was missing or not initialized properly
+                        'row_locks': {},  # {table_name: rows locked}, decides when to escalate to a table lock
+                        'isolation': isolation,
+                        'versions': [],  # RowVersions this transaction created, stamped when it commits
+                        'autocommit': autocommit,
+                        'optimistic': OptimisticState() if concurrency == "optimistic" else None,
+                        'savepoints': [],  # (name, lengths of the undo log, operations, versions and staged writes)
+                        'latch': self._registry_latch(transaction_id),
                 }
+                with self._registry_latch(transaction_id):
+                        self.active_transactions[transaction_id] = transaction
                 return f"Transaction {transaction_id} started successfully."
 
+    def begin_read(self):
+        """Start a read-only autocommit transaction: a snapshot with no locks, undo log or commit"""
+        with self.transaction_lock:
+            transaction_id = f"autocommit_read_{next(self.read_ids)}"
+            self.snapshots[transaction_id] = self.commit_ts
+            self.active_transactions[transaction_id] = {
+                'status': 'active',
+                'operations': [],
+                'locks': {},
+                'row_locks': {},
+                'isolation': "snapshot",
+                'versions': [],
+                'autocommit': True,
+                'optimistic': None,
+                'latch': self._registry_latch(transaction_id),
+            }
+            return transaction_id
+
+    def end_read(self, transaction_id):
+        """Forget a read-only transaction, nothing it did has to be persisted or released"""
+        with self.transaction_lock:
+            self.snapshots.pop(transaction_id, None)
+            del self.active_transactions[transaction_id]
+
     
     def commit_transaction(self, transaction_id):
         print("in commit func")
         with self.transaction_lock:
             if transaction_id not in self.active_transactions:
-                return f"Transaction {transaction_id} does not exist!"
+                return self._missing_transaction(transaction_id)
             
             if self.active_transactions[transaction_id]['status'] != 'active':
                 return f"Transaction {transaction_id} is not active!"
+
+            occ = self.active_transactions[transaction_id]['optimistic']
+            if occ is not None and not occ.applying:
+                error = self._apply_optimistic(transaction_id, occ)
+                if error:
+                    return error
             
+            # Queue the commit record before releasing locks so that anything that
+            # depends on this transaction is flushed in the same or a later batch
+            ticket = self.db.persist_commit(transaction_id, self.active_transactions[transaction_id]['operations'])
+
+            # Make the changes visible to snapshots taken from now on, before other writers can lock the rows
+            versions = self.active_transactions[transaction_id]['versions']
+            if versions:
+                self.commit_ts += 1
+                for version in versions:
+                    version.commit_ts = self.commit_ts
+            self._end_snapshot(transaction_id)
+
             # Release all locks
             self.release_locks(transaction_id)
             print("in commit func 2")
             
-            self.active_transactions[transaction_id]['status'] = 'committed'
-            if transaction_id in self.checkpoints:
-                del self.checkpoints[transaction_id]
+            self.undo_logs.pop(transaction_id, None)
+            self._finish(transaction_id, 'committed')
         
-            print("in commit func3")
-            self.db.save_to_file()
-            print("in commit func4")
-            return f"Transaction {transaction_id} committed successfully."
+        print("in commit func3")
+        # Wait for the group flush outside transaction_lock so other committers can join the batch
+        if not self.db.wait_durable(ticket):
+            return f"Transaction {transaction_id} committed but could not be written to disk!"
         print("in commit func4")
+        return f"Transaction {transaction_id} committed successfully."
     
     def rollback_transaction(self, transaction_id):
         with self.transaction_lock:
             if transaction_id not in self.active_transactions:
-                return f"Transaction {transaction_id} does not exist!"
+                return self._missing_transaction(transaction_id)
             
+            # Undo before releasing the locks, so nobody sees the changes being taken back
+            self._apply_undo(self.undo_logs.pop(transaction_id, []))
+            if transaction_id in self.snapshots:
+                for version in self.active_transactions[transaction_id]['versions']:
+                    version.writer = None
+                    version.aborted_at = self.commit_ts
+                self._end_snapshot(transaction_id)
+
             # Release all locks
             self.release_locks(transaction_id)
             
-            if transaction_id in self.checkpoints:
-                self.db.tables = copy.deepcopy(self.checkpoints[transaction_id])
-                del self.checkpoints[transaction_id]
-            
-            self.active_transactions[transaction_id]['status'] = 'rolled back'
+            self._finish(transaction_id, 'rolled back')
             return f"Transaction {transaction_id} rolled back successfully."
+
+    def savepoint(self, transaction_id, name):
+        """Mark the current end of the transaction's logs, a later rollback_to_savepoint undoes what follows"""
+        with self.transaction_lock:
+            transaction = self.active_transactions.get(transaction_id)
+            if transaction is None:
+                return self._missing_transaction(transaction_id)
+            occ = transaction['optimistic']
+            transaction['savepoints'].append((
+                name,
+                len(self.undo_logs[transaction_id]),
+                len(transaction['operations']),
+                len(transaction['versions']),
+                len(occ.undo) if occ else 0,
+                len(occ.operations) if occ else 0,
+            ))
+            return f"Savepoint {name} created."
+
+    def _find_savepoint(self, transaction, name):
+        """Index of the newest savepoint with that name, None if there is none"""
+        for index in range(len(transaction['savepoints']) - 1, -1, -1):
+            if transaction['savepoints'][index][0] == name:
+                return index
+        return None
+
+    def rollback_to_savepoint(self, transaction_id, name):
+        """Undo only what the transaction did after the savepoint, which stays defined; locks are kept"""
+        with self.transaction_lock:
+            transaction = self.active_transactions.get(transaction_id)
+            if transaction is None:
+                return self._missing_transaction(transaction_id)
+            index = self._find_savepoint(transaction, name)
+            if index is None:
+                return f"Savepoint {name} does not exist!"
+            _, undo_length, operations, versions, staged_undo, staged_operations = transaction['savepoints'][index]
+            del transaction['savepoints'][index + 1:]
+
+            undo_log = self.undo_logs[transaction_id]
+            self._apply_undo(undo_log[undo_length:])
+            del undo_log[undo_length:]
+            del transaction['operations'][operations:]
+            # Versions pushed after the savepoint now hold values that no longer exist, like a rollback's
+            for version in transaction['versions'][versions:]:
+                version.writer = None
+                version.aborted_at = self.commit_ts
+            del transaction['versions'][versions:]
+
+            occ = transaction['optimistic']
+            if occ is not None:
+                while len(occ.undo) > staged_undo:
+                    table_name, key, previous = occ.undo.pop()
+                    staged = occ.writes[table_name]
+                    if previous is OptimisticState.UNSTAGED:
+                        del staged[key]
+                        if not staged:
+                            del occ.writes[table_name]
+                    else:
+                        staged[key] = previous
+                del occ.operations[staged_operations:]
+            return f"Rolled back to savepoint {name}."
+
+    def release_savepoint(self, transaction_id, name):
+        """Forget a savepoint and every later one, keeping their changes"""
+        with self.transaction_lock:
+            transaction = self.active_transactions.get(transaction_id)
+            if transaction is None:
+                return self._missing_transaction(transaction_id)
+            index = self._find_savepoint(transaction, name)
+            if index is None:
+                return f"Savepoint {name} does not exist!"
+            del transaction['savepoints'][index:]
+            return f"Savepoint {name} released."
+
+    def optimistic_state(self, transaction_id):
+        """OptimisticState of an optimistic transaction, None for locking ones"""
+        transaction = self.active_transactions.get(transaction_id)
+        return transaction['optimistic'] if transaction is not None else None
+
+    def stage_write(self, transaction_id, operation, table_name, key, record, args):
+        """Keep a row write of an optimistic transaction private until it commits"""
+        occ = self.active_transactions[transaction_id]['optimistic']
+        staged = occ.writes.setdefault(table_name, {})
+        occ.undo.append((table_name, key, staged.get(key, OptimisticState.UNSTAGED)))
+        staged[key] = record
+        occ.operations.append((operation, args))
+
+    def _apply_optimistic(self, transaction_id, occ):
+        """Validate an optimistic transaction and run its staged writes, an error message if it was rolled back
+
+        Runs with transaction_lock held, which serializes it with every other commit. Validating under the
+        stripe latches of the written keys instead would need the version chains guarded by them as well.
+        """
+        # Lock what is about to be written first, so nothing validated below can change before it is applied
+        written = [(table_name, key) for table_name, keys in occ.writes.items() for key in keys]
+        conflict = next((item for item in written if not self.acquire_lock(transaction_id, *item, 'write')), None)
+        if conflict is None:
+            conflict = self._find_conflict(transaction_id, occ.reads.union(written))
+        if conflict is not None:
+            self.conflicts += 1
+            self.rollback_transaction(transaction_id)
+            return (f"Transaction {transaction_id} conflicts with a concurrent change to {conflict[0]}:{conflict[1]} "
+                    "and was rolled back. Retry it.")
+
+        occ.applying = True
+        for operation, args in occ.operations:
+            result = getattr(self.db, operation)(*args, transaction_id=transaction_id)
+            if "successfully" not in result:
+                self.rollback_transaction(transaction_id)
+                return f"Transaction {transaction_id} was rolled back while applying its writes: {result}"
+        return None
+
+    def _find_conflict(self, transaction_id, items):
+        """First (table_name, key) that a transaction committed after the given one's snapshot, None if none"""
+        snapshot = self.snapshots[transaction_id]
+        for table_name, key in items:
+            chains = [self.table_history.get(table_name, ())]
+            if key == self.TABLE_KEY:
+                chains.extend(self.row_versions.get(table_name, {}).values())
+            else:
+                chains.append(self.row_versions.get(table_name, {}).get(key, ()))
+            for chain in chains:
+                if any(version.commit_ts is not None and version.commit_ts > snapshot for version in chain):
+                    return table_name, key
+        return None
+
+    def _finish(self, transaction_id, status):
+        """Move a transaction out of active_transactions into the bounded history"""
+        with self._registry_latch(transaction_id):
+            transaction = self.active_transactions.pop(transaction_id)
+        self.history.pop(transaction_id, None)  # A reused id moves to the newest end
+        self.history[transaction_id] = {
+            'status': status,
+            'operations': len(transaction['operations']),
+            'autocommit': transaction['autocommit'],
+            'deadlock_victim': transaction.get('deadlock_victim', False),
+        }
+        while len(self.history) > self.history_size:
+            self.history.popitem(last=False)
+
+    def _missing_transaction(self, transaction_id):
+        if transaction_id in self.history:
+            return f"Transaction {transaction_id} is not active!"
+        return f"Transaction {transaction_id} does not exist!"
     
-    def is_transaction_active(self, transaction_id):
+    def log_record_undo(self, transaction_id, table_name, key, before):
+        """Remember a row's before-image ahead of a change, None if the row did not exist"""
+        with self.transaction_lock:
+            undo_log = self.undo_logs.get(transaction_id)
+            if undo_log is not None and not self.db.recovering:
+                undo_log.append(("record", table_name, key, before))
+                self._push_version(self.row_versions.setdefault(table_name, {}).setdefault(key, []),
+                                   before, transaction_id)
+
+    def log_table_rows(self, transaction_id, table_name):
+        """Keep every row's current value for snapshot readers, ahead of a change to all rows of a table"""
+        with self.transaction_lock:
+            if transaction_id not in self.undo_logs or self.db.recovering:
+                return
+            chains = self.row_versions.setdefault(table_name, {})
+            for key, record in self.db.tables[table_name]["records"].items():
+                self._push_version(chains.setdefault(key, []), record, transaction_id)
+
+    def log_table_version(self, transaction_id, table_name):
+        """Keep the table object for snapshot readers, ahead of creating or dropping the table"""
+        with self.transaction_lock:
+            if transaction_id in self.undo_logs and not self.db.recovering:
+                self._push_version(self.table_history.setdefault(table_name, []),
+                                   self.db.tables.get(table_name), transaction_id)
+
+    def _push_version(self, chain, value, transaction_id):
+        if chain and chain[-1].writer == transaction_id and chain[-1].commit_ts is None:
+            return  # Snapshots only need the value from before the transaction's first change
+        version = RowVersion(value, transaction_id)
+        chain.append(version)
+        self.active_transactions[transaction_id]['versions'].append(version)
+
+    def read_version(self, transaction_id, chain, current):
+        """Value a transaction's snapshot sees, given the chain of a row or table and its current value"""
+        if not chain:
+            return current
+        chain = list(chain)  # Writers append and vacuum trims concurrently
+        newest = chain[-1]
+        if newest.writer == transaction_id and newest.commit_ts is None:
+            return current  # The transaction's own change
+        snapshot = self.snapshots.get(transaction_id, self.commit_ts)
+        for position, version in enumerate(chain):
+            if version.aborted and position + 1 < len(chain):
+                # Rolled back, and any later change kept the value it restored as its own before-image.
+                # Only the newest version stands in for a current value read just before the rollback
+                continue
+            if version.visible_to(transaction_id, snapshot):
+                return version.value
+        return current
+
+    def reads_snapshot(self, transaction_id):
+        """True unless the transaction asked for serializable reads, which lock what they read"""
+        transaction = self.active_transactions.get(transaction_id)
+        return transaction is None or transaction.get('isolation', "snapshot") == "snapshot"
+
+    def _end_snapshot(self, transaction_id):
+        """Forget a finished transaction's snapshot and drop the row versions nobody can see any more"""
+        self.snapshots.pop(transaction_id, None)
+        self.active_transactions[transaction_id]['versions'] = []
+        self.commits_since_vacuum += 1
+        # With no reader left every version is obsolete, so this pass costs what was just written
+        if not self.snapshots or self.commits_since_vacuum >= self.VACUUM_EVERY:
+            self.vacuum()
+
+    def vacuum(self):
+        """Drop row and table versions older than every active snapshot, returns how many were dropped"""
+        with self.transaction_lock:
+            self.commits_since_vacuum = 0
+            oldest = min(self.snapshots.values(), default=None)
+            removed = 0
+            for chains in [self.table_history] + list(self.row_versions.values()):
+                for key in list(chains):
+                    chain = chains[key]
+                    keep = 0
+                    while keep < len(chain) and (self._obsolete(chain[keep], oldest) or
+                                                 chain[keep].aborted and keep + 1 < len(chain)):
+                        keep += 1
+                    if keep:
+                        del chain[:keep]
+                        removed += keep
+                    if not chain:
+                        del chains[key]
+            for table_name in [name for name, chains in self.row_versions.items() if not chains]:
+                del self.row_versions[table_name]
+            return removed
+
+    def _obsolete(self, version, oldest):
+        if version.commit_ts is not None:
+            return oldest is None or version.commit_ts <= oldest
+        if version.aborted_at is not None:
+            # A reader that began before the rollback may still be between reading a row and its versions
+            return oldest is None or version.aborted_at < oldest
+        return False
+
+    def get_version_stats(self):
+        with self.transaction_lock:
+            return {
+                'commit_ts': self.commit_ts,
+                'active_snapshots': len(self.snapshots),
+                'oldest_snapshot': min(self.snapshots.values(), default=None),
+                'row_versions': sum(len(chain) for chains in self.row_versions.values() for chain in chains.values()),
+                'table_versions': sum(len(chain) for chain in self.table_history.values()),
+            }
+
+    def log_table_undo(self, transaction_id, table_name):
+        """Remember a table's schema, records and indexes ahead of a table-level change"""
         with self.transaction_lock:
-            return (transaction_id in self.active_transactions and
-                    self.active_transactions[transaction_id]['status'] == 'active')
+            undo_log = self.undo_logs.get(transaction_id)
+            if undo_log is None or self.db.recovering:
+                return
+            table = self.db.tables.get(table_name)
+            image = None  # The table did not exist
+            if table is not None:
+                self.db.ensure_loaded(table_name)
+                image = {field: copy.deepcopy(value) for field, value in dict(table).items() if field != "records"}
+                records = table["records"]
+                # Table-level changes replace a memory table's records dict, pages and runs are forked instead
+                image["records"] = copy.deepcopy(records) if isinstance(records, (PagedRecords, LSMRecords)) else records
+            # Index dicts are only edited by row changes, which are undone first, so references are enough
+            indexes = dict(self.db.indexer.indexes.get(table_name, {}))
+            pending = set(self.db.indexer.pending.get(table_name, ()))
+            undo_log.append(("table", table_name, image, indexes, pending))
+
+    def _apply_undo(self, undo_log):
+        """Put back the before-images of a rolled back transaction, newest first"""
+        indexer = self.db.indexer
+        for entry in reversed(undo_log):
+            if entry[0] == "record":
+                _, table_name, key, before = entry
+                table = self.db.tables.get(table_name)
+                if table is None:
+                    continue  # Dropped later on by this transaction, a table entry restores it
+                records = table["records"]
+                current = records.get(key)
+                if current is not None:
+                    indexer.delete_from_index(table_name, key, current)
+                    del records[key]
+                if before is not None:
+                    records[key] = before
+                    indexer.add_to_index(table_name, key, before)
+                self.db._bump_table_version(table_name)
+            else:
+                _, table_name, image, indexes, pending = entry
+                if image is None:
+                    self.db.tables.pop(table_name, None)
+                else:
+                    self.db.tables[table_name] = image
+                indexer.indexes.pop(table_name, None)
+                if indexes:
+                    indexer.indexes[table_name] = indexes
+                with indexer.rebuild_lock:
+                    indexer.pending.pop(table_name, None)
+                for column_name in pending:
+                    indexer.schedule_rebuild(table_name, column_name)
+
+    def committed_rows(self):
+        """{table_name: {key: committed record, None if absent}} of the rows that active transactions changed
+
+        The oldest before-image of a row is its committed value, its write lock kept anyone else from
+        committing to it since. None if an uncommitted change is a table-level one or went to the pages or
+        runs of a paged or LSM table, which snapshots cannot leave out.
+        """
+        with self.transaction_lock:
+            committed = {}
+            for undo_log in self.undo_logs.values():
+                for entry in undo_log:
+                    if entry[0] != "record":
+                        return None
+                    _, table_name, key, before = entry
+                    table = self.db.tables.get(table_name)
+                    if table is None or table.get("storage", "memory") != "memory":
+                        return None
+                    committed.setdefault(table_name, {}).setdefault(key, before)
+            return committed
+
+    def is_transaction_active(self, transaction_id):
+        transaction = self.active_transactions.get(transaction_id)
+        if transaction is None:
+            return False
+        with transaction['latch']:
+            return transaction['status'] == 'active' and transaction_id in self.active_transactions
     
     def log_operation(self, transaction_id, operation, *args, **kwargs):
-        with self.transaction_lock:
-            if transaction_id not in self.active_transactions:
-                return False
-            
-            self.active_transactions[transaction_id]['operations'].append({
+        transaction = self.active_transactions.get(transaction_id)
+        if transaction is None:
+            return False
+        with transaction['latch']:
+            transaction['operations'].append({
                 'operation': operation,
                 'args': args,
                 'kwargs': kwargs,
@@ -168,22 +1499,81 @@ class TransactionManager:
             })
             return True
 class Database:
-    def __init__(self, file_name="database.json"):
+    LOAD_PROGRESS_EVERY = 100000  # Records between two load progress reports
+    CHECKPOINT_DEFERRALS_LOGGED = 10  # Deferred checkpoints in a row between two log lines
+    def __init__(self, file_name="database.json", wal_mode=False,
+                 group_commit_window=0.0, group_commit_max_batch=64,
+                 checkpoint_interval=60.0, checkpoint_wal_bytes=16 * 1024 * 1024,
+                 storage_layout="single", lazy_load=False, load_progress=None, record_format=None,
+                 buffer_pool_pages=1024, page_size=4096, lsm_memtable_limit=4096, lock_timeout=5.0,
+                 lock_escalation_threshold=1000, transaction_history=1000, lock_stripes=16):
         self.tables = {}
         print("DEBUG: Initializing Database...")
         self.file_name = file_name
         self.indexer = Indexer(self)  # Initialize the indexer
-        self.transaction_manager = TransactionManager(self)
-        self.implicit_transaction_counter = 0
+        self.transaction_manager = TransactionManager(self, lock_timeout, lock_escalation_threshold,
+                                                      transaction_history, lock_stripes)
+        self.implicit_transaction_ids = count(1)  # next() is atomic, implicit transactions start on many threads
+        self.cascading = {}  # {transaction_id: set of (table, key)} whose delete is cascading, ends reference cycles
+        # In WAL mode commits append to <file_name>.wal and database.json is only a snapshot
+        self.wal_mode = wal_mode
+        self.wal = WriteAheadLog(file_name + ".wal", self._json_serializer) if wal_mode else None
+        self.group_committer = GroupCommitter(self._flush_commits, group_commit_window, group_commit_max_batch)
+        self.snapshot_lsn = 0
+        self.snapshot_lock = threading.Lock()
+        # "single" keeps everything in file_name, "segmented" keeps one file per table in segment_dir
+        self.storage_layout = storage_layout
+        self.segment_dir = file_name + ".segments"
+        self.dirty_tables = set()  # Tables changed by committed transactions since the last snapshot
+        self.table_lsns = {}  # LSN each table's segment was written at, used to skip replayed records
+        # "json" or "binary" (typed, no per-value parsing on load); None keeps the format found on disk
+        self.record_format = record_format
+        self.codec = RecordCodec(self._json_serializer)
+        self.segment_formats = {}  # Record format each table's segment file is currently written in
+        # Tables created with storage="paged" keep their records in <file_name>.pages, cached by the buffer pool
+        self.buffer_pool = BufferPool(buffer_pool_pages)
+        self.page_size = page_size
+        self.page_dir = file_name + ".pages"
+        # Tables created with storage="lsm" keep a memtable and sorted runs in <file_name>.lsm/<table>
+        self.lsm_dir = file_name + ".lsm"
+        self.lsm_memtable_limit = lsm_memtable_limit
+        self.table_stores = {}  # Open PageFile or LSMStore per paged or LSM table
+        self.store_lsns = {}  # LSN each paged or LSM table's files were last flushed at
+        self.store_versions = {}  # Table version each paged or LSM table's files were last flushed at
+        # Every change to a table's records gives it a new version, stored indexes must carry the same one
+        self.table_versions = count(1)
+        self.stored_indexes = {}  # Indexes read from disk, validated once the table stores are open
+        # Only schemas are read at startup, records are loaded when a table is first used
+        self.lazy_load = lazy_load
+        # Called as load_progress(bytes_read, total_bytes, table_name, records_loaded) while loading
+        self.load_progress = load_progress
+        self.recovering = False
+        self.checkpoint_deferrals = 0  # Checkpoints in a row that found an uncommitted change they cannot leave out
         self.load_from_file()
+        # Background checkpoints only make sense when commits go to the WAL
+        self.checkpointer = None
+        if wal_mode and checkpoint_interval:
+            self.checkpointer = Checkpointer(self, checkpoint_interval, checkpoint_wal_bytes)
+            self.checkpointer.start()
         print(f"Database initialized with tables: {self.tables}")
         
     def _get_implicit_transaction_id(self):
-        self.implicit_transaction_counter += 1
-        return f"implicit_transaction_{self.implicit_transaction_counter}"
+        return f"implicit_transaction_{next(self.implicit_transaction_ids)}"
+
+    def _autocommit_read(self, read, *args):
+        """Run a point read outside of any transaction, against a snapshot that ends with the read"""
+        transaction_id = self.transaction_manager.begin_read()
+        try:
+            return read(*args, transaction_id=transaction_id)
+        finally:
+            self.transaction_manager.end_read(transaction_id)
+
+    def begin_transaction(self, transaction_id, isolation="snapshot", concurrency="locking"):
+        """Snapshot transactions read without locks; serializable ones lock what they read
 
-    def begin_transaction(self, transaction_id):
-        return self.transaction_manager.begin_transaction(transaction_id)
+        concurrency="optimistic" also defers row writes to commit, see TransactionManager.begin_transaction.
+        """
+        return self.transaction_manager.begin_transaction(transaction_id, isolation, concurrency=concurrency)
     
     def commit_transaction(self, transaction_id):
         return self.transaction_manager.commit_transaction(transaction_id)
@@ -194,17 +1584,130 @@ class Database:
     def is_transaction_active(self, transaction_id):
         return self.transaction_manager.is_transaction_active(transaction_id)
 
-    def create_table(self, table_name, columns, constraints=None, transaction_id=None):
+    def savepoint(self, transaction_id, name):
+        return self.transaction_manager.savepoint(transaction_id, name)
+
+    def rollback_to_savepoint(self, transaction_id, name):
+        return self.transaction_manager.rollback_to_savepoint(transaction_id, name)
+
+    def release_savepoint(self, transaction_id, name):
+        return self.transaction_manager.release_savepoint(transaction_id, name)
+
+    def vacuum(self):
+        """Reclaim row versions that no active snapshot can see any more"""
+        removed = self.transaction_manager.vacuum()
+        return f"Vacuum removed {removed} old row versions."
+
+    def get_version_stats(self):
+        return self.transaction_manager.get_version_stats()
+
+    def get_lock_stats(self):
+        return self.transaction_manager.get_lock_stats()
+
+    def get_transaction_stats(self):
+        return self.transaction_manager.get_memory_stats()
+
+    def _lock_failure(self, transaction_id, target):
+        """Message for a lock that was not granted, telling deadlock victims to retry at once"""
+        if self.transaction_manager.is_deadlock_victim(transaction_id):
+            return (f"Transaction {transaction_id} was rolled back to break a deadlock on {target}. "
+                    "Retry it.")
+        return f"Could not acquire lock for {target}. Try again later."
+
+    def _lock_for_read(self, transaction_id, table_name, key, lock_type='read'):
+        """Only serializable transactions lock for reading, snapshot readers see committed versions instead"""
+        if self.transaction_manager.reads_snapshot(transaction_id):
+            return True
+        return self.transaction_manager.acquire_lock(transaction_id, table_name, key, lock_type)
+
+    def _lock_for_scan(self, transaction_id, table_name):
+        """One shared lock on the whole table instead of a lock per row read, again only for serializable readers"""
+        return self._lock_for_read(transaction_id, table_name, TransactionManager.TABLE_KEY, "S")
+
+    def _lock_table(self, transaction_id, table_name):
+        """Exclusive table lock for schema and whole-table changes, waits for every row lock on the table"""
+        return self.transaction_manager.acquire_lock(transaction_id, table_name, TransactionManager.TABLE_KEY, "X")
+
+    def _visible_table(self, transaction_id, table_name):
+        """The table as the transaction's snapshot sees it, None if it does not exist there"""
+        current = self.tables.get(table_name)
+        if not self.transaction_manager.reads_snapshot(transaction_id):
+            return current
+        return self.transaction_manager.read_version(
+            transaction_id, self.transaction_manager.table_history.get(table_name), current)
+
+    def _visible_record(self, transaction_id, table_name, table, key):
+        occ = self.transaction_manager.optimistic_state(transaction_id)
+        if occ is not None:
+            occ.reads.add((table_name, key))
+            staged = occ.writes.get(table_name, {})
+            if key in staged:
+                return staged[key]
+        current = table["records"].get(key)
+        if not self.transaction_manager.reads_snapshot(transaction_id):
+            return current
+        chains = self.transaction_manager.row_versions.get(table_name, {})
+        return self.transaction_manager.read_version(transaction_id, chains.get(key), current)
+
+    def _visible_items(self, transaction_id, table_name, table):
+        """(key, record) pairs as the transaction's snapshot sees them, safe to iterate while others write"""
+        occ = self.transaction_manager.optimistic_state(transaction_id)
+        if occ is None or table_name not in occ.writes:
+            if occ is not None:
+                occ.reads.add((table_name, TransactionManager.TABLE_KEY))
+            yield from self._snapshot_items(transaction_id, table_name, table)
+            return
+        occ.reads.add((table_name, TransactionManager.TABLE_KEY))
+        staged = occ.writes[table_name]
+        for key, record in self._snapshot_items(transaction_id, table_name, table):
+            if key not in staged:
+                yield key, record
+        for key, record in list(staged.items()):
+            if record is not None:
+                yield key, record
+
+    def _snapshot_items(self, transaction_id, table_name, table):
+        records = table["records"]
+        # Read the current rows before their versions, writers keep a version before they change a row
+        if isinstance(records, (PagedRecords, LSMRecords)):
+            records = copy.deepcopy(records)  # Forks the pages or runs
+        else:
+            records = dict(records)
+        chains = self.transaction_manager.row_versions.get(table_name)
+        if not chains or not self.transaction_manager.reads_snapshot(transaction_id):
+            yield from records.items()
+            return
+        chains = dict(chains)
+        read_version = self.transaction_manager.read_version
+        for key, record in records.items():
+            if key in chains:
+                record = read_version(transaction_id, chains[key], record)
+                if record is None:
+                    continue
+            yield key, record
+        for key, chain in chains.items():
+            if key not in records:
+                record = read_version(transaction_id, chain, None)
+                if record is not None:
+                    yield key, record
+
+    def create_table(self, table_name, columns, constraints=None, transaction_id=None, storage="memory"):
         # Handle implicit transactions if no transaction_id is provided
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         table_name = table_name.strip().lower()
+
+        # Lock the new table's schema so that concurrent creates of the same name serialize
+        if not self._lock_table(transaction_id, table_name):
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return self._lock_failure(transaction_id, f"{table_name}")
         
         if not isinstance(self.tables, dict):
             self.tables = {}  # Ensure it's always a dictionary
@@ -216,6 +1719,11 @@ class Database:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Table '{table_name}' already exists!"
+
+        if storage not in {"memory", "paged", "lsm"}:
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return f"Unsupported storage: '{storage}'. Expected 'memory', 'paged' or 'lsm'."
             
         formatted_columns = {}
         constraints = constraints or {}
@@ -241,16 +1749,35 @@ class Database:
 
             if "primary_key" in col_constraints:
                 primary_keys.add(col_name)
-            if "foreign_key" in col_constraints:
-                foreign_keys[col_name] = col_constraints.get("foreign_key", None)
-
             formatted_columns[col_name] = {"type": col_type, "constraints": col_constraints}
 
+        for col_name, col_details in formatted_columns.items():
+            foreign_key = self._foreign_key(col_details["constraints"])
+            if foreign_key is None:
+                continue
+            parent_table, parent_column, on_delete = foreign_key
+            parent_columns = formatted_columns if parent_table == table_name else \
+                self.tables.get(parent_table, {}).get("columns", {})
+            error = None
+            if parent_column not in parent_columns:
+                error = f"Foreign key '{col_name}' references unknown column '{parent_table}.{parent_column}'"
+            elif parent_columns[parent_column]["type"] != col_details["type"]:
+                error = f"Foreign key '{col_name}' is {col_details['type']} but '{parent_table}.{parent_column}' is {parent_columns[parent_column]['type']}"
+            elif on_delete not in {"restrict", "cascade"}:
+                error = f"Unsupported ON DELETE action: '{on_delete}'. Expected 'restrict' or 'cascade'."
+            if error:
+                if implicit_transaction:
+                    self.transaction_manager.rollback_transaction(transaction_id)
+                return error
+            foreign_keys[col_name] = f"{parent_table}.{parent_column}"
+
         if len(primary_keys) > 1:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return "Only one primary key is allowed per table!"
 
+        self.transaction_manager.log_table_undo(transaction_id, table_name)
+        self.transaction_manager.log_table_version(transaction_id, table_name)
         self.tables[table_name] = {
             "columns": formatted_columns,
             "records": {},
@@ -258,9 +1785,18 @@ class Database:
             "primary_keys": list(primary_keys),
             "foreign_keys": foreign_keys,
         }
+        if storage != "memory":
+            self.tables[table_name]["storage"] = storage
+            self.tables[table_name]["records"] = self._open_table_storage(table_name, storage, create=True)
+        # Constraints look values up in indexes rather than scanning
+        if not self._index_constraint_columns(transaction_id, table_name, self.tables[table_name]):
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return self._lock_failure(transaction_id, f"{table_name}")
         
         # Log the operation and handle transaction
-        self.transaction_manager.log_operation(transaction_id, 'create_table', table_name, columns, constraints)
+        self.transaction_manager.log_operation(transaction_id, 'create_table', table_name, columns, constraints,
+                                               storage=storage)
         
         if implicit_transaction:
             result = self.transaction_manager.commit_transaction(transaction_id)
@@ -276,8 +1812,8 @@ class Database:
             
         if transaction_id:
             # This is a table-level operation, so we use a generic key
-            if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read'):
-                return f"Could not acquire lock for {table_name}. Try again later."
+            if not self._lock_for_read(transaction_id, table_name, TransactionManager.TABLE_KEY, "IS"):
+                return self._lock_failure(transaction_id, f"{table_name}")
             self.transaction_manager.log_operation(transaction_id, 'get_table_columns', table_name)
             
         return self.tables.get(table_name, {}).get("columns", None)
@@ -287,16 +1823,20 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
+
+        occ = self.transaction_manager.optimistic_state(transaction_id)
+        if occ is not None and not occ.applying:
+            return self._stage_write('insert', transaction_id, table_name, key, values)
             
         # Acquire write lock
         if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'write'):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}:{key}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
                 
         table_name = table_name.strip().lower()
         key = str(key).strip()
@@ -307,97 +1847,31 @@ class Database:
             return "Table does not exist!"
 
         table = self.tables[table_name]
-        columns = table["columns"]
-        constraints = table.get("constraints", {})
-
-        if isinstance(values, str):
-            values_list = re.findall(r'"([^"]*)"|\'([^\']*)\'|([^,\s]+)', values)
-            values_list = ["".join(match) for match in values_list]
-        elif isinstance(values, list):
-            values_list = values
-        else:
+        record, error = self._build_record(table, key, values)
+        if error:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return "Invalid input format!"
+            return error
 
-        if len(values_list) != len(columns):
+        if not self._lock_row_values(transaction_id, table_name, table, None, record):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return "Mismatch between column count and values!"
-
-        record = {}
-        for (col_name, col_details), value in zip(columns.items(), values_list):
-            value = value.strip()
-            col_type = col_details["type"]
-            col_constraints = col_details.get("constraints", [])
-
-            if "primary_key" in col_constraints and key in table["records"]:
-                if implicit_transaction:
-                    self.transaction_manager.rollback_transaction(transaction_id)
-                return f"Primary Key violation: '{key}' already exists!"
-
-            if "unique" in col_constraints:
-                for existing_record in table["records"].values():
-                    if existing_record.get(col_name) == value:
-                        if implicit_transaction:
-                            self.transaction_manager.rollback_transaction(transaction_id)
-                        return f"Unique constraint violation: '{col_name}' must be unique!"
-
-            if "foreign_key" in col_constraints:
-                parent_table, parent_column = col_constraints["foreign_key"].split(".")
-                if parent_table not in self.tables or value not in self.tables[parent_table]["records"]:
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Foreign Key violation: '{value}' not found in '{parent_table}.{parent_column}'"
-
-            # Convert based on type
-            if col_type == "int":
-                if not value.isdigit():        
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Invalid value '{value}' for column '{col_name}' (Expected int)"
-                value = int(value)
-            elif col_type == "float":
-                try:
-                    value = float(value)
-                except ValueError:
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Invalid value '{value}' for column '{col_name}' (Expected float)"
-            elif col_type == "bool":
-                if value.lower() not in {"true", "false"}:
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Invalid value '{value}' for column '{col_name}' (Expected bool: true/false)"
-                value = value.lower() == "true"
-            elif col_type == "char":
-                if len(value) != 1:
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Invalid value '{value}' for column '{col_name}' (Expected CHAR - single character)"
-            elif col_type == "datetime":
-                if isinstance(value, str):
-                    try:
-                        value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        if implicit_transaction:
-                            self.transaction_manager.rollback_transaction(transaction_id)
-                        return f"Invalid datetime format for '{col_name}', expected 'YYYY-MM-DD HH:MM:SS'."
-                elif not isinstance(value, datetime):
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Invalid type for column '{col_name}', expected DATETIME."
-            elif col_type == "string":
-                value = value.strip('"').strip("'")
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
 
-            record[col_name] = value
+        error = self._constraint_violation(table_name, table, key, None, record)
+        if error:
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return error
 
         if key in table["records"]:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return "Key already exists! Use UPDATE instead."
 
+        self.transaction_manager.log_record_undo(transaction_id, table_name, key, None)
         table["records"][key] = record
+        self._bump_table_version(table_name)
         
         self.indexer.add_to_index(table_name, key, record)
 
@@ -412,43 +1886,133 @@ class Database:
         
         return "Inserted successfully!"
 
+    def _stage_write(self, operation, transaction_id, table_name, key, argument=None):
+        """Check a row write of an optimistic transaction against its snapshot and stage it until commit"""
+        table_name = table_name.strip().lower()
+        key = str(key).strip()
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
+            return "Table does not exist!"
+        self.ensure_loaded(table_name)
+
+        current = self._visible_record(transaction_id, table_name, table, key)
+        error = None
+        if operation == 'insert':
+            if current is not None:
+                return "Key already exists! Use UPDATE instead."
+            record, error = self._build_record(table, key, argument)
+        elif current is None:
+            return "Key not found!"
+        elif operation == 'update':
+            record, error = self._build_update(table_name, table, key, current, argument)
+        else:
+            record = None
+        if error is None and record is not None:
+            # Checked again under the value locks when the commit applies it
+            error = self._constraint_violation(table_name, table, key, current, record)
+        if error:
+            return error
+
+        args = (table_name, key) if operation == 'delete' else (table_name, key, argument)
+        self.transaction_manager.stage_write(transaction_id, operation, table_name, key, record, args)
+        return {'insert': "Inserted successfully!", 'update': "Updated successfully!",
+                'delete': "Deleted successfully!"}[operation]
+
+    def _build_record(self, table, key, values):
+        """Parse, check and convert the values of a new row: (record, None), or (None, error message)"""
+        columns = table["columns"]
+
+        if isinstance(values, str):
+            values_list = re.findall(r'"([^"]*)"|\'([^\']*)\'|([^,\s]+)', values)
+            values_list = ["".join(match) for match in values_list]
+        elif isinstance(values, list):
+            values_list = values
+        else:
+            return None, "Invalid input format!"
+
+        if len(values_list) != len(columns):
+            return None, "Mismatch between column count and values!"
+
+        record = {}
+        for (col_name, col_details), value in zip(columns.items(), values_list):
+            value = value.strip()
+            col_type = col_details["type"]
+            col_constraints = col_details.get("constraints", [])
+
+            if "primary_key" in col_constraints and key in table["records"]:
+                return None, f"Primary Key violation: '{key}' already exists!"
+
+            value, error = self._convert_value(col_name, col_type, value)
+            if error:
+                return None, error
+
+            record[col_name] = value
+        return record, None
+
+    # Python types a value given as something other than a string may already have, per column type
+    COLUMN_PYTHON_TYPES = {"int": int, "float": (int, float), "bool": bool, "char": str, "string": str,
+                           "datetime": datetime}
+
+    def _convert_value(self, col_name, col_type, value):
+        """Convert a value to its column's type: (value, None), or (None, error message)"""
+        if not isinstance(value, str):
+            if isinstance(value, self.COLUMN_PYTHON_TYPES.get(col_type, object)) and \
+                    not (isinstance(value, bool) and col_type != "bool"):
+                return (float(value) if col_type == "float" else value), None
+            if isinstance(value, datetime):
+                return None, f"Invalid type for column '{col_name}', expected {col_type.upper()}."
+            value = str(value)
+
+        # Convert based on type
+        if col_type == "int":
+            if not value.isdigit():        
+                return None, f"Invalid value '{value}' for column '{col_name}' (Expected int)"
+            value = int(value)
+        elif col_type == "float":
+            try:
+                value = float(value)
+            except ValueError:
+                return None, f"Invalid value '{value}' for column '{col_name}' (Expected float)"
+        elif col_type == "bool":
+            if value.lower() not in {"true", "false"}:
+                return None, f"Invalid value '{value}' for column '{col_name}' (Expected bool: true/false)"
+            value = value.lower() == "true"
+        elif col_type == "char":
+            if len(value) != 1:
+                return None, f"Invalid value '{value}' for column '{col_name}' (Expected CHAR - single character)"
+        elif col_type == "datetime":
+            try:
+                value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                return None, f"Invalid datetime format for '{col_name}', expected 'YYYY-MM-DD HH:MM:SS'."
+        elif col_type == "string":
+            value = value.strip('"').strip("'")
+        return value, None
+
     def get(self, table_name, key, transaction_id=None):
-        # Handle implicit transactions if needed
-        implicit_transaction = False
+        # Point reads without a transaction skip begin and commit altogether
         if transaction_id is None:
-            transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
-            implicit_transaction = True
+            return self._autocommit_read(self.get, table_name, key)
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'read'):
-            if implicit_transaction:
-                self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}:{key}. Try again later."
+        if not self._lock_for_read(transaction_id, table_name, key):
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
                 
         table_name = table_name.strip().lower()
         key = str(key).strip()
 
-        if table_name not in self.tables:
-            if implicit_transaction:
-                self.transaction_manager.rollback_transaction(transaction_id)
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
             return "Table does not exist!"
             
-        if key not in self.tables[table_name]["records"]:
-            if implicit_transaction:
-                self.transaction_manager.rollback_transaction(transaction_id)
+        result = self._visible_record(transaction_id, table_name, table, key)
+        if result is None:
             return "Key not found!"
 
         # Log the operation
         self.transaction_manager.log_operation(transaction_id, 'get', table_name, key)
-        
-        result = self.tables[table_name]["records"][key]
-        
-        # Complete the implicit transaction
-        if implicit_transaction:
-            self.transaction_manager.commit_transaction(transaction_id)
             
         return result
 
@@ -457,16 +2021,20 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
+
+        occ = self.transaction_manager.optimistic_state(transaction_id)
+        if occ is not None and not occ.applying:
+            return self._stage_write('delete', transaction_id, table_name, key)
             
         # Acquire write lock
         if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'write'):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}:{key}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
                 
         table_name = table_name.strip().lower()
         key = str(key).strip()
@@ -482,8 +2050,22 @@ class Database:
             return "Key not found!"
         
         record = self.tables[table_name]["records"][key]
+        # Hold the freed unique and referenced values until commit, a rollback takes them back
+        if not self._lock_row_values(transaction_id, table_name, self.tables[table_name], record, None):
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
+
+        error = self._delete_references(transaction_id, table_name, key, record)
+        if error:
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return error
+
+        self.transaction_manager.log_record_undo(transaction_id, table_name, key, record)
         self.indexer.delete_from_index(table_name, key, record)
         del self.tables[table_name]["records"][key]
+        self._bump_table_version(table_name)
         
         # Log the operation
         self.transaction_manager.log_operation(transaction_id, 'delete', table_name, key)
@@ -501,24 +2083,23 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
             
-        if table_name not in self.tables:
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Table '{table_name}' does not exist!"
         
-        table = self.tables[table_name]
-        
         # Check if the column exists
         if column not in table['columns']:
             if implicit_transaction:
@@ -528,7 +2109,7 @@ class Database:
         distinct_values = set()
         
         # Get distinct values for the specified column
-        for record in table['records'].values():
+        for _, record in self._visible_items(transaction_id, table_name, table):
             distinct_values.add(record.get(column))
         
         # Log the operation
@@ -545,25 +2126,24 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
         # Ensure the table exists
-        if table_name not in self.tables:
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Table '{table_name}' does not exist!"
         
-        table = self.tables[table_name]
-        
         # Ensure the group_column exists in the table
         if group_column not in table["columns"]:
             if implicit_transaction:
@@ -573,7 +2153,7 @@ class Database:
         # Group records by the group_column
         grouped_records = {}
         
-        for row in table["records"].values():
+        for _, row in self._visible_items(transaction_id, table_name, table):
             group_value = row.get(group_column)
             if group_value not in grouped_records:
                 grouped_records[group_value] = 0
@@ -615,36 +2195,38 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read locks on both tables
-        if not self.transaction_manager.acquire_lock(transaction_id, table1, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table1):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table1}. Try again later."
+            return self._lock_failure(transaction_id, f"{table1}")
                 
-        if not self.transaction_manager.acquire_lock(transaction_id, table2, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table2):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table2}. Try again later."
+            return self._lock_failure(transaction_id, f"{table2}")
                 
         # Make sure the tables exist
-        if table1 not in self.tables or table2 not in self.tables:
+        visible1 = self._visible_table(transaction_id, table1)
+        visible2 = self._visible_table(transaction_id, table2)
+        if visible1 is None or visible2 is None:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Error: Tables {table1} or {table2} not found."
             
         # Get the column data from both tables
-        table1_records = self.tables[table1]["records"]
-        table2_records = self.tables[table2]["records"]
+        table1_records = list(self._visible_items(transaction_id, table1, visible1))
+        table2_records = list(self._visible_items(transaction_id, table2, visible2))
         
         # Perform the join
         joined_data = []
-        for key1, record1 in table1_records.items():
-            for key2, record2 in table2_records.items():
+        for key1, record1 in table1_records:
+            for key2, record2 in table2_records:
                 # Check if the join condition is met
                 if record1[table1_column] == record2[table2_column]:
                     # Prepare the result row by selecting the required columns
@@ -666,6 +2248,8 @@ class Database:
         return joined_data
 
 
+    WHERE_OPERATORS = {"=", ">", "<", ">=", "<=", "<>", "BETWEEN"}
+
     def _apply_operator(self, left, operator, right):
      if operator == "=":
         return left == right
@@ -679,6 +2263,8 @@ class Database:
          return left <= right
      elif operator == "<>":
         return left != right
+     elif operator == "BETWEEN":
+        return right[0] <= left <= right[1]
      return False
  
     def group_by(self, table_name, group_column, column, transaction_id=None):
@@ -686,24 +2272,23 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
-        if table_name not in self.tables:
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Table '{table_name}' does not exist!"
         
-        table = self.tables[table_name]
-        
         # Check if the group column exists
         if group_column not in table['columns']:
             if implicit_transaction:
@@ -711,7 +2296,7 @@ class Database:
             return f"Group column '{group_column}' does not exist in table '{table_name}'"
         
         grouped_records = {}
-        for record in table['records'].values():
+        for _, record in self._visible_items(transaction_id, table_name, table):
             group_value = record.get(group_column)
             if group_value not in grouped_records:
                 grouped_records[group_value] = []
@@ -735,16 +2320,16 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire write lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'write'):
+        if not self._lock_table(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
         if table_name not in self.tables:
             if implicit_transaction:
@@ -759,14 +2344,27 @@ class Database:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Column '{column_name}' does not exist in table '{table_name}'"
+
+        error = self._referenced_by_other_table(table_name, column_name)
+        if error:
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return error
         
-        # Remove the column from each record
-        for record in table["records"].values():
-            if column_name in record:
-                del record[column_name]
+        # Remove the column from each record, replacing the records rather than editing them in place
+        def without_column(record):
+            return {col: value for col, value in record.items() if col != column_name}
+        self.transaction_manager.log_table_undo(transaction_id, table_name)
+        self.transaction_manager.log_table_rows(transaction_id, table_name)
+        if isinstance(table["records"], (PagedRecords, LSMRecords)):
+            table["records"].rewrite(without_column)  # Pages and runs are never edited, snapshots keep the old ones
+        else:
+            table["records"] = {key: without_column(record) for key, record in table["records"].items()}
         
         # Remove the column from the column definition
         del table["columns"][column_name]
+        self._bump_table_version(table_name)
+        self.indexer.forget_indexes(table_name, column_name)
         
         # Log the operation
         self.transaction_manager.log_operation(transaction_id, 'drop_column', table_name, column_name)
@@ -784,16 +2382,20 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
+
+        occ = self.transaction_manager.optimistic_state(transaction_id)
+        if occ is not None and not occ.applying:
+            return self._stage_write('update', transaction_id, table_name, key, updates)
             
         # Acquire write lock
         if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'write'):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}:{key}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
                 
         table_name = table_name.strip().lower()
         key = str(key).strip()
@@ -809,43 +2411,28 @@ class Database:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return "Key not found!"
 
-        column_types = table["columns"]
+        record = table["records"][key]
+        new_record, error = self._build_update(table_name, table, key, record, updates)
+        if error:
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return error
 
-        for field, value in updates.items():
-            field = field.strip().lower()
+        if not self._lock_row_values(transaction_id, table_name, table, record, new_record):
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
 
-            if field in column_types:
-                col_details = column_types[field]
-                expected_type = column_types[field]
-                constraints = col_details.get("constraints", [])
-               
-                if "primary_key" in constraints:
-                    if implicit_transaction:
-                        self.transaction_manager.rollback_transaction(transaction_id)
-                    return f"Cannot update primary key '{field}'."
-                
-                if "unique" in constraints:
-                    for existing_key, existing_record in table["records"].items():
-                        if existing_key != key and existing_record.get(field) == value:
-                            if implicit_transaction:
-                                self.transaction_manager.rollback_transaction(transaction_id)
-                            return f"Unique constraint violation: '{field}' must be unique!"
-                
-                if "foreign_key" in constraints:
-                    parent_table, parent_column = constraints["foreign_key"].split(".")
-                    if parent_table not in self.tables or value not in self.tables[parent_table]["records"]:
-                        if implicit_transaction:
-                            self.transaction_manager.rollback_transaction(transaction_id)
-                        return f"Foreign Key violation: '{value}' not found in '{parent_table}.{parent_column}'"
-                
-                old_value = table["records"][key].get(field)
-                self.indexer.update_index(table_name, field, key, old_value, value)
-                # Update the field
-                table["records"][key][field] = value
-            else:
-                if implicit_transaction:
-                    self.transaction_manager.rollback_transaction(transaction_id)
-                return f"Field '{field}' does not exist in table '{table_name}'."
+        error = self._constraint_violation(table_name, table, key, record, new_record)
+        if error:
+            if implicit_transaction:
+                self.transaction_manager.rollback_transaction(transaction_id)
+            return error
+
+        self.transaction_manager.log_record_undo(transaction_id, table_name, key, record)
+        self.indexer.update_indexes(table_name, key, record, new_record)
+        table["records"][key] = new_record
+        self._bump_table_version(table_name)
         
         # Log the operation
         self.transaction_manager.log_operation(transaction_id, 'update', table_name, key, updates)
@@ -858,24 +2445,283 @@ class Database:
                 
         return "Updated successfully!"
     
+    def _build_update(self, table_name, table, key, record, updates):
+        """Check and apply updates to a copy of a row: (new record, None), or (None, error message)"""
+        column_types = table["columns"]
+        # Build a new record instead of editing in place so that snapshots holding the old one stay consistent
+        new_record = dict(record)
+        updated_fields = []
+
+        for field, value in updates.items():
+            field = field.strip().lower()
+
+            if field in column_types:
+                col_details = column_types[field]
+                expected_type = column_types[field]
+                constraints = col_details.get("constraints", [])
+               
+                if "primary_key" in constraints:
+                    return None, f"Cannot update primary key '{field}'."
+                
+                # Check and convert the value as insert does, so indexes and reloads see the column's type
+                value, error = self._convert_value(field, col_details["type"], value.strip() if isinstance(value, str) else value)
+                if error:
+                    return None, error
+
+                # Update the field
+                new_record[field] = value
+                updated_fields.append(field)
+            else:
+                return None, f"Field '{field}' does not exist in table '{table_name}'."
+
+        return new_record, None
+
+    def _unique_columns(self, table):
+        return [col_name for col_name, col_details in table["columns"].items()
+                if "unique" in col_details.get("constraints", [])]
+
+    def _foreign_key(self, col_constraints):
+        """(parent table, parent column, on delete action) of a column's foreign key, None if it has none
+
+        Given either as {"foreign_key": "classes.id", "on_delete": "cascade"}
+        or as ["foreign_key", "classes.id", "cascade"]; the action defaults to restrict.
+        """
+        if "foreign_key" not in col_constraints:
+            return None
+        if isinstance(col_constraints, dict):
+            target = col_constraints["foreign_key"]
+            on_delete = col_constraints.get("on_delete", "restrict")
+        else:
+            rest = list(col_constraints)[list(col_constraints).index("foreign_key") + 1:]
+            target = rest[0] if rest else ""
+            on_delete = "cascade" if "cascade" in rest else "restrict"
+        parent_table, _, parent_column = str(target).partition(".")
+        return parent_table.strip().lower(), parent_column.strip().lower(), str(on_delete).lower()
+
+    def _foreign_keys(self, table):
+        """{column: (parent table, parent column, on delete action)} of a table's foreign keys"""
+        foreign_keys = {}
+        for col_name, col_details in table["columns"].items():
+            foreign_key = self._foreign_key(col_details.get("constraints", []))
+            if foreign_key:
+                foreign_keys[col_name] = foreign_key
+        return foreign_keys
+
+    def _references_to(self, table_name):
+        """(child table, child column, parent column, on delete action) of the foreign keys referencing a table"""
+        references = []
+        for child_name, child in list(self.tables.items()):
+            for col_name, (parent_table, parent_column, on_delete) in self._foreign_keys(child).items():
+                if parent_table == table_name:
+                    references.append((child_name, col_name, parent_column, on_delete))
+        return references
+
+    def _constraint_columns(self, table_name):
+        """Indexed columns that constraints look values up in: unique ones, foreign keys and the columns they reference"""
+        table = self.tables.get(table_name)
+        if table is None:
+            return []
+        columns = self._unique_columns(table) + list(self._foreign_keys(table))
+        columns += [parent_column for _, _, parent_column, _ in self._references_to(table_name)]
+        return list(dict.fromkeys(columns))
+
+    def _value_lock(self, transaction_id, table_name, column, value, lock_type):
+        """Lock one value of a column, so that the checks of constraints on it serialize with changes to it"""
+        return self.transaction_manager.acquire_lock(transaction_id, table_name, ("value", column, value), lock_type)
+
+    def _lock_row_values(self, transaction_id, table_name, table, old_record, new_record):
+        """Lock the values a row change relies on before its constraints are checked
+
+        Unique values and values that foreign keys reference are write-locked when the row gives them up or
+        takes them, the parent values of its foreign keys are read-locked so that the parents stay.
+        """
+        old_record = old_record or {}
+        new_record = new_record or {}
+        for col_name in self._unique_columns(table) + [column for _, _, column, _ in self._references_to(table_name)]:
+            if old_record.get(col_name) == new_record.get(col_name):
+                continue
+            for record in (old_record, new_record):
+                if col_name in record and not self._value_lock(transaction_id, table_name, col_name, record[col_name], 'write'):
+                    return False
+        for col_name, (parent_table, parent_column, _) in self._foreign_keys(table).items():
+            if col_name in new_record and old_record.get(col_name) != new_record[col_name]:
+                if not self._value_lock(transaction_id, parent_table, parent_column, new_record[col_name], 'read'):
+                    return False
+        return True
+
+    def _keys_with_value(self, table_name, column, value):
+        """Keys of the rows holding a value in a column, looked up in the column's index"""
+        self.ensure_loaded(table_name)
+        index = self.indexer.indexes.get(table_name, {}).get(column)
+        if index is not None:
+            return list(index.get(value, ()))
+        # Stored before constraints had an index, scan until it is rebuilt
+        self.indexer.ensure_index(table_name, column)
+        return [key for key, record in self.tables[table_name]["records"].items() if record.get(column) == value]
+
+    def _constraint_violation(self, table_name, table, key, old_record, new_record):
+        """Error message if a new or changed row breaks a unique constraint or a foreign key, None otherwise"""
+        old_record = old_record or {}
+        for col_name in self._unique_columns(table):
+            if col_name in new_record and any(holder != key for holder in
+                                               self._keys_with_value(table_name, col_name, new_record[col_name])):
+                return f"Unique constraint violation: '{col_name}' must be unique!"
+        for col_name, (parent_table, parent_column, _) in self._foreign_keys(table).items():
+            if col_name not in new_record or old_record.get(col_name) == new_record[col_name]:
+                continue
+            value = new_record[col_name]
+            if parent_table not in self.tables or not self._keys_with_value(parent_table, parent_column, value):
+                if not (parent_table == table_name and new_record.get(parent_column) == value):  # Refers to itself
+                    return f"Foreign Key violation: '{value}' not found in '{parent_table}.{parent_column}'"
+        # A parent row may not give up a value that children still refer to
+        for child_name, child_column, parent_column, _ in self._references_to(table_name):
+            if old_record and old_record.get(parent_column) != new_record.get(parent_column):
+                error = self._still_referenced(table_name, key, old_record, child_name, child_column, parent_column)
+                if error:
+                    return error
+        return None
+
+    def _referencing_keys(self, table_name, key, record, child_name, child_column, parent_column, ignore=()):
+        """Keys of the child rows that only the given parent row's value keeps valid"""
+        value = record[parent_column]
+        if any(holder != key for holder in self._keys_with_value(table_name, parent_column, value)):
+            return []  # Another parent row still has the value
+        return [child_key for child_key in self._keys_with_value(child_name, child_column, value)
+                if (child_name, child_key) != (table_name, key) and (child_name, child_key) not in ignore]
+
+    def _still_referenced(self, table_name, key, record, child_name, child_column, parent_column):
+        if self._referencing_keys(table_name, key, record, child_name, child_column, parent_column):
+            return (f"Foreign Key violation: '{table_name}.{parent_column}' value '{record[parent_column]}' "
+                    f"is still referenced by '{child_name}'")
+        return None
+
+    def _delete_references(self, transaction_id, table_name, key, record):
+        """Apply ON DELETE of the foreign keys referencing a deleted row: refuse (restrict) or delete the children (cascade)"""
+        cascading = self.cascading.setdefault(transaction_id, set())
+        cascading.add((table_name, key))
+        savepoint = None
+        try:
+            for child_name, child_column, parent_column, on_delete in self._references_to(table_name):
+                if parent_column not in record:
+                    continue
+                # Rows already being deleted further up the cascade no longer count
+                children = self._referencing_keys(table_name, key, record, child_name, child_column, parent_column,
+                                                  cascading)
+                if not children:
+                    continue
+                if on_delete != "cascade":
+                    return (f"Foreign Key violation: '{table_name}.{parent_column}' value '{record[parent_column]}' "
+                            f"is still referenced by '{child_name}'")
+                if savepoint is None:
+                    # Either every child goes or, if one of them cannot, none do
+                    savepoint = f"cascade {table_name}:{key}"
+                    self.transaction_manager.savepoint(transaction_id, savepoint)
+                for child_key in children:
+                    if child_key not in self.tables[child_name]["records"]:
+                        continue  # Went with an earlier child
+                    result = self.delete(child_name, child_key, transaction_id)
+                    if result != "Deleted successfully!":
+                        self.transaction_manager.rollback_to_savepoint(transaction_id, savepoint)
+                        return result
+            if savepoint is not None:
+                self.transaction_manager.release_savepoint(transaction_id, savepoint)
+            return None
+        finally:
+            cascading.discard((table_name, key))
+            if not cascading:
+                self.cascading.pop(transaction_id, None)
+
+    def _empty_references(self, transaction_id, table_name):
+        """Apply ON DELETE of other tables' foreign keys to a table that loses all of its rows
+
+        Child rows are found through the index on their foreign key column rather than by scanning them.
+        """
+        savepoint = None
+        for child_name, child_column, parent_column, on_delete in self._references_to(table_name):
+            if child_name == table_name:
+                continue  # Its rows go with the table
+            self.ensure_loaded(child_name)
+            child_index = self.indexer.indexes.get(child_name, {}).get(child_column)
+            values = list(child_index) if child_index is not None else \
+                {record.get(parent_column) for record in self.tables[table_name]["records"].values()}
+            children = [child_key for value in values if self._keys_with_value(table_name, parent_column, value)
+                        for child_key in self._keys_with_value(child_name, child_column, value)]
+            if not children:
+                continue
+            if on_delete != "cascade":
+                return f"Foreign Key violation: '{table_name}' is still referenced by '{child_name}'"
+            if savepoint is None:
+                savepoint = f"cascade {table_name}"
+                self.transaction_manager.savepoint(transaction_id, savepoint)
+            for child_key in children:
+                if child_key not in self.tables[child_name]["records"]:
+                    continue  # Went with an earlier child
+                result = self.delete(child_name, child_key, transaction_id)
+                if result != "Deleted successfully!":
+                    self.transaction_manager.rollback_to_savepoint(transaction_id, savepoint)
+                    return result
+        if savepoint is not None:
+            self.transaction_manager.release_savepoint(transaction_id, savepoint)
+        return None
+
+    def _referenced_by_other_table(self, table_name, column_name=None):
+        """Error message if another table's foreign key references the table (or one of its columns)"""
+        for child_name, child_column, parent_column, _ in self._references_to(table_name):
+            if child_name != table_name and column_name in (None, parent_column):
+                return (f"Cannot drop '{table_name}{'.' + column_name if column_name else ''}': "
+                        f"foreign key '{child_name}.{child_column}' references it. Drop that first.")
+        return None
+
+    def _index_constraint_columns(self, transaction_id, table_name, table):
+        """Create the indexes the constraints of a new table look values up in, on it and on the tables it references"""
+        for col_name in self._unique_columns(table) + list(self._foreign_keys(table)):
+            self.indexer.add_index(table_name, col_name)
+        for parent_table, parent_column, _ in self._foreign_keys(table).values():
+            if parent_column in self.indexer.index_columns(parent_table):
+                continue
+            if parent_table != table_name:
+                # Built from the parent's records, which the table lock keeps still
+                if not self._lock_table(transaction_id, parent_table):
+                    return False
+                self.ensure_loaded(parent_table)
+                self.transaction_manager.log_table_undo(transaction_id, parent_table)
+            self.indexer.add_index(parent_table, parent_column)
+            # persist_commit only marks the new table, the parent's segment has to be rewritten with its index too
+            self.dirty_tables.add(parent_table)
+        return True
+
     def delete_table(self, table_name, transaction_id=None):
         # Handle implicit transactions if needed
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire write lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'write'):
+        if not self._lock_table(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
         if table_name in self.tables:
-            self.tables[table_name]["records"].clear()
+            error = self._empty_references(transaction_id, table_name)
+            if error:
+                if implicit_transaction:
+                    self.transaction_manager.rollback_transaction(transaction_id)
+                return error
+
+            self.transaction_manager.log_table_undo(transaction_id, table_name)
+            self.transaction_manager.log_table_rows(transaction_id, table_name)
+            table = self.tables[table_name]
+            if isinstance(table["records"], (PagedRecords, LSMRecords)):
+                table["records"].clear()
+            else:
+                table["records"] = {}  # The undo log keeps the old dict
+            self._bump_table_version(table_name)
+            self.indexer.clear_indexes(table_name)
             
             # Log the operation
             self.transaction_manager.log_operation(transaction_id, 'delete_table', table_name)
@@ -896,25 +2742,26 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
         table_name = table_name.strip().lower()
         
-        if table_name not in self.tables:
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
             return f"Table '{table_name}' does not exist!"
         
-        records = self.tables[table_name]["records"]
+        records = list(self._visible_items(transaction_id, table_name, table))
         
         if not records:
             if implicit_transaction:
@@ -922,7 +2769,7 @@ class Database:
             return f"No records found in table '{table_name}'!"
         
         output = f"Records in '{table_name}':\n"
-        for key, record in records.items():
+        for key, record in records:
             output += f"Key: {key}, " + ", ".join(f"{k}: {v}" for k, v in record.items()) + "\n"
         
         # Log the operation
@@ -935,50 +2782,33 @@ class Database:
         return output.strip()
     
     def select_columns(self, table_name, columns, key, transaction_id=None):
-        # Handle implicit transactions if needed
-        implicit_transaction = False
+        # Point reads without a transaction skip begin and commit altogether
         if transaction_id is None:
-            transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
-            implicit_transaction = True
+            return self._autocommit_read(self.select_columns, table_name, columns, key)
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'read'):
-            if implicit_transaction:
-                self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}:{key}. Try again later."
+        if not self._lock_for_read(transaction_id, table_name, key):
+            return self._lock_failure(transaction_id, f"{table_name}:{key}")
                 
-        if table_name not in self.tables:
-            if implicit_transaction:
-                self.transaction_manager.rollback_transaction(transaction_id)
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
             return f"Table '{table_name}' does not exist!"
         
-        table = self.tables[table_name]
-        
         # Check if 'records' exists in the table
         if 'records' not in table:
-            if implicit_transaction:
-                self.transaction_manager.rollback_transaction(transaction_id)
             return f"Table '{table_name}' does not have any records!"
         
         # Find the record based on key
-        if key in table['records']:
-            row = table['records'][key]
+        row = self._visible_record(transaction_id, table_name, table, key)
+        if row is not None:
             result = {col: row[col] for col in columns if col in row}
             
             # Log the operation
             self.transaction_manager.log_operation(transaction_id, 'select_columns', table_name, columns, key)
-            
-            # Complete the implicit transaction
-            if implicit_transaction:
-                self.transaction_manager.commit_transaction(transaction_id)
                 
             return result
-        
-        if implicit_transaction:
-            self.transaction_manager.rollback_transaction(transaction_id)
         return f"Record with id {key} not found in table '{table_name}'."
 
     def drop_table(self, table_name, transaction_id=None):
@@ -986,19 +2816,28 @@ class Database:
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire write lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'write'):
+        if not self._lock_table(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
         if table_name in self.tables:
+            error = self._referenced_by_other_table(table_name)
+            if error:
+                if implicit_transaction:
+                    self.transaction_manager.rollback_transaction(transaction_id)
+                return error
+
+            self.transaction_manager.log_table_undo(transaction_id, table_name)
+            self.transaction_manager.log_table_version(transaction_id, table_name)
             del self.tables[table_name]
+            self.indexer.forget_indexes(table_name)
             
             # Log the operation
             self.transaction_manager.log_operation(transaction_id, 'drop_table', table_name)
@@ -1015,78 +2854,84 @@ class Database:
             self.transaction_manager.rollback_transaction(transaction_id)
         return f"Table '{table_name}' does not exist!"
 
-    def select_where(self, table_name, column, operator, value, transaction_id=None):
+    def select_where(self, table_name, column, operator=None, value=None, transaction_id=None):
+        """Rows where column <operator> value; column can also be a list of (column, operator, value)
+        conditions that must all hold, which are matched against composite indexes"""
         # Handle implicit transactions if needed
         implicit_transaction = False
         if transaction_id is None:
                 transaction_id = self._get_implicit_transaction_id()
-                self.transaction_manager.begin_transaction(transaction_id)
+                self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
                 implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
                 return f"Transaction {transaction_id} is not active!"
 
         table_name = table_name.strip().lower()
-        column = column.strip().lower()
+        conditions = column if isinstance(column, (list, tuple)) else [(column, operator, value)]
+        conditions = [(name.strip().lower(), condition_operator, condition_value)
+                      for name, condition_operator, condition_value in conditions]
+        for _, condition_operator, _ in conditions:
+                if condition_operator not in self.WHERE_OPERATORS:
+                        if implicit_transaction:
+                                self.transaction_manager.rollback_transaction(transaction_id)
+                        return f"Unsupported operator: {condition_operator}"
 
-        if table_name not in self.tables:
+        table = self._visible_table(transaction_id, table_name)
+        if table is None:
                 if implicit_transaction:
                         self.transaction_manager.rollback_transaction(transaction_id)
                 return "Table does not exist!"
 
-        table = self.tables[table_name]
+        self.ensure_loaded(table_name)  # A lazily loaded table brings its indexes along
 
-        # Try to use index for faster lookup
-        keys = self.indexer.get_keys_by_value(table_name, column.strip().lower(), value, operator)
+        try:
+                conditions = [(name, condition_operator, self.indexer.typed_value(table, name, condition_value))
+                              for name, condition_operator, condition_value in conditions]
+        except ValueError:
+                conditions = None  # A value that is not valid for its column matches nothing
 
-        if keys is not None:
-                # Index was available, use it
-                matching_records = []
+        # Try to use index for faster lookup
+        planned = None
+        occ = self.transaction_manager.optimistic_state(transaction_id)
+        # The index does not know about an optimistic transaction's staged writes, scan instead
+        if conditions and table is self.tables.get(table_name) and (occ is None or table_name not in occ.writes):
+                planned = self.indexer.find_keys(table_name, conditions)
+
+        matching_records = []
+        if conditions is None:
+                pass
+        elif planned is not None:
+                # Index was available, use it; its keys are candidates for the conditions on the other columns
+                keys, index_name = planned
+                changed = {}
+                if self.transaction_manager.reads_snapshot(transaction_id):
+                        changed = self.transaction_manager.row_versions.get(table_name, {})
+                if changed:
+                        # The index follows the current rows, rows changed since the snapshot are checked by value
+                        in_index = set(keys)
+                        keys = keys + [key for key in list(changed) if key not in in_index]
                 for key in keys:
                         # Acquire read lock for each record
-                        if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'read'):
+                        if not self._lock_for_read(transaction_id, table_name, key):
                                 if implicit_transaction:
                                         self.transaction_manager.rollback_transaction(transaction_id)
-                                return f"Could not acquire lock for {table_name}:{key}. Try again later."
-
-                        if key in table["records"]:
-                                matching_records.append(table["records"][key])
+                                return self._lock_failure(transaction_id, f"{table_name}:{key}")
+
+                        row = self._visible_record(transaction_id, table_name, table, key)
+                        if row is not None and self._matches(row, conditions):
+                                matching_records.append(row)
+                if changed:
+                        # Snapshot values of changed rows can differ from where the index has them
+                        matching_records.sort(key=lambda row: self.indexer.index_value(index_name, row))
         else:
-                # No index available, fall back to full table scan
-                matching_records = []
-                for key, row in table["records"].items():
-                        # Acquire read lock for each record
-                        if not self.transaction_manager.acquire_lock(transaction_id, table_name, key, 'read'):
-                                if implicit_transaction:
-                                        self.transaction_manager.rollback_transaction(transaction_id)
-                                return f"Could not acquire lock for {table_name}:{key}. Try again later."
-
-                        if column not in row:
-                                continue
-
-                        row_value = row[column]
-
-                        if operator == "=":
-                                if row_value == value:
-                                        matching_records.append(row)
-                        elif operator == ">":
-                                if row_value > value:
-                                        matching_records.append(row)
-                        elif operator == "<":
-                                if row_value < value:
-                                        matching_records.append(row)
-                        elif operator == ">=":
-                                if row_value >= value:
-                                        matching_records.append(row)
-                        elif operator == "<=":
-                                if row_value <= value:
-                                        matching_records.append(row)
-                        elif operator == "<>":
-                                if row_value != value:
-                                        matching_records.append(row)
-                        else:
-                                if implicit_transaction:
-                                        self.transaction_manager.rollback_transaction(transaction_id)
-                                return f"Unsupported operator: {operator}"
+                # No index available, fall back to full table scan under one table lock
+                if not self._lock_for_scan(transaction_id, table_name):
+                        if implicit_transaction:
+                                self.transaction_manager.rollback_transaction(transaction_id)
+                        return self._lock_failure(transaction_id, f"{table_name}")
+                for key, row in self._visible_items(transaction_id, table_name, table):
+                        if self._matches(row, conditions):
+                                matching_records.append(row)
 
         # Log the operation
         self.transaction_manager.log_operation(transaction_id, 'select_where', table_name, column, operator, value)
@@ -1097,23 +2942,33 @@ class Database:
 
         return matching_records
 
+    def _matches(self, row, conditions):
+        return all(name in row and self._apply_operator(row[name], condition_operator, condition_value)
+                   for name, condition_operator, condition_value in conditions)
+
     def count_records(self, table_name, transaction_id=None):
         # Handle implicit transactions if needed
         implicit_transaction = False
         if transaction_id is None:
             transaction_id = self._get_implicit_transaction_id()
-            self.transaction_manager.begin_transaction(transaction_id)
+            self.transaction_manager.begin_transaction(transaction_id, autocommit=True)
             implicit_transaction = True
         elif not self.transaction_manager.is_transaction_active(transaction_id):
             return f"Transaction {transaction_id} is not active!"
             
         # Acquire read lock on table
-        if not self.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read'):
+        if not self._lock_for_scan(transaction_id, table_name):
             if implicit_transaction:
                 self.transaction_manager.rollback_transaction(transaction_id)
-            return f"Could not acquire lock for {table_name}. Try again later."
+            return self._lock_failure(transaction_id, f"{table_name}")
                 
-        if table_name in self.tables:
+        table = self._visible_table(transaction_id, table_name)
+        if table is not None:
+            if table_name in self.transaction_manager.row_versions or table is not self.tables.get(table_name):
+                count = sum(1 for _ in self._visible_items(transaction_id, table_name, table))
+            else:
+                count = len(table['records'])
+
             # Log the operation
             self.transaction_manager.log_operation(transaction_id, 'count_records', table_name)
             
@@ -1121,7 +2976,7 @@ class Database:
             if implicit_transaction:
                 self.transaction_manager.commit_transaction(transaction_id)
                 
-            return f"Total records in '{table_name}': {len(self.tables[table_name]['records'])}"
+            return f"Total records in '{table_name}': {count}"
             
         if implicit_transaction:
             self.transaction_manager.rollback_transaction(transaction_id)
@@ -1137,88 +2992,665 @@ class Database:
     
     def has_index(self, table_name, column_name):
         """Check if an index exists on the specified column of the table"""
-        return (table_name in self.indexer.indexes and column_name in self.indexer.indexes[table_name])
+        if column_name in self._unloaded_index_columns(table_name):
+            return True
+        return column_name in self.indexer.index_columns(table_name)
     
     def get_all_indexes(self):
         """Get a list of all indexes in the database"""
         result = []
-        for table_name, columns in self.indexer.indexes.items():
-                for column_name in columns:
+        for table_name in list(self.tables):
+                for column_name in self.indexer.index_columns(table_name):
+                        result.append(f"{table_name}.{column_name}")
+        for table_name in list(self.tables):
+                for column_name in self._unloaded_index_columns(table_name):
                         result.append(f"{table_name}.{column_name}")
         return result
 
+    def ensure_loaded(self, table_name):
+        """Materialize a lazily loaded table, together with its indexes"""
+        table = self.tables.get(table_name)
+        if isinstance(table, LazyTable):
+            table.materialize()
+
+    def _bump_table_version(self, table_name):
+        self.tables[table_name]["version"] = next(self.table_versions)
+
+    def _unloaded_index_columns(self, table_name):
+        table = self.tables.get(table_name)
+        if isinstance(table, LazyTable) and not table.loaded:
+            return table.index_columns
+        return []
+
     def _json_serializer(self, obj):
         """Custom JSON serializer to handle datetime objects"""
         if isinstance(obj, datetime):
                 return obj.strftime("%Y-%m-%d %H:%M:%S")
         raise TypeError(f"Type {type(obj)} not serializable")
 
-    def save_to_file(self):
-        try:
-            data_to_save = {
-                "tables": self.tables,
-                "indexes": self.indexer.indexes
-            }
-
-            with open(self.file_name, 'w') as file:
-                json.dump(data_to_save, file, default=self._json_serializer)
+    def persist_commit(self, transaction_id, operations):
+        """Queue a committed transaction for the next group flush; returns a ticket for wait_durable"""
+        changes = [op for op in operations if op['operation'] in WAL_OPERATIONS]
+        # Remember which tables the next segmented snapshot has to rewrite
+        self.dirty_tables.update(str(op['args'][0]).strip().lower() for op in changes)
+        if self.recovering:
+            return None  # Replayed transactions are already on disk
+        if not changes:
+            return None  # Read-only transaction, nothing to write
+
+        # In WAL mode each commit contributes one log record; otherwise one full save covers the batch
+        record = self.wal.prepare(transaction_id, changes) if self.wal_mode else None
+        return self.group_committer.enqueue(record)
+
+    def wait_durable(self, ticket):
+        """Block until the flush covering ticket has been fsynced"""
+        if ticket is None:
             return True
+        return self.group_committer.wait_durable(ticket)
+
+    def _flush_commits(self, records):
+        """Write one group-commit batch with a single fsync"""
+        try:
+            if self.wal_mode:
+                self.wal.write_batch(records)
+                return True
+            return self.save_to_file()
         except Exception as e:
-            print(f"Error saving to file: {str(e)}")
+            print(f"Error flushing commits: {str(e)}")
             return False
 
+    def get_commit_stats(self):
+        """Return group commit statistics, including how many commits each recent flush covered"""
+        return self.group_committer.get_stats()
+
+    def checkpoint(self):
+        """Write a snapshot of everything committed so far and drop the WAL records it covers"""
+        if not self.wal_mode:
+            return self.save_to_file()
+
+        with self.snapshot_lock:
+            with self.transaction_manager.transaction_lock:
+                # Rows that running transactions changed are written with their committed values
+                committed = self.transaction_manager.committed_rows()
+                if committed is None:
+                    return self._defer_checkpoint()
+                data_to_save = self._take_snapshot(committed)
+                data_to_save["lsn"] = self.wal.last_lsn
+                wal_offset = self.wal.tell()
+
+            # The expensive part runs without transaction_lock, commits keep appending to the WAL
+            try:
+                self._write_snapshot(data_to_save)
+                self.snapshot_lsn = data_to_save["lsn"]
+                self.wal.truncate_prefix(wal_offset)
+                if self.checkpoint_deferrals:
+                    print(f"DEBUG: Checkpoint written after {self.checkpoint_deferrals} deferred attempts")
+                    self.checkpoint_deferrals = 0
+                return True
+            except Exception as e:
+                print(f"Error writing checkpoint: {str(e)}")
+                self._restore_dirty(data_to_save)
+                return False
+
+    def _defer_checkpoint(self):
+        """Count a checkpoint that has to wait for a table-level or paged/LSM change to commit or roll back"""
+        self.checkpoint_deferrals += 1
+        if self.checkpoint_deferrals % self.CHECKPOINT_DEFERRALS_LOGGED == 0:
+            print(f"DEBUG: Checkpoint deferred {self.checkpoint_deferrals} times in a row, "
+                  "a table-level or paged/LSM change is uncommitted")
+        return False
+
+    def save_to_file(self):
+        if self.wal_mode:
+            return self.checkpoint()
+        with self.snapshot_lock:
+            with self.transaction_manager.transaction_lock:
+                # Without a WAL this runs on the commit path, other transactions' rows go in as last committed
+                data_to_save = self._take_snapshot(self.transaction_manager.committed_rows())
+            try:
+                self._write_snapshot(data_to_save)
+                return True
+            except Exception as e:
+                print(f"Error saving to file: {str(e)}")
+                self._restore_dirty(data_to_save)
+                return False
+
+    def _take_snapshot(self, committed=None):
+        """Capture what the next snapshot has to write; call with transaction_lock held
+
+        committed maps the rows of running transactions to the values written in their place.
+        """
+        if self.storage_layout != "segmented":
+            data = self._capture_snapshot(committed=committed)
+            data["stored_tables"] = self._stored_table_names()
+            return data
+
+        dirty = self.dirty_tables
+        self.dirty_tables = set()
+        data = self._capture_snapshot(dirty, committed)
+        data["dirty"] = dirty
+
+        # The catalog carries every schema so that lazy startup never has to open a segment
+        data["catalog"] = {}
+        for table_name, table in list(self.tables.items()):
+            schema = {field: value for field, value in dict(table).items() if field != "records"}
+            index_columns = self._unloaded_index_columns(table_name) or self.indexer.index_columns(table_name)
+            data["catalog"][table_name] = {"schema": schema, "indexes": index_columns}
+        data["stored_tables"] = self._stored_table_names()
+        return data
+
+    def _stored_table_names(self):
+        return {table_name for table_name, table in self.tables.items() if table.get("storage", "memory") != "memory"}
+
+    def _restore_dirty(self, data):
+        """Put back the dirty tables of a snapshot that failed to write"""
+        with self.transaction_manager.transaction_lock:
+            self.dirty_tables.update(data.get("dirty", ()))
+
+    def _capture_snapshot(self, table_names=None, committed=None):
+        """Copy the table and index containers; records are never edited in place so they can be shared"""
+        if table_names is None:
+            table_names = list(self.tables.keys())
+        committed = committed or {}
+
+        tables = {}
+        stored = {}
+        for table_name in table_names:
+            table = self.tables.get(table_name)
+            if table is None:
+                continue  # Dropped since it was marked dirty
+            table_copy = dict(table)
+            table_copy["columns"] = dict(table["columns"])
+            if isinstance(table["records"], (PagedRecords, LSMRecords)):
+                # Only the bucket directory or memtable is copied, the snapshot writer flushes the files themselves
+                state = dict(table["records"].capture(), version=table.get("version", 0))
+                stored[table_name] = (table["records"].store, state)
+                table_copy["records"] = {}
+            else:
+                table_copy["records"] = dict(table["records"])
+                for key, record in committed.get(table_name, {}).items():
+                    if record is None:
+                        table_copy["records"].pop(key, None)
+                    else:
+                        table_copy["records"][key] = record
+            tables[table_name] = table_copy
+
+        indexes = {}
+        for table_name, table_copy in tables.items():
+            # The indexes of a table with uncommitted rows are built from the records the snapshot writes
+            records = table_copy["records"] if table_name in committed else None
+            for column_name in self.indexer.index_columns(table_name):
+                indexes.setdefault(table_name, {})[column_name] = self.indexer.capture_index(table_name, column_name,
+                                                                                             records)
+
+        return {"tables": tables, "indexes": indexes, "stored": stored}
+
+    def _write_snapshot(self, data):
+        # Paged and LSM tables go first, so the snapshot never names pages or runs that are not on disk yet
+        stored = data.pop("stored", {})
+        stored_tables = data.pop("stored_tables", set())
+        for table_name, (store, state) in stored.items():
+            store.flush(state, data.get("lsn", 0))
+            self.store_lsns[table_name] = data.get("lsn", 0)
+            self.store_versions[table_name] = state["version"]
+        for columns in data["indexes"].values():
+            for index in columns.values():
+                self.indexer.seal_index(index)
+
+        if self.storage_layout == "segmented":
+            self._write_segments(data)
+        elif self.record_format == "binary":
+            self._atomic_write(self.file_name, lambda file: self._write_binary(file, data), binary=True)
+        else:
+            self._atomic_write_json(self.file_name, data)
+        self._remove_dropped_table_stores(stored_tables)
+
+    def _remove_dropped_table_stores(self, stored_tables):
+        """Delete the page files and LSM directories of tables that the snapshot just written no longer has"""
+        with self.transaction_manager.transaction_lock:
+            for directory, suffix in ((self.page_dir, ".pages"), (self.lsm_dir, "")):
+                if not os.path.isdir(directory):
+                    continue
+                for file_name in os.listdir(directory):
+                    if suffix and not file_name.endswith(suffix):
+                        continue  # The .meta file goes together with its page file
+                    table_name = file_name[:len(file_name) - len(suffix)]
+                    if table_name in stored_tables or table_name in self.tables:
+                        continue
+                    store = self.table_stores.get(table_name)
+                    if store is not None and store.instances:
+                        continue  # Still referenced, e.g. by a transaction that may roll the drop back
+                    if store is not None:
+                        self.table_stores.pop(table_name).remove()
+                    elif suffix:
+                        os.remove(os.path.join(directory, file_name))
+                    else:
+                        shutil.rmtree(os.path.join(directory, file_name), ignore_errors=True)
+
+    def _open_table_storage(self, table_name, storage, create=False):
+        """Open the page file or LSM directory of a table, create=True starts it empty"""
+        old_store = self.table_stores.pop(table_name, None)
+        if old_store is not None:
+            old_store.close()
+        decode = lambda data: self._decode_block(self.tables.get(table_name, {}), data)
+        if storage == "lsm":
+            store = LSMStore(os.path.join(self.lsm_dir, table_name), self._encode_page, decode,
+                             self._atomic_write_json, memtable_limit=self.lsm_memtable_limit)
+            state = store.open(create)
+            records = LSMRecords(store, state)
+        else:
+            store = PageFile(os.path.join(self.page_dir, f"{table_name}.pages"), self.buffer_pool,
+                             self.page_size, self._atomic_write_json)
+            state = store.open(create)
+            records = PagedRecords(store, self._encode_page, decode, state)
+            store.collect_garbage()
+        self.table_stores[table_name] = store
+        self.store_lsns[table_name] = state.get("lsn", 0) if state else 0
+        self.store_versions[table_name] = state.get("version", 0) if state else 0
+        return records
+
+    def _encode_page(self, records):
+        return b"".join(self.codec.encode_records(records))
+
+    def _attach_table_stores(self):
+        """Point the records of paged and LSM tables at their files after loading the schemas"""
+        for table_name, table in self.tables.items():
+            storage = table.get("storage", "memory")
+            if storage != "memory":
+                records = self._open_table_storage(table_name, storage)
+                if isinstance(table, LazyTable):
+                    table.materialize()  # Picks up the indexes stored with the segment
+                dict.__setitem__(table, "records", records)
+
+    def get_buffer_pool_stats(self):
+        """Return buffer pool hit, miss and eviction counters for paged tables"""
+        return self.buffer_pool.get_stats()
+
+    def get_lsm_stats(self, table_name):
+        """Return run, compaction and bloom filter counters for an LSM table"""
+        table_name = table_name.strip().lower()
+        table = self.tables.get(table_name)
+        if table is None or not isinstance(table["records"], LSMRecords):
+            return f"Table '{table_name}' does not use LSM storage."
+        return table["records"].get_stats()
+
+    def _write_binary(self, file, data):
+        """Write a snapshot as a JSON header with the schemas and indexes followed by one record block per table"""
+        schemas = {}
+        for table_name, table in data["tables"].items():
+            schemas[table_name] = {field: value for field, value in table.items() if field != "records"}
+        self.codec.write_header(file, {"lsn": data.get("lsn", 0), "tables": schemas, "indexes": data["indexes"]})
+        for table in data["tables"].values():
+            self.codec.write_block(file, table["records"])
+
+    def _write_segments(self, data):
+        """Rewrite the segments of the dirty tables, then the catalog, then remove dropped segments"""
+        os.makedirs(self.segment_dir, exist_ok=True)
+        lsn = data.get("lsn", 0)
+        stale_paths = []  # Removed only once the catalog no longer points at them
+        for table_name, table in data["tables"].items():
+            indexes = data["indexes"].get(table_name, {})
+            path = self._segment_path(table_name, self.record_format)
+            if self.record_format == "binary":
+                self._atomic_write(path, lambda file: self._write_binary_segment(file, lsn, table, indexes), binary=True)
+            else:
+                self._atomic_write_json(path, {"lsn": lsn, "table": table, "indexes": indexes})
+            self.table_lsns[table_name] = lsn
+            old_format = self.segment_formats.get(table_name, self.record_format)
+            if old_format != self.record_format:
+                stale_paths.append(self._segment_path(table_name, old_format))
+            self.segment_formats[table_name] = self.record_format
+
+        for table_name, entry in data["catalog"].items():
+            entry["lsn"] = self.table_lsns.get(table_name, lsn)
+            entry["format"] = self.segment_formats.get(table_name, self.record_format)
+        self._atomic_write_json(self.file_name, {"layout": "segmented", "tables": data["catalog"], "lsn": lsn})
+
+        for table_name in data["dirty"] - set(data["tables"]):
+            self.segment_formats.pop(table_name, None)
+            stale_paths.extend(self._segment_path(table_name, record_format) for record_format in ("json", "binary"))
+        for path in stale_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _write_binary_segment(self, file, lsn, table, indexes):
+        schema = {field: value for field, value in table.items() if field != "records"}
+        self.codec.write_header(file, {"lsn": lsn, "table": schema, "indexes": indexes})
+        self.codec.write_block(file, table["records"])
+
+    def _segment_path(self, table_name, record_format=None):
+        if record_format is None:
+            record_format = self.segment_formats.get(table_name, self.record_format)
+        extension = "bin" if record_format == "binary" else "json"
+        return os.path.join(self.segment_dir, f"{table_name}.{extension}")
+
+    def _atomic_write_json(self, path, data):
+        self._atomic_write(path, lambda file: json.dump(data, file, default=self._json_serializer))
+
+    def _atomic_write(self, path, write, binary=False):
+        """Call write(file) on a temp file, fsync it and rename it over the old file"""
+        temp_name = path + ".tmp"
+        with open(temp_name, 'wb' if binary else 'w') as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_name, path)
+
+        # Make the rename itself durable
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        except OSError:
+            return  # Not supported on this platform
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def close(self):
+        """Stop the background checkpointer and close the WAL"""
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+        if self.wal is not None:
+            self.wal.close()
+        for store in self.table_stores.values():
+            store.close()
+
     def load_from_file(self):
         try:
             print(f"DEBUG: Attempting to load from {self.file_name}")
-            with open(self.file_name, 'r') as file:
-                data = json.load(file)
-
-                # Handle both old and new format
-                if isinstance(data, dict) and "tables" in data:
-                        self.tables = data["tables"]
-                        if hasattr(self, "indexer"):
-                            if "indexes" in data:
-                                self.indexer.indexes = data["indexes"]
-                            else:
-                                print("DEBUG: Indexer not initialized; skipping index load.")
+            with open(self.file_name, 'rb') as file:
+                binary = file.read(len(RecordCodec.MAGIC)) == RecordCodec.MAGIC
+            loaded_layout = self._load_binary_file() if binary else self._load_json_file()
+            self._attach_table_stores()
+            self.table_versions = count(max([table.get("version", 0) for table in self.tables.values()] + [0]) + 1)
+            for table_name, stored in self.stored_indexes.items():
+                self.indexer.load_indexes(table_name, stored)
+            self.stored_indexes = {}
+
+            if loaded_layout == "segmented":
+                loaded_formats = set(self.segment_formats.values())
+            else:
+                loaded_formats = {"binary" if binary else "json"}
+            if self.record_format is None:
+                # Keep writing the format found on disk, so a converted database stays converted
+                self.record_format = "binary" if "binary" in loaded_formats else "json"
+
+            if loaded_layout != self.storage_layout:
+                # Switching layouts, the next snapshot has to write every table
+                self.dirty_tables.update(self.tables.keys())
+            else:
+                # Switching record formats, segments still in the old one have to be rewritten
+                self.dirty_tables.update(table_name for table_name, record_format in self.segment_formats.items()
+                                         if record_format != self.record_format)
 
-                else:
-                        # Old format - just tables
-                        self.tables = data
-
-                # Convert types for loaded data
-                for table_name, table in self.tables.items():
-                        for key, record in table.get("records", {}).items():
-                            for col_name, value in record.items():
-                                    col_type = table.get("columns", {}).get(col_name, {}).get("type")
-                                    if col_type == "int":
-                                        record[col_name] = int(value) if isinstance(value, str) and value.isdigit() else value
-                                    elif col_type == "float":
-                                        try:
-                                                record[col_name] = float(value) if isinstance(value, str) else value
-                                        except ValueError:
-                                                pass
-                                    elif col_type == "bool":
-                                        if isinstance(value, str):
-                                                record[col_name] = value.lower() == "true"
-                                    elif col_type == "datetime" and isinstance(value, str):
-                                        try:
-                                                record[col_name] = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
-                                        except ValueError:
-                                                pass
-
-                print(f"DEBUG: Loaded tables: {list(self.tables.keys())}")
+            print(f"DEBUG: Loaded tables: {list(self.tables.keys())}")
 
         except FileNotFoundError:
             print(f"DEBUG: File {self.file_name} not found, starting with empty database")
             self.tables = {}
-        except json.JSONDecodeError as e:
-            print(f"DEBUG: Error decoding JSON: {str(e)}")
+        except (json.JSONDecodeError, SnapshotDecodeError) as e:
+            # Keep the damaged file for inspection instead of overwriting it with the next save
+            print(f"DEBUG: Error decoding {self.file_name}: {str(e)}, moving it to {self.file_name}.corrupt")
+            os.replace(self.file_name, self.file_name + ".corrupt")
             self.tables = {}
         except Exception as e:
             print(f"DEBUG: Unexpected error loading database: {str(e)}")
             self.tables = {}
 
+        if self.record_format is None:
+            self.record_format = "json"
+        if self.wal_mode:
+            self._replay_wal()
+
+    def _load_json_file(self):
+        """Load a JSON snapshot or segment catalog, returns its storage layout"""
+        with open(self.file_name, 'r') as file:
+            # Parse table by table and record by record instead of holding the whole text in memory
+            reader = StreamingJSONReader(file, os.fstat(file.fileno()).st_size)
+            header = {}
+            tables = {}
+            indexes = {}
+            old_format = False
+            for position, field in enumerate(reader.iter_object()):
+                if position == 0 and field not in SNAPSHOT_FIELDS:
+                    old_format = True
+                if old_format:
+                    # Old format - just tables
+                    tables[field] = self._stream_table(reader, field, coerce=not self.lazy_load)
+                elif field == "tables" and header.get("layout") != "segmented":
+                    for table_name in reader.iter_object():
+                        tables[table_name] = self._stream_table(reader, table_name, coerce=not self.lazy_load)
+                elif field == "indexes":
+                    indexes = self._stream_nested(reader, 3)
+                else:
+                    header[field] = reader.read_value()
+
+        if header.get("layout") == "segmented":
+            # Catalog only, each table is opened from its own segment
+            self.tables = {}
+            self.snapshot_lsn = header.get("lsn", 0)
+            catalog = header["tables"]
+            for table_name in catalog:
+                entry = catalog[table_name] if isinstance(catalog, dict) else {}
+                self.segment_formats[table_name] = entry.get("format", "json")
+                if self.lazy_load and entry:
+                    self.tables[table_name] = LazyTable(entry["schema"], self._segment_loader(table_name),
+                                                        entry.get("indexes", []))
+                    self.table_lsns[table_name] = entry.get("lsn", self.snapshot_lsn)
+                else:
+                    self._load_table_segment(table_name)
+            return "segmented"
+
+        self.tables = tables
+        self.snapshot_lsn = header.get("lsn", 0)
+        self.stored_indexes = indexes
+        if self.lazy_load:
+            # Type conversion of the parsed records waits for first use
+            for table_name, table in list(self.tables.items()):
+                records = table.pop("records", {})
+                self.tables[table_name] = LazyTable(table, self._records_loader(table, records))
+        return "single"
+
+    def _load_binary_file(self):
+        """Load a snapshot written in the binary record format, returns its storage layout"""
+        with open(self.file_name, 'rb') as file:
+            total_bytes = os.fstat(file.fileno()).st_size
+            header = self.codec.read_header(file)
+            tables = {}
+            for table_name, schema in header.get("tables", {}).items():
+                table = dict(schema)
+                block = self.codec.read_block(file)
+                if self.lazy_load:
+                    tables[table_name] = LazyTable(table, self._block_loader(table, block))
+                    continue
+                table["records"] = self._decode_block(table, block)
+                tables[table_name] = table
+                self._report_load_progress(file.tell(), total_bytes, table_name, len(table["records"]))
+
+        self.tables = tables
+        self.snapshot_lsn = header.get("lsn", 0)
+        self.stored_indexes = header.get("indexes", {})
+        return "single"
+
+    def _decode_block(self, table, block):
+        """Decode a table's record block; only fields that had to be stored as JSON go through type conversion"""
+        records, json_fields = self.codec.decode_records(block)
+        columns = table.get("columns", {})
+        json_columns = {name: columns[name] for name in json_fields if name in columns}
+        if json_columns:
+            self._coerce_records(json_columns, records)
+        return records
+
+    def _block_loader(self, table, block):
+        """Loader for a LazyTable whose records are still an encoded block"""
+        def load():
+            return self._decode_block(table, block)
+        return load
+
+    def _stream_table(self, reader, table_name, coerce=True):
+        """Parse one table object record by record, converting types as it goes"""
+        table = {}
+        records = {}
+        converted = False
+        for field in reader.iter_object():
+            if field != "records":
+                table[field] = reader.read_value()
+                continue
+            columns = table.get("columns") if coerce else None
+            names = {}
+            for key in reader.iter_object():
+                # Each value is decoded on its own, so share column-name strings across records as json.load does
+                record = {names.setdefault(name, name): value for name, value in reader.read_value().items()}
+                if columns is not None:
+                    self._coerce_record(columns, record)
+                records[key] = record
+                if len(records) % self.LOAD_PROGRESS_EVERY == 0:
+                    self._report_load_progress(reader.bytes_read, reader.total_bytes, table_name, len(records))
+            converted = columns is not None
+
+        table["records"] = records
+        if coerce and not converted:
+            self._coerce_record_types(table)  # The records came before the columns
+        self._report_load_progress(reader.bytes_read, reader.total_bytes, table_name, len(records))
+        return table
+
+    def _stream_nested(self, reader, depth):
+        """Parse depth levels of nested objects one member at a time, e.g. table -> column -> value for indexes"""
+        result = {}
+        for key in reader.iter_object():
+            result[key] = self._stream_nested(reader, depth - 1) if depth > 1 else reader.read_value()
+        return result
+
+    def _report_load_progress(self, bytes_read, total_bytes, table_name, records_loaded):
+        if self.load_progress is not None:
+            self.load_progress(bytes_read, total_bytes, table_name, records_loaded)
+        else:
+            percent = 100 * bytes_read // total_bytes if total_bytes else 100
+            print(f"DEBUG: Loading '{table_name}': {records_loaded} records, {percent}% of file read")
+
+    def _read_table_segment(self, table_name):
+        """Read one table's segment file, returns None if it is missing or damaged"""
+        path = self._segment_path(table_name)
+        try:
+            if self.segment_formats.get(table_name) == "binary":
+                return self._read_binary_segment(path, table_name)
+            with open(path, 'r') as file:
+                reader = StreamingJSONReader(file, os.fstat(file.fileno()).st_size)
+                segment = {}
+                for field in reader.iter_object():
+                    if field == "table":
+                        segment["table"] = self._stream_table(reader, table_name)
+                    elif field == "indexes":
+                        segment["indexes"] = self._stream_nested(reader, 2)
+                    else:
+                        segment[field] = reader.read_value()
+                return segment
+        except FileNotFoundError:
+            print(f"DEBUG: Segment {path} not found, skipping table '{table_name}'")
+        except (json.JSONDecodeError, SnapshotDecodeError) as e:
+            print(f"DEBUG: Error decoding segment {path}: {str(e)}, moving it to {path}.corrupt")
+            os.replace(path, path + ".corrupt")
+        return None
+
+    def _read_binary_segment(self, path, table_name):
+        with open(path, 'rb') as file:
+            total_bytes = os.fstat(file.fileno()).st_size
+            header = self.codec.read_header(file)
+            table = dict(header.get("table", {}))
+            table["records"] = self._decode_block(table, self.codec.read_block(file))
+            self._report_load_progress(file.tell(), total_bytes, table_name, len(table["records"]))
+        return {"lsn": header.get("lsn", 0), "table": table, "indexes": header.get("indexes", {})}
+
+    def _load_table_segment(self, table_name):
+        """Open a single table and its indexes from its segment file"""
+        segment = self._read_table_segment(table_name)
+        if segment is None:
+            return False
+
+        table = segment["table"]
+        self.tables[table_name] = table
+        if segment.get("indexes"):
+            self.stored_indexes[table_name] = segment["indexes"]
+        self.table_lsns[table_name] = segment.get("lsn", 0)
+        return True
+
+    def _segment_loader(self, table_name):
+        """Loader for a LazyTable backed by a segment file"""
+        def load():
+            segment = self._read_table_segment(table_name)
+            if segment is None:
+                return {}
+            table = segment["table"]
+            self.indexer.load_indexes(table_name, segment.get("indexes", {}))
+            return table.get("records", {})
+        return load
+
+    def _records_loader(self, table, records):
+        """Loader for a LazyTable whose records are already parsed but not yet converted"""
+        def load():
+            self._coerce_records(table.get("columns", {}), records)
+            return records
+        return load
+
+    def _coerce_record_types(self, table):
+        """Convert values that JSON turned into strings back to their column types"""
+        self._coerce_records(table.get("columns", {}), table.get("records", {}))
+
+    def _coerce_records(self, columns, records):
+        for record in records.values():
+            self._coerce_record(columns, record)
+
+    def _coerce_record(self, columns, record):
+        for col_name, value in record.items():
+            col_type = columns.get(col_name, {}).get("type")
+            if col_type == "int":
+                record[col_name] = int(value) if isinstance(value, str) and value.isdigit() else value
+            elif col_type == "float":
+                try:
+                    record[col_name] = float(value) if isinstance(value, str) else value
+                except ValueError:
+                    pass
+            elif col_type == "bool":
+                if isinstance(value, str):
+                    record[col_name] = value.lower() == "true"
+            elif col_type == "datetime" and isinstance(value, str):
+                try:
+                    record[col_name] = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+                except ValueError:
+                    pass
+
+    def _replay_wal(self):
+        """Re-apply the transactions logged after the snapshot was taken"""
+        self.wal.last_lsn = max([self.snapshot_lsn] + list(self.table_lsns.values()) + list(self.store_lsns.values()))
+        transaction_id = "wal_replay"
+        self.recovering = True
+        try:
+            self.transaction_manager.begin_transaction(transaction_id)
+            replayed = 0
+            for record in self.wal.read():
+                applied = False
+                for op in record["ops"]:
+                    operation, args = op[0], op[1]
+                    kwargs = op[2] if len(op) > 2 else {}
+                    table_name = str(args[0]).strip().lower()
+                    applied_lsn = self.table_lsns.get(table_name, self.snapshot_lsn)
+                    if operation in RECORD_OPERATIONS:
+                        applied_lsn = max(applied_lsn, self.store_lsns.get(table_name, 0))
+                    if record["lsn"] <= applied_lsn:
+                        continue  # Already part of the snapshot, this table's segment or its pages or runs
+                    getattr(self, operation)(*args, transaction_id=transaction_id, **kwargs)
+                    applied = True
+                replayed += applied
+            self.transaction_manager.commit_transaction(transaction_id)
+            print(f"DEBUG: Replayed {replayed} transactions from {self.wal.file_name}")
+        finally:
+            self.recovering = False
+
     def ensure_indexer(self):
         """Ensure that the indexer is properly initialized and attached to this database instance"""
         if not hasattr(self, 'indexer') or self.indexer is None:
@@ -1230,43 +3662,223 @@ class Database:
         return self.indexer
                     
 class Indexer:
+    INDEX_FORMAT = 1  # Layout of a stored index, older snapshots stored {value: [keys]} with string values
+    REBUILD_ATTEMPTS = 3  # Copies built off the lock before giving up and building under it
+    # A composite index is named after its columns joined by this, e.g. "class_id,age", its values are tuples
+    COLUMN_SEPARATOR = ","
+    RANGE_OPERATORS = {">", ">=", "<", "<=", "BETWEEN"}
+    NO_VALUE = object()  # Index value of a record that lacks one of the index's columns, it is left out
+
     def __init__(self, db):
         self.db = db
-        self.indexes = {}  # Format: {table_name: {column_name: {value: [keys]}}}
+        self.indexes = {}  # Format: {table_name: {index name: OrderedIndex {value: [keys]}}}
+        self.pending = {}  # {table_name: set of columns} whose stored index failed validation and is being rebuilt
+        self.rebuild_lock = threading.Lock()
+        self.rebuild_thread = None
         print(f"DEBUG: New Indexer instance created. ID: {id(self)}")
 
+    def index_columns(self, table_name):
+        """Columns of a table that have an index, including ones still being rebuilt"""
+        return list(self.indexes.get(table_name, {})) + sorted(self.pending.get(table_name, ()))
+
+    def index_name(self, columns):
+        """Name of the index on one column or, given several (a list or "a, b"), of the composite index on them"""
+        if isinstance(columns, str):
+            columns = columns.split(self.COLUMN_SEPARATOR)
+        return self.COLUMN_SEPARATOR.join(column.strip().lower() for column in columns)
+
+    def key_columns(self, index_name):
+        return index_name.split(self.COLUMN_SEPARATOR)
+
+    def index_value(self, index_name, record):
+        """Value a record has in an index, a tuple for a composite one; NO_VALUE if it lacks one of the columns"""
+        if self.COLUMN_SEPARATOR not in index_name:
+            return record.get(index_name, self.NO_VALUE)
+        columns = self.key_columns(index_name)
+        if not all(column in record for column in columns):
+            return self.NO_VALUE
+        return tuple(record[column] for column in columns)
+
+    def _index_type(self, table, index_name):
+        types = [table["columns"].get(column, {}).get("type") for column in self.key_columns(index_name)]
+        return types if len(types) > 1 else types[0]
+
+    def _has_columns(self, table, index_name):
+        return all(column in table["columns"] for column in self.key_columns(index_name))
+
+    def capture_index(self, table_name, column_name, records=None):
+        """Copy an index for a snapshot; call with transaction_lock held, seal_index adds the checksum later
+
+        Given the records the snapshot writes, the index is built from them instead of copied.
+        """
+        table = self.db.tables[table_name]
+        entries = None  # An index that is still being rebuilt is stored as invalid, so it is rebuilt again
+        index = self.indexes.get(table_name, {}).get(column_name)
+        if index is not None:
+            if records is not None:
+                index = self._build_index(records, column_name)
+            entries = [[value, list(keys)] for value, keys in index.items()]
+        return {"format": self.INDEX_FORMAT, "type": self._index_type(table, column_name),
+                "table_version": table.get("version", 0), "entries": entries}
+
+    def seal_index(self, stored):
+        stored["checksum"] = self._checksum(stored["entries"]) if stored["entries"] is not None else None
+
+    def _checksum(self, entries):
+        return zlib.crc32(json.dumps(entries, default=self.db._json_serializer).encode("utf-8"))
+
+    def load_indexes(self, table_name, stored_indexes):
+        """Install the stored indexes of a table that are still valid, rebuild the others in the background"""
+        for column_name, stored in stored_indexes.items():
+            if column_name in self.index_columns(table_name):
+                continue  # Created since startup
+            index = self._validate_index(table_name, column_name, stored)
+            if index is None:
+                print(f"DEBUG: Stored index on '{table_name}.{column_name}' is stale or damaged, rebuilding it")
+                self.schedule_rebuild(table_name, column_name)
+            else:
+                self.indexes.setdefault(table_name, {})[column_name] = index
+
+    def _validate_index(self, table_name, column_name, stored):
+        """Return the index a stored one describes, or None if it does not match the table it was loaded with"""
+        table = self.db.tables.get(table_name)
+        if table is None or not isinstance(stored, dict) or not isinstance(stored.get("entries"), list):
+            return None  # No such table, or an index stored before indexes had a format
+        column_type = self._index_type(table, column_name)
+        version = table.get("version", 0)
+        if stored.get("format") != self.INDEX_FORMAT or stored.get("type") != column_type:
+            return None
+        if stored.get("table_version") != version:
+            return None
+        if self.db.store_versions.get(table_name, version) != version:
+            return None  # The pages or runs were flushed without the snapshot that goes with them
+        if stored.get("checksum") != self._checksum(stored["entries"]):
+            return None
+        index = {}
+        for value, keys in stored["entries"]:
+            if isinstance(column_type, list):
+                # JSON keeps a composite value as a list
+                value = tuple(datetime.strptime(part, "%Y-%m-%d %H:%M:%S") if part_type == "datetime" and isinstance(part, str)
+                              else part for part, part_type in zip(value, column_type))
+            elif column_type == "datetime" and isinstance(value, str):
+                value = datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            index[value] = keys
+        return OrderedIndex(index)
+
+    def add_index(self, table_name, column_name):
+        """Build and install an index within the caller's transaction, for the columns constraints look up"""
+        if column_name not in self.index_columns(table_name):
+            self.indexes.setdefault(table_name, {})[column_name] = self._build_index(self.db.tables[table_name]["records"], column_name)
+
+    def ensure_index(self, table_name, column_name):
+        """Build a missing index in the background, e.g. the one of a unique column stored without it"""
+        if column_name not in self.index_columns(table_name):
+            self.schedule_rebuild(table_name, column_name)
+
+    def schedule_rebuild(self, table_name, column_name):
+        with self.rebuild_lock:
+            self.pending.setdefault(table_name, set()).add(column_name)
+            if self.rebuild_thread is None:
+                self.rebuild_thread = threading.Thread(target=self._rebuild_pending, daemon=True)
+                self.rebuild_thread.start()
+
+    def wait_for_rebuilds(self, timeout=None):
+        """Block until the indexes scheduled for a rebuild are usable, returns False on timeout"""
+        thread = self.rebuild_thread
+        if thread is not None:
+            thread.join(timeout)
+        return not any(self.pending.values())
+
+    def _rebuild_pending(self):
+        while True:
+            with self.rebuild_lock:
+                work = [(table_name, column_name) for table_name, columns in self.pending.items() for column_name in columns]
+                if not work:
+                    self.rebuild_thread = None
+                    return
+            for table_name, column_name in work:
+                try:
+                    self._rebuild_index(table_name, column_name)
+                except Exception as e:
+                    print(f"DEBUG: Rebuilding index on '{table_name}.{column_name}' failed: {str(e)}")
+                    self._discard_pending(table_name, column_name)
+
+    def _rebuild_index(self, table_name, column_name):
+        """Build an index from a copy of the records, installing it only if the table did not change meanwhile"""
+        self.db.ensure_loaded(table_name)
+        transaction_lock = self.db.transaction_manager.transaction_lock
+        for attempt in range(self.REBUILD_ATTEMPTS + 1):
+            with transaction_lock:
+                table = self.db.tables.get(table_name)
+                if column_name not in self.pending.get(table_name, ()):
+                    return  # Dropped meanwhile
+                if table is None or not self._has_columns(table, column_name):
+                    self._discard_pending(table_name, column_name)
+                    return
+                version = table.get("version", 0)
+                records = table["records"]
+                if attempt == self.REBUILD_ATTEMPTS:
+                    # The table keeps changing, build under the lock so that nothing can change it
+                    self._install_index(table_name, column_name, self._build_index(records, column_name))
+                    return
+                # Records are replaced rather than edited, so a shallow copy (or a fork of the pages or runs) is stable
+                records = copy.deepcopy(records) if isinstance(records, (PagedRecords, LSMRecords)) else dict(records)
+            index = self._build_index(records, column_name)
+            with transaction_lock:
+                if self.db.tables.get(table_name) is table and table.get("version", 0) == version and \
+                        column_name in self.pending.get(table_name, ()):
+                    self._install_index(table_name, column_name, index)
+                    return
+
+    def _build_index(self, records, column_name):
+        index = {}
+        for key, record in records.items():
+            value = self.index_value(column_name, record)
+            if value is not self.NO_VALUE:
+                index.setdefault(value, []).append(key)
+        return OrderedIndex(index)
+
+    def _install_index(self, table_name, column_name, index):
+        self.indexes.setdefault(table_name, {})[column_name] = index
+        self._discard_pending(table_name, column_name)
+        print(f"DEBUG: Rebuilt index on '{table_name}.{column_name}'")
+
+    def _discard_pending(self, table_name, column_name):
+        with self.rebuild_lock:
+            columns = self.pending.get(table_name, set())
+            columns.discard(column_name)
+            if not columns:
+                self.pending.pop(table_name, None)
+
     def create_index(self, table_name, column_name, transaction_id=None):
-        """Create an index on the specified column of the table"""
+        """Create an index on the specified column of the table, or a composite one on a list of columns"""
         print(f"DEBUG: Starting create_index for {table_name}.{column_name}")
 
         # Standardize input
         table_name = table_name.strip().lower()
-        column_name = column_name.strip().lower()
+        column_name = self.index_name(column_name)
         
         try:
             # Handle implicit transactions if needed
             implicit_transaction = False
             if transaction_id is None:
                 print("DEBUG: Creating implicit transaction")
-                # Corrected transaction_id handling
-                raw_id = self.transaction_id_input.text().strip() if hasattr(self, 'transaction_id_input') else None
-                transaction_id = raw_id if raw_id else None
-
-                self.db.transaction_manager.begin_transaction(transaction_id)
+                transaction_id = self.db._get_implicit_transaction_id()
+                self.db.transaction_manager.begin_transaction(transaction_id, autocommit=True)
                 implicit_transaction = True
             elif not self.db.transaction_manager.is_transaction_active(transaction_id):
                 print(f"DEBUG: Transaction {transaction_id} is not active")
                 return f"Transaction {transaction_id} is not active!"
                 
-            # Acquire read lock on table
-            lock_acquired = self.db.transaction_manager.acquire_lock(transaction_id, table_name, "schema", 'read')
+            # Acquire write lock on table, the index is built from a stable set of records
+            lock_acquired = self.db._lock_table(transaction_id, table_name)
             print(f"DEBUG: Lock acquisition result: {lock_acquired}")
             
             if not lock_acquired:
                 print(f"DEBUG: Failed to acquire lock for {table_name}")
                 if implicit_transaction:
                     self.db.transaction_manager.rollback_transaction(transaction_id)
-                return f"Could not acquire lock for {table_name}. Try again later."
+                return self.db._lock_failure(transaction_id, f"{table_name}")
                     
             # Check if table exists
             if table_name not in self.db.tables:
@@ -1275,39 +3887,33 @@ class Indexer:
                     self.db.transaction_manager.rollback_transaction(transaction_id)
                 return f"Table '{table_name}' does not exist!"
                 
-            # Check if column exists
-            if column_name not in self.db.tables[table_name]["columns"]:
-                print(f"DEBUG: Column '{column_name}' not found in table columns: {list(self.db.tables[table_name]['columns'].keys())}")
+            # Check if the columns exist
+            missing = [column for column in self.key_columns(column_name) if column not in self.db.tables[table_name]["columns"]]
+            if missing:
+                print(f"DEBUG: Column '{missing[0]}' not found in table columns: {list(self.db.tables[table_name]['columns'].keys())}")
                 if implicit_transaction:
                     self.db.transaction_manager.rollback_transaction(transaction_id)
-                return f"Column '{column_name}' does not exist in table '{table_name}'!"
+                return f"Column '{missing[0]}' does not exist in table '{table_name}'!"
                 
+            # A lazily loaded table brings its stored indexes along when it is materialized
+            self.db.ensure_loaded(table_name)
+
             # Initialize index structure if it doesn't exist
             if table_name not in self.indexes:
                 self.indexes[table_name] = {}
                 print(f"DEBUG: Created table entry in indexes: {table_name}")
                 
-            if column_name in self.indexes[table_name]:
+            if column_name in self.index_columns(table_name):
                 print(f"DEBUG: Index already exists on '{table_name}.{column_name}'")
                 if implicit_transaction:
                     self.db.transaction_manager.rollback_transaction(transaction_id)
                 return f"Index on '{table_name}.{column_name}' already exists!"
                 
-            # Create the index
-            self.indexes[table_name][column_name] = {}
-            print(f"DEBUG: Index structure initialized for {table_name}.{column_name}")
-
-            # Populate the index with existing data
-            record_count = 0
-            for key, record in self.db.tables[table_name]["records"].items():
-                if column_name in record:
-                    value = record[column_name]
-                    if value not in self.indexes[table_name][column_name]:
-                        self.indexes[table_name][column_name][value] = []
-                    self.indexes[table_name][column_name][value].append(key)
-                    record_count += 1
-            
-            print(f"DEBUG: Populated index with {record_count} records")
+            # Create the index from the existing data, sorting its values once
+            self.db.transaction_manager.log_table_undo(transaction_id, table_name)
+            index = self._build_index(self.db.tables[table_name]["records"], column_name)
+            self.indexes[table_name][column_name] = index
+            print(f"DEBUG: Populated index with {sum(len(keys) for keys in index.values())} records")
             print(f"DEBUG: Current indexes: {self.indexes}")
 
             # Log the operation
@@ -1342,7 +3948,7 @@ class Indexer:
         
         # Standardize input
         table_name = table_name.strip().lower()
-        column_name = column_name.strip().lower()
+        column_name = self.index_name(column_name)
         
         try:
             # Handle implicit transactions if needed
@@ -1350,29 +3956,47 @@ class Indexer:
             if transaction_id is None:
                 print("DEBUG: Creating implicit transaction for drop_index")
                 transaction_id = self.db._get_implicit_transaction_id()
-                self.db.transaction_manager.begin_transaction(transaction_id)
+                self.db.transaction_manager.begin_transaction(transaction_id, autocommit=True)
                 implicit_transaction = True
             elif not self.db.transaction_manager.is_transaction_active(transaction_id):
                 print(f"DEBUG: Transaction {transaction_id} is not active")
                 return f"Transaction {transaction_id} is not active!"
+
+            # Acquire write lock on table
+            if not self.db._lock_table(transaction_id, table_name):
+                print(f"DEBUG: Failed to acquire lock for {table_name}")
+                if implicit_transaction:
+                    self.db.transaction_manager.rollback_transaction(transaction_id)
+                return self.db._lock_failure(transaction_id, f"{table_name}")
                 
+            self.db.ensure_loaded(table_name)
+
             # Check if index exists
-            if (table_name not in self.indexes or 
-                column_name not in self.indexes[table_name]):
+            if column_name not in self.index_columns(table_name):
                 print(f"DEBUG: Index on '{table_name}.{column_name}' does not exist")
                 print(f"DEBUG: Current indexes: {self.indexes}")
                 if implicit_transaction:
                     self.db.transaction_manager.rollback_transaction(transaction_id)
                 return f"Index on '{table_name}.{column_name}' does not exist!"
+
+            if column_name in self.db._constraint_columns(table_name):
+                if implicit_transaction:
+                    self.db.transaction_manager.rollback_transaction(transaction_id)
+                return f"Index on '{table_name}.{column_name}' backs a constraint and cannot be dropped!"
                 
-            # Drop the index
-            del self.indexes[table_name][column_name]
-            print(f"DEBUG: Index removed for {table_name}.{column_name}")
-            
-            # If no more indexes for this table, remove the table entry
-            if not self.indexes[table_name]:
-                del self.indexes[table_name]
-                print(f"DEBUG: Removed empty table entry for {table_name}")
+            self.db.transaction_manager.log_table_undo(transaction_id, table_name)
+            if column_name in self.pending.get(table_name, ()):
+                # Not built yet, dropping it only cancels the rebuild
+                self._discard_pending(table_name, column_name)
+            else:
+                # Drop the index
+                del self.indexes[table_name][column_name]
+                print(f"DEBUG: Index removed for {table_name}.{column_name}")
+
+                # If no more indexes for this table, remove the table entry
+                if not self.indexes[table_name]:
+                    del self.indexes[table_name]
+                    print(f"DEBUG: Removed empty table entry for {table_name}")
                 
             # Log the operation
             self.db.transaction_manager.log_operation(transaction_id, 'drop_index', table_name, column_name)
@@ -1400,40 +4024,42 @@ class Indexer:
                     
             return f"Error dropping index: {str(e)}"
         
-    def update_index(self, table_name, column_name, key, old_value, new_value):
-        """Update an index when a record is updated"""
-        if (table_name not in self.indexes or 
-            column_name not in self.indexes[table_name]):
-            return  # No index to update
-            
-        # Remove the old value
-        if old_value in self.indexes[table_name][column_name]:
-            if key in self.indexes[table_name][column_name][old_value]:
-                self.indexes[table_name][column_name][old_value].remove(key)
-                
-            # Clean up empty lists
-            if not self.indexes[table_name][column_name][old_value]:
-                del self.indexes[table_name][column_name][old_value]
-                
-        # Add the new value
-        if new_value not in self.indexes[table_name][column_name]:
-            self.indexes[table_name][column_name][new_value] = []
-        self.indexes[table_name][column_name][new_value].append(key)
-        
+    def forget_indexes(self, table_name, column_name=None):
+        """Remove the indexes of a dropped table, or the ones that include a dropped column"""
+        columns = self.indexes.get(table_name, {})
+        for name in [name for name in self.index_columns(table_name)
+                     if column_name is None or column_name in self.key_columns(name)]:
+            columns.pop(name, None)
+            self._discard_pending(table_name, name)
+        if not columns:
+            self.indexes.pop(table_name, None)
+
+    def clear_indexes(self, table_name):
+        """Empty the indexes of a table whose records were all deleted"""
+        if table_name in self.indexes:
+            # New dicts rather than clearing, a rollback puts the old ones back
+            self.indexes[table_name] = {column_name: OrderedIndex() for column_name in self.indexes[table_name]}
+
+    def update_indexes(self, table_name, key, old_record, new_record):
+        """Move a record within every index whose value it changes, single-column and composite"""
+        for name, index in list(self.indexes.get(table_name, {}).items()):
+            old_value = self.index_value(name, old_record)
+            new_value = self.index_value(name, new_record)
+            if old_value != new_value:
+                if old_value is not self.NO_VALUE:
+                    index.discard(old_value, key)
+                if new_value is not self.NO_VALUE:
+                    index.add(new_value, key)
+
     def delete_from_index(self, table_name, key, record):
         """Remove a record from all indexes when it's deleted"""
         if table_name not in self.indexes:
             return  # No indexes for this table
             
         for column_name, index in self.indexes[table_name].items():
-            if column_name in record:
-                value = record[column_name]
-                if value in index and key in index[value]:
-                    index[value].remove(key)
-                    
-                    # Clean up empty lists
-                    if not index[value]:
-                        del index[value]
+            value = self.index_value(column_name, record)
+            if value is not self.NO_VALUE:
+                index.discard(value, key)
                         
     def add_to_index(self, table_name, key, record):
         """Add a record to all indexes when it's inserted"""
@@ -1441,12 +4067,28 @@ class Indexer:
             return  # No indexes for this table
             
         for column_name, index in self.indexes[table_name].items():
-            if column_name in record:
-                value = record[column_name]
-                if value not in index:
-                    index[value] = []
-                index[value].append(key)
+            value = self.index_value(column_name, record)
+            if value is not self.NO_VALUE:
+                index.add(value, key)
                 
+    def typed_value(self, table, column_name, value):
+        """Convert a value given as a string to its column's type in table, raises ValueError if it does not parse
+
+        table is the schema the caller reads, e.g. the one a snapshot sees, which can differ from self.db.tables.
+        """
+        if isinstance(value, (list, tuple)):
+                return type(value)(self.typed_value(table, column_name, bound) for bound in value)
+        if table is None or column_name not in table["columns"] or not isinstance(value, str):
+                return value
+        col_type = table["columns"][column_name]["type"]
+        if col_type == "int":
+                return int(value)
+        if col_type == "float":
+                return float(value)
+        if col_type == "datetime":
+                return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        return value
+
     def get_keys_by_value(self, table_name, column_name, value, operator="="):
         """Get all keys that match a value using the index"""
         if (table_name not in self.indexes or 
@@ -1456,52 +4098,110 @@ class Indexer:
         index = self.indexes[table_name][column_name]
 
         # Convert value to the appropriate type based on the column type
-        if table_name in self.db.tables and column_name in self.db.tables[table_name]["columns"]:
-                col_type = self.db.tables[table_name]["columns"][column_name]["type"]
-                if col_type == "int" and isinstance(value, str):
-                        try:
-                                value = int(value)
-                        except ValueError:
-                                return []  # Invalid integer value
-                elif col_type == "float" and isinstance(value, str):
-                        try:
-                                value = float(value)
-                        except ValueError:
-                                return []  # Invalid float value
+        try:
+                value = self.typed_value(self.db.tables.get(table_name), column_name, value)
+        except ValueError:
+                return []  # Not a valid value of the column's type
 
+        # Copies, writers change the index while snapshot readers use it
         if operator == "=":
-                return index.get(value, [])
+                return list(index.get(value, []))
 
-        # For other operators, we need to scan the index
-        result = []
-        for idx_value, keys in index.items():
-                # Ensure both values are of the same type for comparison
-                if isinstance(idx_value, (int, float)) and isinstance(value, str):
-                        try:
-                                compare_value = type(idx_value)(value)
-                        except ValueError:
-                                continue  # Skip if conversion fails
-                elif isinstance(idx_value, str) and isinstance(value, (int, float)):
-                        try:
-                                compare_value = value
-                                idx_value = type(value)(idx_value)
-                        except ValueError:
-                                continue  # Skip if conversion fails
+        # Other operators seek to their bounds in the sorted values, rows come out in value order
+        try:
+                if operator == "<>":
+                        return list(index.keys_between(None, value, True, False)) + \
+                               list(index.keys_between(value, None, False, True))
+                if operator in self.RANGE_OPERATORS:
+                        return list(index.keys_between(*self._range_bounds(operator, value)))
+        except TypeError:
+                return []  # A value that cannot be compared with the column's values matches nothing
+        return None  # Unknown operator, let the scan report it
+
+    def _range_bounds(self, operator, value):
+        """(low, high, include_low, include_high) for keys_between"""
+        if operator == "BETWEEN":
+                return value[0], value[1], True, True
+        return {
+                ">": (value, None, False, True),
+                ">=": (value, None, True, True),
+                "<": (None, value, True, False),
+                "<=": (None, value, True, True),
+        }[operator]
+
+    def find_keys(self, table_name, conditions):
+        """Candidate keys for (column, operator, typed value) conditions that must all hold, from the best index
+
+        An index helps with equalities on its leading columns followed by at most one range on the next
+        column; the one covering the most columns that way wins. Returns (keys in index order, index name),
+        or None if no index helps. The keys still have to be checked against all the conditions.
+        """
+        equal = {name: value for name, operator, value in conditions if operator == "="}
+        ranges = {name: (operator, value) for name, operator, value in conditions if operator in self.RANGE_OPERATORS}
+        best, best_score = None, (0, False)
+        for index_name in list(self.indexes.get(table_name, {})):
+                columns = self.key_columns(index_name)
+                prefix = 0
+                while prefix < len(columns) and columns[prefix] in equal:
+                        prefix += 1
+                score = (prefix, prefix < len(columns) and columns[prefix] in ranges)
+                if score > best_score:
+                        best, best_score = index_name, score
+        index = self.indexes.get(table_name, {}).get(best)
+        if index is None:
+                return None
+
+        columns = self.key_columns(best)
+        prefix = tuple(equal[column] for column in columns[:best_score[0]])
+        operator, value = ranges[columns[len(prefix)]] if best_score[1] else (None, None)
+        try:
+                if len(columns) > 1:
+                        keys = list(self._prefix_keys(index, prefix, operator, value))
+                elif operator is None:
+                        keys = list(index.get(prefix[0], []))
                 else:
-                        compare_value = value
-
-                if operator == ">" and idx_value > compare_value:
-                        result.extend(keys)
-                elif operator == "<" and idx_value < compare_value:
-                        result.extend(keys)
-                elif operator == ">=" and idx_value >= compare_value:
-                        result.extend(keys)
-                elif operator == "<=" and idx_value <= compare_value:
-                        result.extend(keys)
-                elif operator == "<>" and idx_value != compare_value:
-                        result.extend(keys)
-
-        return result
+                        keys = list(index.keys_between(*self._range_bounds(operator, value)))
+        except TypeError:
+                keys = []  # Values that cannot be compared with the columns' values match nothing
+        return keys, best
+
+    def _prefix_keys(self, index, prefix, operator=None, value=None):
+        """Keys of a composite index whose values start with prefix, with a range on the column after it"""
+        size = len(prefix)
+        low = prefix
+        if operator in (">", ">="):
+                low = prefix + (value,)
+        elif operator == "BETWEEN":
+                low = prefix + (value[0],)
+        for entry in index.values_between(low or None):
+                if entry[:size] != prefix:
+                        return
+                if operator is not None:
+                        part = entry[size]
+                        if operator == ">" and part == value:
+                                continue
+                        if (operator == "<" and part >= value) or (operator == "<=" and part > value) or \
+                                        (operator == "BETWEEN" and part > value[1]):
+                                return
+                yield from list(index.get(entry, ()))
+
+def convert_database(file_name="database.json", record_format="binary"):
+    """Rewrite an existing database in another record format, e.g. to migrate database.json to binary"""
+    if record_format not in {"json", "binary"}:
+        return f"Unknown record format '{record_format}', expected 'json' or 'binary'."
+    wal_mode = os.path.exists(file_name + ".wal")
+    if not os.path.exists(file_name) and not wal_mode:
+        return f"Database file '{file_name}' does not exist."
+    storage_layout = "segmented" if os.path.isdir(file_name + ".segments") else "single"
+    # Open with the WAL if there is one, so that the converted snapshot includes its transactions
+    db = Database(file_name, wal_mode=wal_mode, checkpoint_interval=0,
+                  storage_layout=storage_layout, record_format=record_format)
+    try:
+        if not db.save_to_file():
+            return f"Error converting '{file_name}'."
+    finally:
+        db.close()
+    return f"Database '{file_name}' converted to the {record_format} record format."
 
 # db =Database("custom_db.json")
 # db.create_table("students", columns=["id int", "name string"], constraints={"id": ["primary_key"]})
@@ -1696,4 +4396,8 @@ class Indexer:
 # result = db.select_where("students", "grade", "=", "3.7")
 # print(f"Students with grade = 3.7 after delete: {result}")
 
-# print("\nIndexer test completed successfully!")
\ No newline at end of file
+# print("\nIndexer test completed successfully!")
+
+if __name__ == "__main__":
+    # python oldengine.py [file_name] [json|binary]
+    print(convert_database(*sys.argv[1:3]))
@@ -6,6 +6,13 @@ from oldengine import Database
 import json
 from PyQt5.QtGui import QIcon
 
+# One WHERE condition: column, operator, value, or column, BETWEEN low AND high
+CONDITION = r"(\w+)\s*(?:(>=|<=|<>|=|>|<)\s*(\d+|\"[^\"]*\")|\s+BETWEEN\s+(\d+|\"[^\"]*\")\s+AND\s+(\d+|\"[^\"]*\"))"
+
+def parse_value(value):
+    """Number or quoted string of a query, as the engine expects it"""
+    return int(value) if value.isdigit() else value[1:-1]
+
 class StorageSQLUI(QWidget):
     def __init__(self):
         super().__init__()
@@ -236,7 +243,7 @@ class StorageSQLUI(QWidget):
         help_text.setReadOnly(True)
         help_text.setHtml("""
         <ul style="padding-left:20px; font-size:14px;">
-            <li><span style="font-weight:bold;">CREATE TABLE:</span> CREATE TABLE students (id INT, name TEXT, age INT) CONSTRAINTS (id PRIMARY_KEY)</li>
+            <li><span style="font-weight:bold;">CREATE TABLE:</span> CREATE TABLE students (id INT, name TEXT, age INT, class_id INT) CONSTRAINTS (id PRIMARY_KEY, class_id FOREIGN_KEY classes.id CASCADE)</li>
             <li><span style="font-weight:bold;">INSERT:</span> INSERT INTO students VALUES (1, 'Alice', 21)</li>
             <li><span style="font-weight:bold;">SELECT:</span> SELECT * FROM students WHERE id = 1</li>
             <li><span style="font-weight:bold;">UPDATE:</span> UPDATE students SET name = 'Bob' WHERE id = 1</li>
@@ -401,10 +408,17 @@ class StorageSQLUI(QWidget):
         count_match = re.match(r"^COUNT (\w+)$", query, re.IGNORECASE)
         select_columns_match = re.match(r"^SELECT (.+) FROM (\w+) WHERE id=(\d+)$", query, re.IGNORECASE)
         select_where_match = re.match(r"^SELECT \* FROM (\w+) WHERE (\w+)\s*(=|>|<|>=|<=|<>)\s*(\d+|\"[^\"]*\")$", query, re.IGNORECASE)
+        select_between_match = re.match(r"^SELECT \* FROM (\w+) WHERE (\w+) BETWEEN (\d+|\"[^\"]*\") AND (\d+|\"[^\"]*\")$", query, re.IGNORECASE)
+        select_conditions_match = re.match(r"^SELECT \* FROM (\w+) WHERE (%s(?:\s+AND\s+%s)+)$" % (CONDITION, CONDITION), query, re.IGNORECASE)
+        create_index_match = re.match(r"^CREATE INDEX(?: \w+)? ON (\w+)\s*\(([\w\s,]+)\)$", query, re.IGNORECASE)
+        drop_index_match = re.match(r"^DROP INDEX ON (\w+)\s*\(([\w\s,]+)\)$", query, re.IGNORECASE)
         group_by_match = re.match(r"^SELECT (\w+), COUNT\(\*\) FROM (\w+) GROUP BY (\w+)$", query, re.IGNORECASE)
         having_match = re.match(r"^SELECT (\w+), COUNT\(\*\) FROM (\w+) GROUP BY (\w+) HAVING COUNT\(\*\)\s*(=|>|<|>=|<=|<>)\s*(\d+)$", query, re.IGNORECASE)
         distinct_match = re.match(r"^SELECT DISTINCT (\w+) FROM (\w+)$", query, re.IGNORECASE)
         alter_drop_column_match = re.match(r"^ALTER TABLE (\w+) DROP COLUMN (\w+)$", query, re.IGNORECASE)
+        savepoint_match = re.match(r"^SAVEPOINT (\w+)$", query, re.IGNORECASE)
+        rollback_to_match = re.match(r"^ROLLBACK TO (?:SAVEPOINT )?(\w+)$", query, re.IGNORECASE)
+        release_match = re.match(r"^RELEASE (?:SAVEPOINT )?(\w+)$", query, re.IGNORECASE)
 
         if create_match:
                 table_name, columns, constraints = create_match.groups()
@@ -412,8 +426,9 @@ class StorageSQLUI(QWidget):
                 constraints_dict = {}
                 for constraint in constraints.split(","):
                         parts = constraint.strip().split()
-                        if len(parts) == 2:
-                                constraints_dict[parts[0]] = [parts[1]]
+                        # e.g. "id PRIMARY_KEY" or "class_id FOREIGN_KEY classes.id CASCADE"
+                        if len(parts) >= 2:
+                                constraints_dict[parts[0].lower()] = [part.lower() for part in parts[1:]]
                 result = self.engine.create_table(table_name, columns_list, constraints_dict, transaction_id)
 
         elif insert_match:
@@ -467,6 +482,30 @@ class StorageSQLUI(QWidget):
                         value = value[1:-1]
                 result = self.engine.select_where(table_name, column, operator, value, transaction_id)
 
+        elif select_between_match:
+                table_name, column, low, high = select_between_match.groups()
+                bounds = [int(bound) if bound.isdigit() else bound[1:-1] for bound in (low, high)]
+                result = self.engine.select_where(table_name, column, "BETWEEN", bounds, transaction_id)
+
+        elif select_conditions_match:
+                # Conditions joined by AND, the engine picks an index covering as many of them as it can
+                table_name, text = select_conditions_match.group(1), select_conditions_match.group(2)  # CONDITION has groups of its own
+                conditions = []
+                for column, operator, value, low, high in re.findall(CONDITION, text, re.IGNORECASE):
+                        if operator:
+                                conditions.append((column, operator, parse_value(value)))
+                        else:
+                                conditions.append((column, "BETWEEN", [parse_value(low), parse_value(high)]))
+                result = self.engine.select_where(table_name, conditions, transaction_id=transaction_id)
+
+        elif create_index_match:
+                table_name, columns = create_index_match.groups()
+                result = self.engine.create_index(table_name, columns, transaction_id)
+
+        elif drop_index_match:
+                table_name, columns = drop_index_match.groups()
+                result = self.engine.drop_index(table_name, columns, transaction_id)
+
         elif select_all_match:
                 table_name = select_all_match.group(1)
                 result = self.engine.select_all(table_name, transaction_id)
@@ -498,6 +537,16 @@ class StorageSQLUI(QWidget):
         elif alter_drop_column_match:
                 table_name, column_name = alter_drop_column_match.groups()
                 result = self.engine.drop_column(table_name, column_name, transaction_id)
+
+        elif savepoint_match or rollback_to_match or release_match:
+                if transaction_id is None:
+                        result = "Savepoints need an active transaction, execute them in the Transaction tab."
+                elif savepoint_match:
+                        result = self.engine.savepoint(transaction_id, savepoint_match.group(1))
+                elif rollback_to_match:
+                        result = self.engine.rollback_to_savepoint(transaction_id, rollback_to_match.group(1))
+                else:
+                        result = self.engine.release_savepoint(transaction_id, release_match.group(1))
         
         return result
     
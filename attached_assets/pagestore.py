@@ -0,0 +1,384 @@
+import os
+import json
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping, ItemsView, ValuesView
+
+class BufferPool:
+    """LRU cache of pages shared by all page files of a database; dirty pages are written back on eviction"""
+    def __init__(self, capacity=1024):
+        self.capacity = max(1, capacity)
+        self.pages = OrderedDict()  # (page_file, page_id) -> [data, dirty]
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+
+    def read(self, page_file, page_id):
+        key = (page_file, page_id)
+        with self.lock:
+            entry = self.pages.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.pages.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+            data = page_file.read_page(page_id)
+            self.pages[key] = [data, False]
+            self._evict()
+            return data
+
+    def write(self, page_file, page_id, data):
+        """Cache a page's new contents; it reaches the file on eviction or flush"""
+        key = (page_file, page_id)
+        with self.lock:
+            self.pages[key] = [data, True]
+            self.pages.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self.pages) > self.capacity:
+            (page_file, page_id), (data, dirty) = self.pages.popitem(last=False)
+            self.evictions += 1
+            if dirty:
+                page_file.write_page(page_id, data)
+                self.writes += 1
+
+    def flush(self, page_file):
+        """Write back every dirty page of page_file"""
+        with self.lock:
+            for (owner, page_id), entry in self.pages.items():
+                if owner is page_file and entry[1]:
+                    owner.write_page(page_id, entry[0])
+                    entry[1] = False
+                    self.writes += 1
+
+    def discard(self, page_file, page_ids=None):
+        """Forget cached pages of page_file without writing them, e.g. pages that were freed"""
+        with self.lock:
+            if page_ids is None:
+                keys = [key for key in self.pages if key[0] is page_file]
+            else:
+                keys = [(page_file, page_id) for page_id in page_ids]
+            for key in keys:
+                self.pages.pop(key, None)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "capacity": self.capacity,
+                "cached_pages": len(self.pages),
+                "dirty_pages": sum(1 for entry in self.pages.values() if entry[1]),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "writes": self.writes,
+            }
+
+class PageFile:
+    """One table's fixed-size pages on disk plus the metadata file naming the pages of each hash bucket"""
+    def __init__(self, path, pool, page_size=4096, write_json=None):
+        self.path = path
+        self.meta_path = path + ".meta"
+        self.pool = pool
+        self.page_size = page_size
+        self.write_json = write_json  # Writes the metadata atomically, e.g. Database._atomic_write_json
+        self.lock = threading.RLock()
+        self.io_lock = threading.Lock()  # Only guards seek + read/write, the buffer pool calls in with its own lock held
+        self.instances = weakref.WeakValueDictionary()  # id -> every PagedRecords sharing these pages, e.g. rollback copies
+        self.free_pages = []
+        # Pages allocated since the last copy or capture; only the live PagedRecords can refer to them,
+        # so they are freed as soon as it replaces them instead of at the next flush
+        self.private_pages = set()
+        self.page_count = 0
+        self.meta = None
+        self.file = None
+        # Recently decoded buckets by page chain; a chain's pages never change until they are freed
+        self.decoded = OrderedDict()
+
+    def open(self, create=False):
+        """Open the page file, returns the stored bucket state or None for a new, empty file"""
+        if not create and os.path.exists(self.meta_path) and os.path.exists(self.path):
+            with open(self.meta_path, 'r') as file:
+                self.meta = json.load(file)
+            self.page_size = self.meta["page_size"]
+            self.page_count = self.meta["page_count"]
+            self.file = open(self.path, 'r+b')
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.meta = None
+            self.page_count = 0
+            self.file = open(self.path, 'w+b')
+        return self.meta
+
+    def read_page(self, page_id):
+        with self.io_lock:
+            self.file.seek(page_id * self.page_size)
+            return self.file.read(self.page_size)
+
+    def write_page(self, page_id, data):
+        with self.io_lock:
+            self.file.seek(page_id * self.page_size)
+            self.file.write(data.ljust(self.page_size, b"\0"))
+
+    def allocate(self):
+        with self.lock:
+            if self.free_pages:
+                page_id = self.free_pages.pop()
+            else:
+                self.page_count += 1
+                page_id = self.page_count - 1
+            self.private_pages.add(page_id)
+            return page_id
+
+    def release(self, chain):
+        """Free the pages of a replaced bucket chain that nothing else can refer to"""
+        with self.lock:
+            page_ids = [page_id for page_id in chain[1:] if page_id in self.private_pages]
+            if not page_ids:
+                return
+            self.decoded.pop(chain, None)
+            self.private_pages.difference_update(page_ids)
+            self.pool.discard(self, set(page_ids))
+            self.free_pages.extend(page_ids)
+
+    def share(self):
+        """Called when the bucket directory is copied, from now on every page may be referred to twice"""
+        with self.lock:
+            self.private_pages.clear()
+
+    def flush(self, state, lsn=0):
+        """Make a captured bucket state durable: write back dirty pages, fsync, then replace the metadata"""
+        with self.lock:
+            self.pool.flush(self)
+            with self.io_lock:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            meta = dict(state, lsn=lsn, page_size=self.page_size, page_count=self.page_count)
+            self.write_json(self.meta_path, meta)
+            self.meta = meta
+            self.collect_garbage()
+
+    def collect_garbage(self):
+        """Free the pages that neither the durable metadata nor any live PagedRecords refers to"""
+        with self.lock:
+            directories = [instance.directory for instance in list(self.instances.values())]
+            if self.meta is not None:
+                directories.append(self.meta["directory"])
+            referenced = set()
+            for directory in directories:
+                for chain in directory:
+                    referenced.update(chain[1:])
+            free_pages = [page_id for page_id in range(self.page_count) if page_id not in referenced]
+            self.pool.discard(self, set(free_pages))
+            self.decoded.clear()  # Freed pages get reused, so a chain may name different data from now on
+            self.private_pages.intersection_update(referenced)
+            # Give free pages at the end of the file back to the file system
+            while free_pages and free_pages[-1] == self.page_count - 1:
+                free_pages.pop()
+                self.page_count -= 1
+            with self.io_lock:
+                self.file.truncate(self.page_count * self.page_size)
+            self.free_pages = free_pages[::-1]  # allocate() pops the lowest page first
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.pool.discard(self)
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class PagedRecords(MutableMapping):
+    """Records of one table kept in a linear hash table of page chains, read through the buffer pool.
+
+    Pages are never rewritten in place: changing a bucket writes it to new pages, so a copy made for
+    rollback or a snapshot only has to copy the bucket directory.
+    """
+    INITIAL_BUCKETS = 4
+    DECODED_BUCKETS = 16  # Decoded buckets kept per page file, saves decoding a bucket twice in one insert
+    FILL_FACTOR = 0.75  # Split a bucket once the table would fill its buckets' first pages this much
+
+    def __init__(self, page_file, encode, decode, state=None):
+        self.page_file = page_file
+        self.encode = encode  # {key: record} -> bytes
+        self.decode = decode  # bytes -> {key: record}
+        if state is None:
+            state = {"level": 0, "split": 0, "count": 0, "record_size": 64.0,
+                     "directory": [[0]] * self.INITIAL_BUCKETS}
+        self.level = state["level"]
+        self.split = state["split"]
+        self.count = state["count"]
+        self.record_size = state["record_size"]
+        self.directory = [tuple(chain) for chain in state["directory"]]  # Per bucket: (byte length, page ids...)
+        page_file.instances[id(self)] = self
+
+    @property
+    def store(self):
+        return self.page_file
+
+    def capture(self):
+        """Bucket state for PageFile.flush; pages are copy-on-write so the directory is all that is copied"""
+        with self.page_file.lock:
+            self.page_file.share()
+            return {"level": self.level, "split": self.split, "count": self.count,
+                    "record_size": self.record_size, "directory": list(self.directory)}
+
+    def __deepcopy__(self, memo):
+        return PagedRecords(self.page_file, self.encode, self.decode, self.capture())
+
+    def __repr__(self):
+        return f"<PagedRecords {self.count} records in {self.page_file.path}>"
+
+    def _bucket_of(self, key):
+        hashed = zlib.crc32(str(key).encode("utf-8", "surrogatepass"))
+        buckets = self.INITIAL_BUCKETS << self.level
+        bucket = hashed % buckets
+        if bucket < self.split:
+            bucket = hashed % (buckets << 1)  # Already split in this round
+        return bucket
+
+    def _read_bucket(self, bucket):
+        """Decoded records of a bucket; callers must copy the dict before changing it"""
+        chain = self.directory[bucket]
+        if not chain[0]:
+            return {}
+        decoded = self.page_file.decoded
+        entries = decoded.get(chain)
+        if entries is not None:
+            decoded.move_to_end(chain)
+            return entries
+        pool = self.page_file.pool
+        data = b"".join(pool.read(self.page_file, page_id) for page_id in chain[1:])
+        entries = self.decode(data[:chain[0]])
+        decoded[chain] = entries
+        if len(decoded) > self.DECODED_BUCKETS:
+            decoded.popitem(last=False)
+        return entries
+
+    def _write_bucket(self, bucket, entries):
+        data = self.encode(entries) if entries else b""
+        page_size = self.page_file.page_size
+        page_ids = []
+        for start in range(0, len(data), page_size):
+            page_id = self.page_file.allocate()
+            self.page_file.pool.write(self.page_file, page_id, data[start:start + page_size])
+            page_ids.append(page_id)
+        self.page_file.release(self.directory[bucket])
+        self.directory[bucket] = (len(data), *page_ids)
+        if entries:
+            self.record_size = 0.9 * self.record_size + 0.1 * (len(data) / len(entries))
+
+    def _maybe_split(self):
+        records_per_bucket = max(1.0, self.page_file.page_size * self.FILL_FACTOR / self.record_size)
+        if self.count > len(self.directory) * records_per_bucket:
+            self._split()
+
+    def _split(self):
+        """Split the bucket at the split pointer into itself and one new bucket at the end"""
+        buckets = self.INITIAL_BUCKETS << self.level
+        entries = self._read_bucket(self.split)
+        stay, move = {}, {}
+        for key, record in entries.items():
+            hashed = zlib.crc32(str(key).encode("utf-8", "surrogatepass"))
+            (stay if hashed % (buckets << 1) == self.split else move)[key] = record
+        self.directory.append((0,))
+        self._write_bucket(self.split, stay)
+        self._write_bucket(len(self.directory) - 1, move)
+        self.split += 1
+        if self.split == buckets:
+            self.level += 1
+            self.split = 0
+
+    def __getitem__(self, key):
+        with self.page_file.lock:
+            return self._read_bucket(self._bucket_of(key))[key]
+
+    def get(self, key, default=None):
+        with self.page_file.lock:
+            return self._read_bucket(self._bucket_of(key)).get(key, default)
+
+    def __contains__(self, key):
+        with self.page_file.lock:
+            return key in self._read_bucket(self._bucket_of(key))
+
+    def __setitem__(self, key, record):
+        with self.page_file.lock:
+            bucket = self._bucket_of(key)
+            entries = dict(self._read_bucket(bucket))
+            added = key not in entries
+            entries[key] = record
+            self._write_bucket(bucket, entries)
+            if added:
+                self.count += 1
+                self._maybe_split()
+
+    def __delitem__(self, key):
+        with self.page_file.lock:
+            bucket = self._bucket_of(key)
+            entries = dict(self._read_bucket(bucket))
+            del entries[key]
+            self._write_bucket(bucket, entries)
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        with self.page_file.lock:
+            self.level = 0
+            self.split = 0
+            self.count = 0
+            self.directory = [(0,)] * self.INITIAL_BUCKETS
+
+    def rewrite(self, function):
+        """Replace every record with function(record), one bucket at a time"""
+        with self.page_file.lock:
+            for bucket in range(len(self.directory)):
+                entries = self._read_bucket(bucket)
+                if entries:
+                    self._write_bucket(bucket, {key: function(record) for key, record in entries.items()})
+
+    def _iter_buckets(self):
+        """Yield each bucket's records; only one bucket is decoded at a time"""
+        bucket = 0
+        while True:
+            with self.page_file.lock:
+                if bucket >= len(self.directory):
+                    return
+                entries = self._read_bucket(bucket)
+            if entries:
+                yield entries
+            bucket += 1
+
+    def __iter__(self):
+        for entries in self._iter_buckets():
+            yield from entries
+
+    def items(self):
+        return PagedItemsView(self)
+
+    def values(self):
+        return PagedValuesView(self)
+
+class PagedItemsView(ItemsView):
+    def __iter__(self):
+        for entries in self._mapping._iter_buckets():
+            yield from entries.items()
+
+class PagedValuesView(ValuesView):
+    def __iter__(self):
+        for entries in self._mapping._iter_buckets():
+            yield from entries.values()
@@ -0,0 +1,761 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from oldengine import Database, RecordCodec, convert_database
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = self.open_database()
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open_database(self, **options):
+        options.setdefault("wal_mode", True)
+        options.setdefault("checkpoint_interval", 0)
+        with contextlib.redirect_stdout(io.StringIO()):  # The engine prints DEBUG lines
+            return Database(os.path.join(self.directory, "test.json"), **options)
+
+    def run_quietly(self, operation, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return operation(*args, **kwargs)
+
+
+class WriteAheadLogTest(EngineTestCase):
+    def test_replay_stops_at_a_torn_last_line_and_later_commits_survive(self):
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.close)
+        with open(self.db.wal.file_name, "a") as wal:
+            wal.write('{"lsn":99,"txn":"x","ops":[["insert",["t","2"')  # A crash in the middle of a write
+
+        self.db = self.open_database()
+        self.assertEqual(sorted(self.db.tables["t"]["records"]), ["1"])
+        self.assertEqual(self.run_quietly(self.db.insert, "t", "3", ["3", "3"]), "Inserted successfully!")
+        self.run_quietly(self.db.close)
+        self.db = self.open_database()
+        self.assertEqual(sorted(self.db.tables["t"]["records"]), ["1", "3"])
+
+
+class GroupCommitTest(EngineTestCase):
+    def test_concurrent_commits_share_one_flush(self):
+        self.run_quietly(self.db.create_table, "t", ["id int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.close)
+        # The first committer waits up to the window for the others, a full batch is flushed at once
+        self.db = self.open_database(group_commit_window=5.0, group_commit_max_batch=4)
+        flushes = self.db.get_commit_stats()["flushes"]
+
+        results = []
+        threads = [threading.Thread(target=lambda key=key: results.append(self.db.insert("t", str(key), [str(key)])))
+                   for key in range(4)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, ["Inserted successfully!"] * 4)
+        stats = self.db.get_commit_stats()
+        self.assertEqual(stats["flushes"] - flushes, 1)
+        self.assertEqual(stats["recent_batch_sizes"][-1], 4)
+        self.run_quietly(self.db.close)
+        self.db = self.open_database()
+        self.assertEqual(len(self.db.tables["t"]["records"]), 4)
+
+
+class CheckpointTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.insert, "t", "2", ["2", "2"])
+        self.run_quietly(self.db.create_index, "t", "v")
+
+    def test_checkpoint_writes_committed_rows_while_a_writer_is_open(self):
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.update, "t", "1", {"v": "100"}, "w")
+        self.run_quietly(self.db.insert, "t", "3", ["3", "3"], "w")
+        self.run_quietly(self.db.delete, "t", "2", "w")
+
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+        self.assertEqual(self.db.wal.size(), 0)
+        self.run_quietly(self.db.close)  # Crash before w commits
+        self.db = self.open_database()
+        self.assertEqual(dict(self.db.tables["t"]["records"]), {"1": {"id": 1, "v": 1}, "2": {"id": 2, "v": 2}})
+        self.assertEqual(self.db.indexer.indexes["t"]["v"], {1: ["1"], 2: ["2"]})
+        self.assertEqual(self.db.indexer.pending, {})  # The stored index matched the stored rows
+
+    def test_uncommitted_table_change_defers_the_checkpoint(self):
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.create_table, "u", ["id int"], {"id": ["primary_key"]}, "w")
+
+        self.assertFalse(self.run_quietly(self.db.checkpoint))
+        self.assertFalse(self.run_quietly(self.db.checkpoint))
+        self.assertEqual(self.db.checkpoint_deferrals, 2)
+        self.run_quietly(self.db.rollback_transaction, "w")
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+        self.assertEqual(self.db.checkpoint_deferrals, 0)
+
+
+class SegmentedLayoutTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(storage_layout="segmented")
+
+    def test_only_dirty_segments_are_rewritten_and_all_tables_reopen(self):
+        for table_name in ("a", "b"):
+            self.run_quietly(self.db.create_table, table_name, ["id int", "v int"], {"id": ["primary_key"]})
+            self.run_quietly(self.db.insert, table_name, "1", ["1", "1"])
+        self.run_quietly(self.db.create_index, "b", "v")
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+        segment_b = os.stat(self.db._segment_path("b")).st_ino  # Rewriting renames a new file over it
+
+        self.run_quietly(self.db.update, "a", "1", {"v": "2"})
+        self.assertEqual(self.db.dirty_tables, {"a"})
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+        self.assertEqual(os.stat(self.db._segment_path("b")).st_ino, segment_b)
+
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(storage_layout="segmented")
+        self.assertEqual(self.db.tables["a"]["records"]["1"]["v"], 2)
+        self.assertEqual(self.db.tables["b"]["records"]["1"]["v"], 1)
+        self.assertEqual(self.db.indexer.indexes["b"]["v"], {1: ["1"]})
+
+
+class LazyLoadTest(EngineTestCase):
+    def fill(self, **options):
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(**options)
+        for table_name in ("a", "b"):
+            self.run_quietly(self.db.create_table, table_name, ["id int", "v int"], {"id": ["primary_key"]})
+            self.run_quietly(self.db.insert, table_name, "1", ["1", "1"])
+        self.run_quietly(self.db.create_index, "a", "v")
+        self.run_quietly(self.db.checkpoint)  # Replaying the WAL would load the tables it touches
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(lazy_load=True, **options)
+
+    def assert_loads_on_first_access(self):
+        self.assertEqual(set(self.db.tables), {"a", "b"})
+        self.assertFalse(self.db.tables["a"].loaded)
+        self.assertEqual(list(self.db.tables["a"]["columns"]), ["id", "v"])
+
+        self.assertEqual(self.run_quietly(self.db.get, "a", "1"), {"id": 1, "v": 1})
+        self.assertTrue(self.db.tables["a"].loaded)
+        self.assertFalse(self.db.tables["b"].loaded)
+        self.assertEqual(self.run_quietly(self.db.select_where, "a", "v", "=", "1"), [{"id": 1, "v": 1}])
+
+    def test_segmented_tables_load_on_first_access(self):
+        self.fill(storage_layout="segmented")
+        self.assert_loads_on_first_access()
+
+    def test_single_file_tables_load_on_first_access(self):
+        self.fill()
+        self.assert_loads_on_first_access()
+
+
+class LoadProgressTest(EngineTestCase):
+    def test_progress_is_reported_while_the_snapshot_loads(self):
+        self.run_quietly(self.db.create_table, "t", ["id int"], {"id": ["primary_key"]})
+        for key in range(5):
+            self.run_quietly(self.db.insert, "t", str(key), [str(key)])
+        self.run_quietly(self.db.checkpoint)
+        self.run_quietly(self.db.close)
+
+        reports = []
+        with mock.patch.object(Database, "LOAD_PROGRESS_EVERY", 2):
+            self.db = self.open_database(load_progress=lambda *report: reports.append(report))
+        self.assertEqual([(table_name, loaded) for _, _, table_name, loaded in reports], [("t", 2), ("t", 4), ("t", 5)])
+        self.assertEqual([bytes_read for bytes_read, _, _, _ in reports], sorted(bytes_read for bytes_read, _, _, _ in reports))
+        self.assertTrue(all(0 < bytes_read <= total_bytes for bytes_read, total_bytes, _, _ in reports))
+        self.assertEqual(len(self.db.tables["t"]["records"]), 5)
+
+
+class BinaryFormatTest(EngineTestCase):
+    def test_every_column_type_and_nulls_survive_conversion_to_binary(self):
+        columns = ["id int", "f float", "b bool", "c char", "s string", "d datetime"]
+        self.run_quietly(self.db.create_table, "t", columns, {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1.5", "true", "x", "a b", "2024-02-29 23:59:59"])
+        self.run_quietly(self.db.insert, "t", "2", ["2", "-2", "false", "y", "", "1969-07-20 20:17:40"])
+        self.run_quietly(self.db.insert, "t", "3", ["3", "0", "true", "z", "c", "2000-01-01 00:00:00"])
+        self.run_quietly(self.db.checkpoint)
+        self.run_quietly(self.db.close)
+        with open(self.db.file_name) as file:  # Older files can hold nulls, which insert never writes
+            data = json.load(file)
+        data["tables"]["t"]["records"]["3"] = {"id": 3, "f": None, "b": None, "c": None, "s": None, "d": None}
+        with open(self.db.file_name, "w") as file:
+            json.dump(data, file)
+        self.db = self.open_database()
+        expected = dict(self.db.tables["t"]["records"])
+        self.run_quietly(self.db.close)
+
+        self.assertIn("converted", self.run_quietly(convert_database, self.db.file_name))
+        with open(self.db.file_name, "rb") as file:
+            self.assertEqual(file.read(len(RecordCodec.MAGIC)), RecordCodec.MAGIC)
+        self.db = self.open_database()
+        self.assertEqual(dict(self.db.tables["t"]["records"]), expected)
+        self.assertEqual(expected["1"]["d"], datetime(2024, 2, 29, 23, 59, 59))
+        self.assertEqual(expected["2"]["f"], -2.0)
+        self.assertIsNone(expected["3"]["d"])
+
+
+class PagedTableTest(EngineTestCase):
+    def test_pages_are_evicted_and_read_back(self):
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(buffer_pool_pages=2, page_size=256)
+        self.run_quietly(self.db.create_table, "t", ["id int", "s string"], {"id": ["primary_key"]}, storage="paged")
+        for key in range(50):
+            self.run_quietly(self.db.insert, "t", str(key), [str(key), f"row {key:x<20}"])
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+        stats = self.db.get_buffer_pool_stats()
+        self.assertGreater(stats["evictions"], 0)
+        self.assertLessEqual(stats["cached_pages"], 2)
+
+        misses = stats["misses"]
+        for key in range(50):
+            self.assertEqual(self.run_quietly(self.db.get, "t", str(key))["s"], f"row {key:x<20}")
+        self.assertGreater(self.db.get_buffer_pool_stats()["misses"], misses)
+        self.assertEqual(len(self.run_quietly(self.db.select_where, "t", "id", ">=", "40")), 10)
+
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(buffer_pool_pages=2, page_size=256)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "49"), {"id": 49, "s": f"row {49:x<20}"})
+
+
+class LSMFlushTest(EngineTestCase):
+    def test_flush_keeps_files_still_being_written(self):
+        self.run_quietly(self.db.create_table, "t", ["id int"], {"id": ["primary_key"]}, storage="lsm")
+        store = self.db.table_stores["t"]
+        name = store._new_file_name("run")  # As compact_once does before it writes the merged run
+        path = os.path.join(store.directory, name)
+        open(path, "wb").close()
+
+        store.flush(self.db.tables["t"]["records"].capture())
+        self.assertTrue(os.path.exists(path))
+        store.release(name)
+        store.flush(self.db.tables["t"]["records"].capture())
+        self.assertFalse(os.path.exists(path))
+
+
+class LSMTableTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(lsm_memtable_limit=4)
+        self.run_quietly(self.db.create_table, "t", ["id int"], {"id": ["primary_key"]}, storage="lsm")
+        for key in range(16):  # Four runs on level 0
+            self.run_quietly(self.db.insert, "t", str(key), [str(key)])
+        for key in range(4):  # A newer run of tombstones
+            self.run_quietly(self.db.delete, "t", str(key))
+        self.records = self.db.tables["t"]["records"]
+
+    def test_bloom_filters_skip_runs_without_the_key(self):
+        skips = self.db.get_lsm_stats("t")["bloom_skips"]
+        self.assertIsNone(self.records.get("missing"))
+        self.assertGreaterEqual(self.db.get_lsm_stats("t")["bloom_skips"] - skips, len(self.records.runs) - 1)
+
+    def test_tombstones_hide_keys_of_older_runs(self):
+        self.assertGreater(len(self.records.runs), 1)
+        for key in range(4):
+            self.assertNotIn(str(key), self.records)
+            self.assertEqual(self.run_quietly(self.db.get, "t", str(key)), "Key not found!")
+        self.assertEqual(self.run_quietly(self.db.get, "t", "4"), {"id": 4})
+        self.assertEqual(len(self.records), 12)
+
+    def test_table_reopens_after_compaction(self):
+        store = self.db.table_stores["t"]
+        while store.compact_once():
+            pass
+        self.assertGreater(self.db.get_lsm_stats("t")["compactions"], 0)
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(lsm_memtable_limit=4)
+        self.assertEqual(sorted(self.db.tables["t"]["records"], key=int), [str(key) for key in range(4, 16)])
+        self.assertEqual(self.run_quietly(self.db.get, "t", "15"), {"id": 15})
+        self.assertEqual(self.run_quietly(self.db.get, "t", "0"), "Key not found!")
+
+
+class StoredIndexTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "5"])
+        self.run_quietly(self.db.insert, "t", "2", ["2", "6"])
+        self.run_quietly(self.db.create_index, "t", "v")
+        self.run_quietly(self.db.checkpoint)
+        self.run_quietly(self.db.close)
+
+    def reopen_with_stored_index(self, change):
+        with open(self.db.file_name) as file:
+            data = json.load(file)
+        change(data["indexes"]["t"]["v"])
+        with open(self.db.file_name, "w") as file:
+            json.dump(data, file)
+        self.db = self.open_database()
+
+    def assert_rebuilt(self):
+        self.assertEqual(self.run_quietly(self.db.select_where, "t", "v", "=", "6"), [{"id": 2, "v": 6}])
+        self.assertTrue(self.db.indexer.wait_for_rebuilds(5))
+        self.assertEqual(self.db.indexer.indexes["t"]["v"], {5: ["1"], 6: ["2"]})
+
+    def test_index_with_a_wrong_checksum_is_rebuilt(self):
+        self.reopen_with_stored_index(lambda stored: stored["entries"][0][1].append("2"))
+        self.assertEqual(self.db.indexer.index_columns("t"), ["v"])  # Whether or not the rebuild is done yet
+        self.assert_rebuilt()
+
+    def test_index_of_an_older_table_version_is_rebuilt(self):
+        self.reopen_with_stored_index(lambda stored: stored.update(table_version=stored["table_version"] - 1))
+        self.assert_rebuilt()
+
+
+class UndoLogTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.insert, "t", "2", ["2", "2"])
+        self.run_quietly(self.db.create_index, "t", "v")
+
+    def test_rollback_undoes_row_changes(self):
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.update, "t", "1", {"v": "10"}, "w")
+        self.run_quietly(self.db.update, "t", "1", {"v": "11"}, "w")
+        self.run_quietly(self.db.delete, "t", "2", "w")
+        self.run_quietly(self.db.insert, "t", "3", ["3", "3"], "w")
+        undo_log = self.db.transaction_manager.undo_logs["w"]
+        self.assertEqual({(entry[0], entry[2]) for entry in undo_log}, {("record", "1"), ("record", "2"), ("record", "3")})
+        self.run_quietly(self.db.rollback_transaction, "w")
+
+        self.assertEqual(dict(self.db.tables["t"]["records"]), {"1": {"id": 1, "v": 1}, "2": {"id": 2, "v": 2}})
+        self.assertEqual(self.db.indexer.indexes["t"]["v"], {1: ["1"], 2: ["2"]})
+        self.assertNotIn("w", self.db.transaction_manager.undo_logs)
+
+    def test_rollback_restores_a_dropped_table_and_removes_a_created_one(self):
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.drop_table, "t", "w")
+        self.run_quietly(self.db.create_table, "u", ["id int"], {"id": ["primary_key"]}, "w")
+        self.run_quietly(self.db.rollback_transaction, "w")
+
+        self.assertNotIn("u", self.db.tables)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "2"), {"id": 2, "v": 2})
+        self.assertEqual(self.db.indexer.indexes["t"]["v"], {1: ["1"], 2: ["2"]})
+
+
+class SnapshotIsolationTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+
+    def test_snapshot_reads_repeat_across_a_concurrent_commit(self):
+        self.run_quietly(self.db.begin_transaction, "r")
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1", "r")["v"], 1)
+        self.assertEqual(self.run_quietly(self.db.update, "t", "1", {"v": "2"}), "Updated successfully!")
+
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1", "r")["v"], 1)
+        self.assertEqual(self.run_quietly(self.db.select_where, "t", "v", "=", "1", "r"), [{"id": 1, "v": 1}])
+        self.run_quietly(self.db.commit_transaction, "r")
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 2)
+
+    def test_writer_reads_its_own_writes_and_readers_do_not_wait_for_it(self):
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.update, "t", "1", {"v": "5"}, "w")
+        self.run_quietly(self.db.insert, "t", "2", ["2", "5"], "w")
+
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1", "w")["v"], 5)
+        self.assertEqual(len(self.run_quietly(self.db.select_where, "t", "v", "=", "5", "w")), 2)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 1)  # Takes no lock, so the write lock is no obstacle
+        self.assertEqual(self.run_quietly(self.db.get, "t", "2"), "Key not found!")
+        self.run_quietly(self.db.commit_transaction, "w")
+        self.assertEqual(self.run_quietly(self.db.get, "t", "2")["v"], 5)
+
+    def test_vacuum_keeps_versions_an_open_snapshot_reads(self):
+        self.run_quietly(self.db.begin_transaction, "r")
+        self.run_quietly(self.db.update, "t", "1", {"v": "2"})
+        self.run_quietly(self.db.update, "t", "1", {"v": "3"})
+        self.run_quietly(self.db.vacuum)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1", "r")["v"], 1)
+
+        self.run_quietly(self.db.commit_transaction, "r")
+        self.run_quietly(self.db.vacuum)
+        self.assertLessEqual(len(self.db.transaction_manager.row_versions.get("t", {}).get("1", [])), 1)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 3)
+
+
+class LockWaitTest(EngineTestCase):
+    def hold_row(self, lock_timeout):
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(lock_timeout=lock_timeout)
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.begin_transaction, "a")
+        self.run_quietly(self.db.update, "t", "1", {"v": "2"}, "a")
+
+    def test_lock_request_times_out(self):
+        self.hold_row(lock_timeout=0.2)
+        self.run_quietly(self.db.begin_transaction, "b")
+        start = time.monotonic()
+        result = self.run_quietly(self.db.update, "t", "1", {"v": "3"}, "b")
+
+        self.assertEqual(result, "Could not acquire lock for t:1. Try again later.")
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(self.db.transaction_manager.get_lock_stats()["waiting"], 0)
+        self.run_quietly(self.db.rollback_transaction, "b")
+        self.run_quietly(self.db.commit_transaction, "a")
+
+    def test_waiter_is_granted_the_lock_when_the_holder_commits(self):
+        self.hold_row(lock_timeout=5.0)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.db.update("t", "1", {"v": "3"})))
+        with contextlib.redirect_stdout(io.StringIO()):
+            waiter.start()
+            while not self.db.transaction_manager.waiting:
+                time.sleep(0.01)
+            self.db.commit_transaction("a")
+            waiter.join(5)
+
+        self.assertEqual(results, ["Updated successfully!"])
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 3)
+
+
+class DeadlockTest(EngineTestCase):
+    def test_victim_is_told_to_retry_and_the_requester_goes_on(self):
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.insert, "t", "2", ["2", "2"])
+        for transaction_id, key in (("a", "1"), ("b", "2")):
+            self.run_quietly(self.db.begin_transaction, transaction_id)
+            self.run_quietly(self.db.update, "t", key, {"v": "10"}, transaction_id)
+
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.db.update("t", "2", {"v": "20"}, "a")))
+        with contextlib.redirect_stdout(io.StringIO()):
+            waiter.start()
+            while "a" not in self.db.transaction_manager.waiting:
+                time.sleep(0.01)
+            # b closes the cycle; both did the same work, so the transaction that was already waiting is the victim
+            self.assertEqual(self.db.update("t", "1", {"v": "20"}, "b"), "Updated successfully!")
+            waiter.join(5)
+
+        self.assertEqual(results, ["Transaction a was rolled back to break a deadlock on t:2. Retry it."])
+        self.assertEqual(self.db.transaction_manager.get_lock_stats()["deadlocks"], 1)
+        self.assertEqual(self.run_quietly(self.db.commit_transaction, "b"), "Transaction b committed successfully.")
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 20)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "2")["v"], 10)
+
+
+class LockEscalationTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(lock_escalation_threshold=3, lock_timeout=0.1)
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        for key in range(6):
+            self.run_quietly(self.db.insert, "t", str(key), [str(key), "0"])
+
+    def test_row_locks_escalate_to_a_table_lock_at_the_threshold(self):
+        self.run_quietly(self.db.begin_transaction, "w")
+        for key in range(3):
+            self.run_quietly(self.db.update, "t", str(key), {"v": "1"}, "w")
+        self.assertEqual(self.db.transaction_manager.get_lock_stats()["escalations"], 0)
+        self.run_quietly(self.db.update, "t", "3", {"v": "1"}, "w")
+
+        stats = self.db.transaction_manager.get_lock_stats()
+        self.assertEqual((stats["escalations"], stats["table_locks"], stats["locked_keys"]), (1, 1, 1))
+        self.assertIn("Could not acquire lock", self.run_quietly(self.db.update, "t", "5", {"v": "2"}))
+        self.run_quietly(self.db.commit_transaction, "w")
+        self.assertEqual(self.db.transaction_manager.get_lock_stats()["locked_keys"], 0)
+
+    def test_serializable_scan_takes_one_shared_table_lock(self):
+        self.run_quietly(self.db.begin_transaction, "r", "serializable")
+        self.assertEqual(len(self.run_quietly(self.db.select_where, "t", "v", "=", "0", "r")), 6)
+
+        locks = self.db.transaction_manager.active_transactions["r"]["locks"]
+        self.assertEqual(locks, {("t", self.db.transaction_manager.TABLE_KEY): "S"})
+        self.run_quietly(self.db.commit_transaction, "r")
+
+
+class IntentionLockTest(EngineTestCase):
+    def test_row_writer_blocks_drop_column_until_it_commits(self):
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(lock_timeout=0.1)
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.update, "t", "1", {"v": "2"}, "w")
+        table_key = ("t", self.db.transaction_manager.TABLE_KEY)
+        self.assertEqual(self.db.transaction_manager.active_transactions["w"]["locks"][table_key], "IX")
+
+        self.assertEqual(self.run_quietly(self.db.drop_column, "t", "v"), "Could not acquire lock for t. Try again later.")
+        self.assertIn("v", self.db.tables["t"]["columns"])
+        self.run_quietly(self.db.commit_transaction, "w")
+        self.run_quietly(self.db.drop_column, "t", "v")
+        self.assertNotIn("v", self.db.tables["t"]["columns"])
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1"), {"id": 1})
+
+
+class AutocommitReadTest(EngineTestCase):
+    def test_point_reads_write_and_keep_nothing(self):
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        manager = self.db.transaction_manager
+        wal_size = self.db.wal.size()
+        history = len(manager.history)
+
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1"), {"id": 1, "v": 1})
+        self.assertEqual(self.run_quietly(self.db.get, "t", "2"), "Key not found!")
+        self.run_quietly(self.db.select_columns, "t", ["v"], "1")
+
+        self.assertEqual(self.db.wal.size(), wal_size)
+        self.assertEqual(len(manager.history), history)
+        self.assertEqual(manager.active_transactions, {})
+        self.assertEqual(manager.snapshots, {})
+        self.assertEqual(manager.get_lock_stats()["locked_keys"], 0)
+
+
+class TransactionHistoryTest(EngineTestCase):
+    def test_finished_transactions_and_lock_entries_stay_bounded(self):
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(transaction_history=5)
+        self.run_quietly(self.db.create_table, "t", ["id int"], {"id": ["primary_key"]})
+        for key in range(20):
+            self.run_quietly(self.db.insert, "t", str(key), [str(key)])
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.delete, "t", "0", "w")
+        self.run_quietly(self.db.rollback_transaction, "w")
+
+        stats = self.db.transaction_manager.get_memory_stats()
+        self.assertEqual((stats["history"], stats["history_size"]), (5, 5))
+        self.assertEqual((stats["active_transactions"], stats["logged_operations"], stats["undo_entries"]), (0, 0, 0))
+        self.assertEqual((stats["lock_entries"], stats["queued_requests"]), (0, 0))
+        self.assertEqual(list(self.db.transaction_manager.history)[-1], "w")
+
+
+class RolledBackVersionTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+
+    def test_rollback_does_not_hide_a_later_commit(self):
+        self.run_quietly(self.db.begin_transaction, "c")  # Keeps a snapshot open across what follows
+        self.run_quietly(self.db.begin_transaction, "b")
+        self.assertEqual(self.run_quietly(self.db.update, "t", "1", {"v": "100"}, "b"), "Updated successfully!")
+        self.run_quietly(self.db.rollback_transaction, "b")
+        self.assertEqual(self.run_quietly(self.db.update, "t", "1", {"v": "2"}), "Updated successfully!")
+
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 2)
+        self.assertEqual(self.db.tables["t"]["records"]["1"]["v"], 2)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1", "c")["v"], 1)  # The old snapshot still reads its value
+        self.run_quietly(self.db.commit_transaction, "c")
+
+    def test_vacuum_drops_rolled_back_versions_that_were_superseded(self):
+        self.run_quietly(self.db.begin_transaction, "c")
+        self.run_quietly(self.db.begin_transaction, "b")
+        self.run_quietly(self.db.update, "t", "1", {"v": "100"}, "b")
+        self.run_quietly(self.db.rollback_transaction, "b")
+        self.run_quietly(self.db.update, "t", "1", {"v": "2"})
+        self.run_quietly(self.db.vacuum)
+
+        chain = self.db.transaction_manager.row_versions["t"]["1"]
+        self.assertFalse(any(version.aborted for version in chain))
+        self.run_quietly(self.db.commit_transaction, "c")
+
+    def test_savepoint_rollback_does_not_hide_a_later_commit(self):
+        self.run_quietly(self.db.begin_transaction, "c")
+        self.run_quietly(self.db.begin_transaction, "b")
+        self.run_quietly(self.db.savepoint, "b", "s")
+        self.run_quietly(self.db.update, "t", "1", {"v": "100"}, "b")
+        self.run_quietly(self.db.rollback_to_savepoint, "b", "s")
+        self.run_quietly(self.db.commit_transaction, "b")
+        self.run_quietly(self.db.update, "t", "1", {"v": "2"})
+
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1")["v"], 2)
+        self.run_quietly(self.db.commit_transaction, "c")
+
+
+class SavepointTest(EngineTestCase):
+    def test_rollback_to_undoes_later_changes_and_the_wal_replays_the_rest(self):
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "1"])
+        self.run_quietly(self.db.begin_transaction, "w")
+        self.run_quietly(self.db.insert, "t", "2", ["2", "2"], "w")
+        self.assertEqual(self.run_quietly(self.db.savepoint, "w", "s"), "Savepoint s created.")
+        self.run_quietly(self.db.update, "t", "1", {"v": "50"}, "w")
+        self.run_quietly(self.db.insert, "t", "3", ["3", "3"], "w")
+        self.run_quietly(self.db.delete, "t", "2", "w")
+
+        self.assertEqual(self.run_quietly(self.db.rollback_to_savepoint, "w", "s"), "Rolled back to savepoint s.")
+        self.assertEqual(self.run_quietly(self.db.get, "t", "1", "w")["v"], 1)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "2", "w")["v"], 2)
+        self.assertEqual(self.run_quietly(self.db.get, "t", "3", "w"), "Key not found!")
+        self.run_quietly(self.db.update, "t", "1", {"v": "7"}, "w")
+        self.assertEqual(self.run_quietly(self.db.release_savepoint, "w", "s"), "Savepoint s released.")
+        self.assertEqual(self.run_quietly(self.db.rollback_to_savepoint, "w", "s"), "Savepoint s does not exist!")
+        self.run_quietly(self.db.commit_transaction, "w")
+
+        expected = {"1": {"id": 1, "v": 7}, "2": {"id": 2, "v": 2}}
+        self.assertEqual(dict(self.db.tables["t"]["records"]), expected)
+        self.run_quietly(self.db.close)
+        self.db = self.open_database()  # Rebuilt from the WAL alone
+        self.assertEqual(dict(self.db.tables["t"]["records"]), expected)
+
+
+class UpdateValidationTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "5"])
+        self.run_quietly(self.db.create_index, "t", "v")
+
+    def test_invalid_value_is_refused_and_leaves_the_index_alone(self):
+        result = self.run_quietly(self.db.update, "t", "1", {"v": "abc"})
+
+        self.assertEqual(result, "Invalid value 'abc' for column 'v' (Expected int)")
+        self.assertEqual(self.db.indexer.indexes["t"]["v"], {5: ["1"]})
+        self.assertEqual(self.db.transaction_manager.get_lock_stats()["locked_keys"], 0)
+        self.assertEqual(self.run_quietly(self.db.update, "t", "1", {"v": "7"}), "Updated successfully!")
+        self.assertEqual(self.db.tables["t"]["records"]["1"]["v"], 7)
+
+    def test_index_keeps_values_of_another_type(self):
+        from oldengine import OrderedIndex
+        index = OrderedIndex({3: ["a"], "x": ["b"], 1: ["c"]})
+        index.add("y", "d")
+        index.add(2, "e")
+
+        self.assertEqual(list(index.values_between(1, 3)), [1, 2, 3])
+        self.assertEqual(index["x"], ["b"])
+        index.discard("x", "b")
+        index.discard(2, "e")
+        self.assertEqual(list(index.values_between()), [1, 3])
+        self.assertEqual(set(index), {1, 3, "y"})
+
+
+class SnapshotSchemaTest(EngineTestCase):
+    def test_scan_conditions_are_typed_by_the_table_the_snapshot_sees(self):
+        self.run_quietly(self.db.create_table, "t", ["id int", "v int"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "1", ["1", "50"])
+        self.run_quietly(self.db.begin_transaction, "s")
+        expected = [{"id": 1, "v": 50}]
+        self.assertEqual(self.run_quietly(self.db.select_where, "t", "v", "=", "50", "s"), expected)
+
+        self.run_quietly(self.db.drop_table, "t")
+        self.assertEqual(self.run_quietly(self.db.select_where, "t", "v", "=", "50", "s"), expected)
+        self.run_quietly(self.db.create_table, "t", ["id int", "v string"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "t", "2", ["2", "50"])
+        self.assertEqual(self.run_quietly(self.db.select_where, "t", "v", "=", "50", "s"), expected)
+        self.assertEqual(self.run_quietly(self.db.select_where, "t", "v", "=", "50"), [{"id": 2, "v": "50"}])
+        self.run_quietly(self.db.commit_transaction, "s")
+
+
+class UniqueConstraintTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "users", ["id int", "email string"],
+                         {"id": ["primary_key"], "email": ["unique"]})
+
+    def insert_concurrently(self, keys):
+        results = []
+        start = threading.Barrier(len(keys))
+
+        def insert(key):
+            start.wait()
+            results.append(self.db.insert("users", key, [key, "a@example.com"]))
+        threads = [threading.Thread(target=insert, args=(key,)) for key in keys]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def test_only_one_of_concurrent_inserts_of_a_value_succeeds(self):
+        results = self.insert_concurrently([str(key) for key in range(8)])
+
+        self.assertEqual(results.count("Inserted successfully!"), 1)
+        self.assertEqual(results.count("Unique constraint violation: 'email' must be unique!"), 7)
+        self.assertEqual(len(self.db.tables["users"]["records"]), 1)
+
+    def test_insert_waiting_on_a_value_goes_through_when_its_holder_rolls_back(self):
+        self.run_quietly(self.db.begin_transaction, "a")
+        self.run_quietly(self.db.insert, "users", "1", ["1", "a@example.com"], "a")
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(self.db.insert("users", "2", ["2", "a@example.com"])))
+        with contextlib.redirect_stdout(io.StringIO()):
+            waiter.start()
+            while not self.db.transaction_manager.waiting:
+                time.sleep(0.01)
+            self.db.rollback_transaction("a")
+            waiter.join(5)
+
+        self.assertEqual(results, ["Inserted successfully!"])
+        self.assertEqual(list(self.db.tables["users"]["records"]), ["2"])
+
+
+class ForeignKeyTableTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.run_quietly(self.db.create_table, "classes", ["id int", "name string"], {"id": ["primary_key"]})
+        self.run_quietly(self.db.insert, "classes", "c1", ["101", "a"])
+        self.run_quietly(self.db.insert, "classes", "c2", ["102", "b"])
+
+    def create_students(self, on_delete):
+        self.run_quietly(self.db.create_table, "students", ["id int", "class_id int"],
+                         {"id": ["primary_key"], "class_id": ["foreign_key", "classes.id", on_delete]})
+        self.run_quietly(self.db.insert, "students", "1", ["1", "102"])
+        self.run_quietly(self.db.insert, "students", "2", ["2", "101"])
+
+    def test_emptying_a_referenced_table_is_restricted(self):
+        self.create_students("restrict")
+
+        result = self.run_quietly(self.db.delete_table, "classes")
+        self.assertEqual(result, "Foreign Key violation: 'classes' is still referenced by 'students'")
+        self.assertEqual(len(self.db.tables["classes"]["records"]), 2)
+
+    def test_emptying_a_referenced_table_cascades(self):
+        self.create_students("cascade")
+
+        self.assertEqual(self.run_quietly(self.db.delete_table, "classes"), "All records deleted from table 'classes'.")
+        self.assertEqual(dict(self.db.tables["students"]["records"]), {})
+        self.assertEqual(dict(self.db.indexer.indexes["students"]["class_id"]), {})
+
+    def test_dropping_a_referenced_table_is_refused_across_a_reload(self):
+        self.create_students("cascade")
+
+        self.assertIn("foreign key 'students.class_id' references it", self.run_quietly(self.db.drop_table, "classes"))
+        self.run_quietly(self.db.close)
+        self.db = self.open_database()
+        self.assertIn("classes", self.db.tables)
+        self.assertEqual(self.db.tables["students"]["records"]["1"]["class_id"], 102)
+        self.assertIn("references it", self.run_quietly(self.db.drop_column, "classes", "id"))
+        self.assertEqual(self.run_quietly(self.db.drop_table, "students"), "Table 'students' dropped successfully.")
+        self.assertEqual(self.run_quietly(self.db.drop_table, "classes"), "Table 'classes' dropped successfully.")
+
+    def test_index_created_on_the_parent_is_written_to_its_segment(self):
+        self.run_quietly(self.db.close)
+        self.db = self.open_database(storage_layout="segmented")
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+        self.create_students("restrict")
+        self.assertIn("classes", self.db.dirty_tables)
+        self.assertTrue(self.run_quietly(self.db.checkpoint))
+
+        with open(self.db._segment_path("classes")) as file:
+            self.assertEqual(json.load(file)["indexes"]["id"]["entries"], [[101, ["c1"]], [102, ["c2"]]])
+
+
+if __name__ == "__main__":
+    unittest.main()